@@ -1,9 +1,16 @@
 # -*- coding: utf-8 -*-
 
+from django.conf import settings
+from django.conf.urls import patterns, url
 from django.contrib import admin
+from django.contrib.admin.views.main import ChangeList
+from django.core.urlresolvers import reverse
+from django.http import Http404, HttpResponseRedirect
+from django.shortcuts import render
 from mc.views import *
 from mc.models import *
 from mc.manager import *
+from mc import status
 
 class YigoEnvAdmin(admin.ModelAdmin):
     list_display = ('version','path')
@@ -11,100 +18,107 @@ class YigoEnvAdmin(admin.ModelAdmin):
 class JavaEnvAdmin(admin.ModelAdmin):
     list_display = ('version','path')
 
+class JvmProfileAdmin(admin.ModelAdmin):
+    list_display = ('yigo_env', 'java_env', 'options', 'class_data_sharing')
+
 class YigoHostAdmin(admin.ModelAdmin):
-    list_display = ('address', 'ssh_user', 'ssh_port')
+    list_display    = ('address', 'ssh_user', 'ssh_port', 'num_instances', 'max_instances', 'reserved_heap')
+    readonly_fields = ('num_instances', 'reserved_heap',)
 
 class DatabaseHostAdmin(admin.ModelAdmin):
-    list_display = ('address', 'ssh_user', 'ssh_port', 'port')
+    list_display    = ('address', 'ssh_user', 'ssh_port', 'port', 'num_instances', 'max_instances')
+    readonly_fields = ('num_instances',)
+
+class YigoInstanceChangeList(ChangeList):
+    """Probes the running states of the instances of the page, one remote command
+    per yigo host, hosts in parallel (see mc.status.probe). Action POSTs skip it,
+    they are mostly redirected without showing the page."""
+
+    def get_results(self, request):
+        super(YigoInstanceChangeList, self).get_results(request)
+        if request.method == 'POST' and 'action' in request.POST:
+            return
+        running, errors = status.probe([instance.pk for instance in self.result_list],
+                                       timeout=settings.MC_ADMIN_STATUS_TIMEOUT)
+        # Unknown if the host failed or did not answer in time
+        for instance in self.result_list:
+            instance.running_state = running.get(instance.pk)
 
 class YigoInstanceAdmin(admin.ModelAdmin):
     list_display    = ('external_id', 'yigo_host', 'service_port', 'installed', 'database_host', \
-                       'database_installed')
+                       'database_installed', 'running')
+    list_select_related = ('yigo_host', 'database_host',)
     readonly_fields = ( 'busy', 'installed', 'database_installed','database_password',)
     actions         = ['install_instance','start_instance','stop_instance','uninstall_instance',]
 
-
+    def get_changelist(self, request, **kwargs):
+        return YigoInstanceChangeList
+
+    def running(self, instance):
+        return getattr(instance, 'running_state', None)
+    running.boolean = True
+
+
+    def get_urls(self):
+        urls = super(YigoInstanceAdmin, self).get_urls()
+        return patterns('',
+            url(r'^batch/(?P<job_id>\d+)/$', self.admin_site.admin_view(self.batch_job_view),
+                name='mc_yigoinstance_batch_job'),
+        ) + urls
+
+    def batch_job_view(self, request, job_id):
+        """进度和结果页面，批量任务运行时每2秒刷新"""
+        try:
+            job = Manager().batch_job_status(job_id)
+        except BatchJob.DoesNotExist:
+            raise Http404
+        return render(request, 'admin/mc/yigoinstance/batch_job.html', {
+            'title': 'Batch job %s: %s' % (job['id'], job['method'],),
+            'job': job,
+            'running': job['state'] in (JOB_PENDING, JOB_RUNNING,),
+            'opts': self.model._meta,
+            'app_label': self.model._meta.app_label,
+        })
+
+    def _submit(self, request, method, pks, **options):
+        """把选中的实例作为一个批量任务提交给 mc_worker，各主机并行执行，然后转到进度页面"""
+        if not pks:
+            self.message_user(request, "no instances to %s" % (method.split('_')[0],))
+            return None
+        job_id = Manager().submit_many(method, pks, **options)
+        return HttpResponseRedirect(reverse('admin:mc_yigoinstance_batch_job', args=(job_id,)))
 
     def install_instance(self,request,queryset):
         """ 1.安装实例，2.根据instance的id，创建数据库的用户名和密码，注意：external_id必须是以字母开头database_name=external_id,
                                 database_user=external_id,'database_name', 'database_name', 'database_user'"""
-        instances=queryset
-        count=0
-        installed_count=0
-        for instance in instances:
-            external_id=instance.external_id
-            queryset.update(database_password=generate_password())
-            if instance.installed==False and instance.database_installed==False:
-                ins= Manager()
-                ins.install(instance.id)
-                count+=1
-            else:
-                installed_count+=1
-        if count==0:
-            self.message_user(request,"no instances install success")
-        else:
-            self.message_user(request,"%s instances new install and %s instances had been installed before this time"%(count ,installed_count,))
-
-
+        pks = list(queryset.exclude(installed=True, database_installed=True).values_list('pk', flat=True))
+        # Every database about to be created gets a password of its own
+        for pk in queryset.filter(pk__in=pks, database_installed=False).values_list('pk', flat=True):
+            YigoInstance.objects.filter(pk=pk).update(database_password=generate_password())
+        installed_count = queryset.count() - len(pks)
+        if installed_count:
+            self.message_user(request, "%s instances had been installed before this time" % (installed_count,))
+        return self._submit(request, 'install_many', pks)
 
     def start_instance(self,request,queryset):
-        """启动实例"""
-        instances=queryset
-        count=0
-        start_count=0
-        for instance in instances:
-            if instance.installed==True and instance.database_installed==True:
-                ins=Manager()
-                if ins.is_running(instance.id)==True:
-                   start_count+=1
-                else:
-                    ins.start(instance.id)
-                    count+=1
-            else:
-                pass
-        if count==0:
-            self.message_user(request,"no instances start")
-        else:
-            self.message_user(request,"start %s instances success and %s instances is running" %(count ,start_count,))
-
+        """启动实例，正在运行的实例在结果中报告 InstanceIsRunning"""
+        pks = list(queryset.filter(installed=True, database_installed=True).values_list('pk', flat=True))
+        return self._submit(request, 'start_many', pks)
 
     def stop_instance(self,request,queryset):
         """停止实例"""
-        instances=queryset
-        count=0
-        for instance in instances:
-            if instance.installed==False and instance.database_installed==False:
-                pass
-            else:
-                ins=Manager()
-                if ins.is_running(instance.id)==True:
-                    ins.stop(instance.id)
-                    count+=1
-                else:
-                    pass
-        self.message_user(request,"stop %s  instances success" %count)
+        pks = list(queryset.filter(installed=True, database_installed=True).values_list('pk', flat=True))
+        return self._submit(request, 'stop_many', pks)
 
     def uninstall_instance(self,request,queryset):
-        """ 删除实例"""
-        instances=queryset
-        count=0
-        for instance in instances:
-            if instance.installed==False and instance.database_installed==False:
-               pass
-            else:
-                ins=Manager()
-                if ins.is_running(instance.id)==True:
-                    ins.stop(instance.id)
-                    ins.uninstall(instance.id)
-                    count+=1
-                else:
-                    ins.uninstall(instance.id)
-                    count+=1
-        self.message_user(request,"uninstall %s instances  success" %count)
+        """ 删除实例，正在运行的实例先停止"""
+        pks = list(queryset.exclude(installed=False, database_installed=False).values_list('pk', flat=True))
+        return self._submit(request, 'uninstall_many', pks, stop=True)
 
 
 admin.site.register(YigoEnv,YigoEnvAdmin)
 admin.site.register(JavaEnv,JavaEnvAdmin)
+admin.site.register(JvmProfile,JvmProfileAdmin)
 admin.site.register(YigoHost,YigoHostAdmin)
 admin.site.register(DatabaseHost,DatabaseHostAdmin)
 admin.site.register(YigoInstance,YigoInstanceAdmin)
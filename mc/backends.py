@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+
+import os
+import random
+import re
+import subprocess
+import sys
+import threading
+import time
+
+from django.conf import settings
+from django.utils.module_loading import import_by_path
+
+from mc.metrics import inc, observe
+
+
+def run(command, *args, **kwargs):
+    """Run `command' on the current host (`env.host_string') with the backend of
+    MC_EXECUTION_BACKEND, timed and counted by the fabtask it runs in. Takes the
+    arguments of fabric's `run'."""
+    from fabric.api import env
+    operation = env.command or ''
+    start = time.time()
+    try:
+        return get_backend().run(command, *args, **kwargs)
+    except Exception, e:
+        inc('mc_remote_command_errors_total', operation=operation, exception=e.__class__.__name__)
+        raise
+    finally:
+        observe('mc_remote_command_seconds', time.time() - start, operation=operation)
+
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+def get_backend():
+    path = settings.MC_EXECUTION_BACKEND
+    if path not in _backends:
+        with _backends_lock:                            # operations of many threads share it
+            if path not in _backends:
+                _backends[path] = import_by_path(path)()
+    return _backends[path]
+
+
+class FabricBackend(object):
+    """Runs commands over SSH with fabric, the backend of real hosts."""
+
+    def run(self, command, *args, **kwargs):
+        from fabric.api import run
+        return run(command, *args, **kwargs)
+
+
+# Tools of the managed hosts the simulator replaces, see `SimulatorBackend', java also
+# in the (quoted) contents of instance launchers
+_SIMULATED_TOOLS = ((re.compile(r'/usr/bin/mysql\b'), 'mysql'),
+                    (re.compile(r'[^\s\'"=]*/bin/java\b'), 'java'),)
+
+_MYSQL = r'''#!/bin/bash
+# Simulated mysql client: databases and users (holding their password) are files under ~/.mysql
+force=0; for arg in "$@"; do [ "$arg" = --force ] && force=1; done
+mkdir -p ~/.mysql/databases ~/.mysql/users; rc=0
+fail() { echo "ERROR $1" >&2; rc=1; [ $force -eq 1 ] || exit 1; }
+while read -r line; do
+  if [[ $line =~ ^create\ database\ if\ not\ exists\ ([A-Za-z0-9_]+)\; ]]; then
+    touch ~/.mysql/databases/${BASH_REMATCH[1]}
+  elif [[ $line =~ ^create\ database\ ([A-Za-z0-9_]+)\; ]]; then
+    f=~/.mysql/databases/${BASH_REMATCH[1]}; [ -e $f ] && { fail "1007 database exists"; continue; }; touch $f
+  elif [[ $line =~ ^use\ ([A-Za-z0-9_]+)\; ]]; then
+    [ -e ~/.mysql/databases/${BASH_REMATCH[1]} ] || fail "1049 unknown database"
+  elif [[ $line =~ ^drop\ database\ ([A-Za-z0-9_]+)\; ]]; then
+    f=~/.mysql/databases/${BASH_REMATCH[1]}; [ -e $f ] || { fail "1008 no database"; continue; }; rm $f
+  elif [[ $line =~ ^create\ user\ \'([A-Za-z0-9_]+)\'.*\ identified\ by\ \'([^\']*)\' ]]; then
+    f=~/.mysql/users/${BASH_REMATCH[1]}; [ -e $f ] && { fail "1396 user exists"; continue; }
+    echo "${BASH_REMATCH[2]}" > $f
+  elif [[ $line =~ ^set\ password\ for\ \'([A-Za-z0-9_]+)\'.*password\(\'([^\']*)\'\) ]]; then
+    f=~/.mysql/users/${BASH_REMATCH[1]}; [ -e $f ] || { fail "1133 no user"; continue; }
+    echo "${BASH_REMATCH[2]}" > $f
+  elif [[ $line =~ ^drop\ user\ \'([A-Za-z0-9_]+)\' ]]; then
+    f=~/.mysql/users/${BASH_REMATCH[1]}; [ -e $f ] || { fail "1396 no user"; continue; }; rm $f
+  fi
+done
+exit $rc
+'''
+
+_JAVA = r'''#!/bin/bash
+# Simulated JVM: stays up with its arguments visible to ps until it is killed.
+# Class data sharing: -Xshare:dump writes the archive, a class list asked for is
+# written on exit, and an archive in use halves the startup.
+dump=0; archive=; classlist=; startup=${MC_SIMULATOR_JVM_STARTUP:-0}
+for arg in "$@"; do
+  case "$arg" in
+    -Xshare:dump) dump=1 ;;
+    -XX:SharedArchiveFile=*) archive=${arg#*=} ;;
+    -XX:DumpLoadedClassList=*) classlist=${arg#*=} ;;
+  esac
+done
+if [ $dump -eq 1 ]; then echo simulated > "$archive"; exit 0; fi
+[ -n "$archive" ] && [ -e "$archive" ] && startup=$(awk "BEGIN { print $startup / 2 }")
+echo "Simulated JVM started: $*"
+sleep $startup
+echo "Server started"
+trap '[ -n "$classlist" ] && echo simulated/Main > "$classlist"; echo "Server stopped"; exit 0' TERM
+while :; do sleep 1 & wait $!; done
+'''
+
+_WGET = r'''#!/bin/bash
+# Simulated wget: every config pack URL serves the same pack, a download takes
+# MC_SIMULATOR_DOWNLOAD seconds and is logged to ~/wget.log
+out=; url=
+while [ $# -gt 0 ]; do
+  case "$1" in -O) out=$2; shift ;; -T) shift ;; -*) ;; *) url=$1 ;; esac; shift
+done
+if [[ $url == *.sha256sum ]]; then
+  content="$(cd "$MC_SIMULATOR_SHARE" && sha256sum configs.tar.gz | cut -d ' ' -f 1)  ${url##*/}"
+  content=${content%.sha256sum}
+  if [ "$out" = - ]; then echo "$content"; else echo "$content" > "$out"; fi
+else
+  echo "$url" >> ~/wget.log
+  sleep ${MC_SIMULATOR_DOWNLOAD:-0}
+  if [ "$out" = - ]; then cat "$MC_SIMULATOR_SHARE/configs.tar.gz"; else cp "$MC_SIMULATOR_SHARE/configs.tar.gz" "$out"; fi
+fi
+'''
+
+_TAR = r'''#!/bin/bash
+# Every yigo release pack is the simulated one
+for arg in "$@"; do
+  if [[ $arg == yigo-*.tar.gz && ! -e $arg ]]; then ln -s "$MC_SIMULATOR_SHARE/release.tar.gz" "$arg"; fi
+done
+exec /bin/tar "$@"
+'''
+
+
+class SimulatorBackend(object):
+    """
+    Runs commands of every host on the local machine, in a sandbox directory of
+    its own under MC_SIMULATOR_ROOT which is the home directory of the host.
+
+    mysql, java, wget and yigo release packs are simulated by scripts put first in
+    PATH: databases are files, a JVM is a shell process showing its arguments to
+    `ps', and config packs are served from local files. Every command takes
+    MC_SIMULATOR_LATENCY seconds (plus up to MC_SIMULATOR_JITTER) more than running
+    it locally, the first one of a host in a process MC_SIMULATOR_CONNECT_LATENCY
+    more, like opening an SSH connection.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.prepared = None
+        self.connected = set()
+
+    def _prepare(self, root):
+        # Other processes may use the files meanwhile, they are replaced by renaming
+        with self.lock:
+            if self.prepared == root:
+                return
+            tools = os.path.join(root, 'bin')
+            share = os.path.join(root, 'share')
+            for path in (tools, share):
+                if not os.path.isdir(path):
+                    try:
+                        os.makedirs(path)
+                    except OSError:
+                        pass                            # made by another process meanwhile
+            for name, script in (('mysql', _MYSQL), ('java', _JAVA), ('wget', _WGET), ('tar', _TAR),):
+                filename = os.path.join(tools, name)
+                with open('%s.%s' % (filename, os.getpid(),), 'w') as f:
+                    f.write(script)
+                os.chmod(f.name, 0755)
+                os.rename(f.name, filename)
+            if not os.path.exists(os.path.join(share, 'configs.tar.gz')):
+                build = os.path.join(share, 'build.%s' % (os.getpid(),))
+                subprocess.check_call(
+                    "rm -rf '%s' && mkdir -p '%s' && cd '%s'"
+                    " && mkdir -p release/WEB-INF/classes release/WEB-INF/lib"
+                    " && echo simulated > release/WEB-INF/classes/core.properties"
+                    " && tar -czf release.tar.gz -C release . && mv release.tar.gz .."
+                    " && mkdir -p configs/main configs/_yigo/WEB-INF/classes"
+                    " && echo simulated > configs/main/solution.xml"
+                    " && echo simulated > configs/_yigo/WEB-INF/classes/app.properties"
+                    " && tar -czf configs.tar.gz -C configs . && mv configs.tar.gz .."
+                    " && cd .. && rm -rf '%s'" % (build, build, build, build,), shell=True)
+            self.prepared = root
+
+    def sandbox(self, host_string):
+        """The home directory of host `host_string'."""
+        root = settings.MC_SIMULATOR_ROOT
+        self._prepare(root)
+        path = os.path.join(root, 'hosts', host_string.split('@')[-1].replace(':', '_'))
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                pass                                    # made by another process meanwhile
+        return path
+
+    def run(self, command, shell=True, pty=True, combine_stderr=None, quiet=False, warn_only=False,
+            stdout=None, stderr=None, timeout=None, shell_escape=None):
+        from fabric.api import env
+        from fabric.operations import _AttributeString, _prefix_commands
+        from fabric.state import output
+        from fabric.utils import abort
+        home = self.sandbox(env.host_string)
+        latency = settings.MC_SIMULATOR_LATENCY + random.random() * settings.MC_SIMULATOR_JITTER
+        if (os.getpid(), env.host_string) not in self.connected:
+            self.connected.add((os.getpid(), env.host_string))
+            latency += settings.MC_SIMULATOR_CONNECT_LATENCY
+        time.sleep(latency)
+
+        wrapped = _prefix_commands(command, 'remote')
+        for pattern, tool in _SIMULATED_TOOLS:
+            wrapped = pattern.sub(tool, wrapped)
+        root = settings.MC_SIMULATOR_ROOT
+        environ = dict(os.environ, HOME=home, PATH=os.path.join(root, 'bin') + ':' + os.environ.get('PATH', ''),
+                       MC_SIMULATOR_SHARE=os.path.join(root, 'share'),
+                       MC_SIMULATOR_JVM_STARTUP=str(settings.MC_SIMULATOR_JVM_STARTUP),
+                       MC_SIMULATOR_DOWNLOAD=str(settings.MC_SIMULATOR_DOWNLOAD))
+        process = subprocess.Popen(['/bin/bash', '-c', wrapped], cwd=home, env=environ, close_fds=True,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT if combine_stderr is not False else subprocess.PIPE)
+        out, err = process.communicate()
+        if not quiet and output.stdout:
+            (stdout or sys.stdout).write(out)
+        result = _AttributeString(out.strip())             # as fabric does
+        result.stderr = _AttributeString((err or '').strip())
+        result.command = command
+        result.real_command = wrapped
+        result.return_code = process.returncode
+        result.failed = process.returncode != 0
+        result.succeeded = not result.failed
+        if result.failed and not (quiet or warn_only or env.warn_only):
+            abort("run() received nonzero return code %s while executing!\n\nRequested: %s\nExecuted: %s" %
+                  (process.returncode, command, wrapped,))
+        return result
+
+
+# Local Variables: **
+# comment-column: 56 **
+# indent-tabs-mode: nil **
+# python-indent: 4 **
+# End: **
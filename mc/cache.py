@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+import atexit
+import os
+import shutil
+import tempfile
+import time
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.cache.backends.filebased import FileBasedCache, pickle
+
+
+class SharedFileCache(FileBasedCache):
+    """
+    File cache shared by the job workers and the uwsgi processes of one machine,
+    so progress events and running states written by one are read by the others
+    (see mc.events, mc.status).
+
+    Entries are written to a temporary file renamed over the entry, readers never
+    see a half written entry. Counting the entries walks the whole cache, so a
+    process checks MAX_ENTRIES at most every CULL_INTERVAL seconds (an option,
+    60 by default) instead of on every write.
+    """
+
+    def __init__(self, dir, params):
+        super(SharedFileCache, self).__init__(dir, params)
+        self._cull_interval = int(params.get('OPTIONS', {}).get('CULL_INTERVAL', 60))
+        self._next_cull = 0
+
+    def _cull(self):
+        if time.time() < self._next_cull:
+            return
+        self._next_cull = time.time() + self._cull_interval
+        super(SharedFileCache, self)._cull()
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        fname = self._key_to_file(key)
+        dirname = os.path.dirname(fname)
+        if timeout == DEFAULT_TIMEOUT:
+            timeout = self.default_timeout
+        self._cull()
+        try:
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                # Made meanwhile by another process
+                if not os.path.isdir(dirname):
+                    raise
+            fd, tmp_path = tempfile.mkstemp(dir=dirname)
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    expiry = None if timeout is None else time.time() + timeout
+                    pickle.dump(expiry, f, pickle.HIGHEST_PROTOCOL)
+                    pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+                os.rename(tmp_path, fname)
+            except:
+                os.remove(tmp_path)
+                raise
+        except (IOError, OSError):
+            pass
+
+
+def use_dir(dirname):
+    """Keep the entries of the default cache of this process in `dirname'."""
+    from django.core.cache import cache
+    cache._dir = dirname
+
+def use_scratch_dir():
+    """Keep the entries of the default cache of this process in a temporary
+    directory removed at exit, so test runs do not clear the cache of the
+    running processes. Returns the directory."""
+    dirname = tempfile.mkdtemp(prefix='yigo_runtime-cache-')
+    use_dir(dirname)
+    atexit.register(shutil.rmtree, dirname, True)
+    return dirname
+
+
+# Local Variables: **
+# comment-column: 56 **
+# indent-tabs-mode: nil **
+# python-indent: 4 **
+# End: **
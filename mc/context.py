@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+
+class OperationContext(object):
+    """
+    Facts about remote state learned during one operation, passed through fabtasks.
+
+    A fabtask asks the context for a fact (e.g. whether an instance is running)
+    instead of the remote host when the fact is already known, and records what
+    its own steps change (start, stop, rm), so one operation looks a fact up
+    once however many tasks need it. A context must not outlive its operation:
+    its facts only stay true while the lease of the instance is held.
+    """
+
+    def __init__(self, running=None):
+        self.facts = {}
+        self.lookups = 0
+        for pk, value in (running or {}).items():
+            self.facts[('running', pk)] = value
+
+    def fact(self, name, instance, lookup):
+        """Fact `name' of `instance', calling `lookup(instance)' if it is not known yet."""
+        key = (name, instance.pk)
+        if key not in self.facts:
+            self.lookups += 1
+            self.facts[key] = lookup(instance)
+        return self.facts[key]
+
+    def record(self, name, instance, value):
+        """Record fact `name' of `instance' changed by a step of the operation."""
+        self.facts[(name, instance.pk)] = value
+
+    def forget(self, name, instance):
+        """Forget fact `name' of `instance' when a step changed it unpredictably."""
+        self.facts.pop((name, instance.pk), None)
+
+
+# Local Variables: **
+# comment-column: 56 **
+# indent-tabs-mode: nil **
+# python-indent: 4 **
+# End: **
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+def _cache_key(pk):
+    return 'mc:events:%s' % (pk,)
+
+
+def emit(pk, event, **data):
+    """
+    Record progress event `event' of instance `pk' with `data', e.g. a finished
+    step of an operation.
+
+    The last MC_EVENTS_BUFFER events of every instance are kept in the cache for
+    MC_EVENTS_TTL seconds, so late subscribers get the events they missed. Only
+    the holder of the instance lease emits, so there is one writer per instance.
+    Event ids are increasing timestamps in microseconds, they stay valid for
+    `since' when the buffer expires.
+    """
+    events = cache.get(_cache_key(pk)) or []
+    event_id = int(time.time() * 1000000)
+    if events and event_id <= events[-1]['id']:
+        event_id = events[-1]['id'] + 1
+    data.update(id=event_id, instance=pk, event=event, time=event_id / 1000000.0)
+    events.append(data)
+    cache.set(_cache_key(pk), events[-settings.MC_EVENTS_BUFFER:], settings.MC_EVENTS_TTL)
+
+
+def since(pk, after=None):
+    """Buffered events of instance `pk' with an id above `after', all of them if it is `None'."""
+    events = cache.get(_cache_key(pk)) or []
+    return [event for event in events if after is None or event['id'] > after]
+
+
+def step_emitter(*pks):
+    """A `RemoteScript' step callback emitting every finished step for instances `pks'."""
+    def on_step(result):
+        for pk in pks:
+            emit(pk, result['step'], exit_code=result['exit_code'], seconds=result['seconds'])
+    return on_step
+
+
+# Local Variables: **
+# comment-column: 56 **
+# indent-tabs-mode: nil **
+# python-indent: 4 **
+# End: **
@@ -32,6 +32,21 @@ class RefreshOldData(Exception):
 class UninstallBeforeDelete(Exception):
     pass
 
+class ServicePortTaken(Exception):
+
+    def __init__(self, yigo_host, port):
+        self.port = port
+        Exception.__init__(self, 'Service port %s of yigo host %s is taken' % (port, yigo_host,))
+
+class RemoteStepFailed(RuntimeError):
+
+    def __init__(self, step, exit_code, command, output, steps):
+        self.step = step
+        self.exit_code = exit_code
+        self.steps = steps
+        RuntimeError.__init__(self, 'Step %s failed with exit code %s\n\nRequested: %s\n\n%s' %
+                              (step, exit_code, command, output,))
+
 # Local Variables: **
 # comment-column: 56 **
 # indent-tabs-mode: nil **
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+import copy
+import thread
+import threading
+from contextlib import contextmanager
+
+
+class ThreadLocalState(object):
+    """
+    Mixin turning a process-global fabric state dict (`env', `output') into one
+    giving every thread a dict of its own, see `install_thread_local_state'.
+
+    The thread installing it goes on with the contents the dict had then, other
+    threads start from a copy of them. `isolated' runs a block on a copy of the
+    dict of the current thread which is dropped afterwards, so settings changed
+    by one operation (e.g. `env.host_string') neither reach operations of other
+    threads nor later ones.
+    """
+
+    __slots__ = ()
+
+    def _stack(self):
+        local = dict.__getattribute__(self, '_local')
+        try:
+            return local.stack
+        except AttributeError:
+            if thread.get_ident() == dict.__getattribute__(self, '_owner'):
+                local.stack = [dict.__getattribute__(self, '_initial')]
+            else:
+                local.stack = [copy.deepcopy(dict.__getattribute__(self, '_pristine'))]
+            return local.stack
+
+    def current(self):
+        """The dict of the current thread."""
+        return self._stack()[-1]
+
+    @contextmanager
+    def isolated(self, base=None):
+        """Run the block on a copy of `base', of the dict of the current thread by default."""
+        stack = self._stack()
+        stack.append(copy.deepcopy(stack[-1] if base is None else base))
+        try:
+            yield
+        finally:
+            stack.pop()
+
+    def __getattr__(self, name):
+        return getattr(self.current(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self.current(), name, value)
+
+    def __delattr__(self, name):
+        delattr(self.current(), name)
+
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(self.current(), memo)
+
+    def __copy__(self):
+        return copy.copy(self.current())
+
+
+def _delegate(name):
+    def method(self, *args, **kwargs):
+        return getattr(self.current(), name)(*args, **kwargs)
+    method.__name__ = name
+    return method
+
+for _name in ('__contains__', '__delitem__', '__eq__', '__getitem__', '__iter__', '__len__', '__ne__',
+              '__repr__', '__setitem__', 'clear', 'copy', 'first', 'get', 'has_key', 'items', 'iteritems',
+              'iterkeys', 'itervalues', 'keys', 'pop', 'popitem', 'setdefault', 'update', 'values',):
+    setattr(ThreadLocalState, _name, _delegate(_name))
+
+
+def install_thread_local_state():
+    """Give every thread fabric `env' and `output' of its own.
+
+    The dicts are changed in place, to a subclass mixing in `ThreadLocalState',
+    as modules and closures (e.g. of `fabric.network.needs_host') hold them since
+    they were imported.
+    """
+    from fabric import state
+    for name in ('env', 'output',):
+        original = getattr(state, name)
+        if isinstance(original, ThreadLocalState):
+            continue
+        cls = original.__class__
+        initial = copy.deepcopy(original)
+        pristine = copy.deepcopy(original)
+        dict.__setattr__(original, '__class__',
+                         type('ThreadLocal%s' % (cls.__name__.lstrip('_'),), (ThreadLocalState, cls), {}))
+        dict.__setattr__(original, '_local', threading.local())
+        dict.__setattr__(original, '_owner', thread.get_ident())
+        dict.__setattr__(original, '_initial', initial)
+        dict.__setattr__(original, '_pristine', pristine)
+
+
+def current():
+    """Fabric `env' and `output' of the current thread, to pass to `isolated' in another thread."""
+    from fabric import state
+    return state.env.current(), state.output.current()
+
+
+@contextmanager
+def isolated(base=None):
+    """Run the block on copies of fabric `env' and `output' of the current thread,
+    or of `base' as returned by `current'."""
+    from fabric import state
+    env, output = base or (None, None)
+    with state.env.isolated(env):
+        with state.output.isolated(output):
+            yield
+
+
+# Local Variables: **
+# comment-column: 56 **
+# indent-tabs-mode: nil **
+# python-indent: 4 **
+# End: **
@@ -1,48 +1,80 @@
 # -*- coding: utf-8 -*-
 
-from fabric.api import run, cd
+import base64
+import hashlib
 
+from fabric.api import cd, env
+
+from mc.backends import run
+from mc.context import OperationContext
+from mc.events import emit, step_emitter
 from mc.exceptions import InstanceIsRunning
+from mc.journal import DATABASE_STEPS, YIGO_STEPS
+from mc.metrics import observe
+from mc.scripts import RemoteScript
 
 from django.conf import settings
 
 
-def _mysql_command(host, cmd):
-    return ("/usr/bin/mysql -h localhost -u '%s' '--password=%s' -P %s -e \"" % \
-            (host.admin_user, host.admin_password, host.port,)) + cmd + "\""
+def _quote(value):
+    return "'" + value.replace("'", "'\\''") + "'"
+
+def _mysql_command(host, statements, force=False):
+    """One mysql client session running all `statements' on `host'. The statements
+    are piped in and the admin password is passed in a file descriptor, so neither
+    shows up in the process list (`printf' is a shell builtin)."""
+    return "printf '%s\\n' " + ' '.join([_quote(s) for s in statements]) + \
+           " | /usr/bin/mysql --defaults-extra-file=<(printf '[client]\\npassword=%s\\n' " + \
+           _quote(host.admin_password) + ") -h localhost -u " + _quote(host.admin_user) + \
+           " -P %s" % (host.port,) + (" --force" if force else "")
+
+def _create_mysql_statements(instance):
+    database = instance.database_name()
+    user = instance.database_user()
+    password = instance.database_password
+    return ["create database %s;" % (database,),
+            "create user '%s'@'%%' identified by '%s';" % (user, password,),
+            "grant all on %s.* to '%s'@'%%';" % (database, user,)]
+
+def _drop_mysql_statements(instance):
+    return ["drop user '%s'@'%%';" % (instance.database_user(),),
+            "drop database %s;" % (instance.database_name(),)]
 
 
 def _get_instance_path(instance):
     return "%s/%s" % (instance.yigo_host.root_path, instance.id,)
 
+def _get_configs_cache_path(instance):
+    return "%s/.configs-cache" % (instance.yigo_host.root_path,)
+
 def _get_log4j_configuration(instance):
     return r"log4j.appender.LOGSTASH=org.apache.log4j.net.SocketAppender\nlog4j.appender.LOGSTASH.remoteHost=%s\nlog4j.appender.LOGSTASH.port=%s\nlog4j.appender.LOGSTASH.locationInfo=true\nlog4j.appender.LOGSTASH.application=%s\nlog4j.rootLogger=INFO,LOGSTASH\n" % (settings.LOGSTASH_HOST, settings.LOGSTASH_PORT, instance.id)
 
-def delete_mysql_instance(instance):
+def delete_mysql_instance(instance, context=None):
     """Delete database and user on remote mysql instance.
 
     Paramters
     ---------
     instance : mc.models.YigoInstance
+    context : mc.context.OperationContext of the operation, if any
     """
-    if is_yigo_instance_running(instance):
+    if is_yigo_instance_running(instance, context):
         raise InstanceIsRunning()
 
-    host = instance.database_host
-    database = instance.database_name()
-    user = instance.database_user()
-
-    cmd_drop_user = _mysql_command(host, "drop user '%s'@'%%';" % (user,) )
-    cmd_drop_database = _mysql_command(host, "drop database %s;" % (database,))
-    run(cmd_drop_user, quiet=True)
-    run(cmd_drop_database, quiet=True)
+    script = RemoteScript(quiet=True, on_step=step_emitter(instance.pk))
+    script.step('drop database', _mysql_command(instance.database_host, _drop_mysql_statements(instance),
+                                                force=True), check=False)
+    return script.run()
 
 
-def delete_yigo_instance(instance):
-    if is_yigo_instance_running(instance):
+def delete_yigo_instance(instance, context=None):
+    context = context or OperationContext()
+    if is_yigo_instance_running(instance, context):
         raise InstanceIsRunning()
 
     run("rm -rf %s" % (_get_instance_path(instance),), quiet=True)
+    context.record('running', instance, False)         # the pid file is gone
+    emit(instance.pk, 'instance deleted')
 
 
 def create_mysql_instance(instance):
@@ -52,25 +84,84 @@ def create_mysql_instance(instance):
     ----------
     instance : mc.models.YigoInstance
     """
-    host = instance.database_host
+    script = RemoteScript(on_step=step_emitter(instance.pk))
+    script.step('create database', _mysql_command(instance.database_host, _create_mysql_statements(instance)))
+    return script.run()
+
+
+def _create_mysql_instance_command(instance):
+    """Create database and user of `instance', keeping them if they exist already
+    (e.g. made by an earlier run which failed for another instance). The check
+    session sets the password of the user, a kept user may have an older one, and
+    fails unless both are there and granted."""
     database = instance.database_name()
     user = instance.database_user()
     password = instance.database_password
-    cmd_create_database = _mysql_command(host, "create database %s;" % (database,))
-    cmd_create_user = _mysql_command(host, "create user '%s'@'%%' identified by '%s';" % (user, password,))
-    cmd_grant = _mysql_command(host, "grant all on %s.* to '%s'@'%%';" % (database, user,))
-    run(cmd_create_database)
-    run(cmd_create_user)
-    run(cmd_grant)
+    create = ["create database if not exists %s;" % (database,),
+              "create user '%s'@'%%' identified by '%s';" % (user, password,)]
+    check = ["use %s;" % (database,),
+             "set password for '%s'@'%%' = password('%s');" % (user, password,),
+             "grant all on %s.* to '%s'@'%%';" % (database, user,)]
+    return _mysql_command(instance.database_host, create, force=True) + " 2> /dev/null; " + \
+           _mysql_command(instance.database_host, check)
+
+def create_mysql_instances(plan):
+    """Create databases and users of all planned instances of the current database
+    host, with one remote script of a step per instance. Instances are created
+    independently and again without error, so one failing instance does not fail
+    the others nor later retries.
+
+    Parameters
+    ----------
+    plan : dict of database host string to list of mc.models.YigoInstance
+
+    Returns
+    -------
+    dict of instance pk to its step result, failed if its 'exit_code' is not 0
+    """
+    instances = plan[env.host_string]
+    pks = {}
+    def on_step(result):
+        emit(pks[result['step']], result['step'], exit_code=result['exit_code'], seconds=result['seconds'])
+    script = RemoteScript(on_step=on_step)
+    for instance in instances:
+        name = 'create database %s' % (instance.database_name(),)
+        pks[name] = instance.pk
+        script.step(name, _create_mysql_instance_command(instance), check=False)
+    return dict((pks[result['step']], result) for result in script.run())
+
+
+def delete_mysql_instances(plan):
+    """Drop databases and users of all planned instances of the current database
+    host in one mysql session, errors of single statements are ignored.
 
+    Parameters
+    ----------
+    plan : dict of database host string to list of mc.models.YigoInstance
 
-def create_yigo_instance(instance):
+    Returns
+    -------
+    dict of instance pk to the step result, see `create_mysql_instances'
+    """
+    instances = plan[env.host_string]
+    statements = []
+    for instance in instances:
+        statements.extend(_drop_mysql_statements(instance))
+    script = RemoteScript(quiet=True, on_step=step_emitter(*[instance.pk for instance in instances]))
+    script.step('drop databases', _mysql_command(instances[0].database_host, statements, force=True),
+                check=False)
+    result = dict(script.run()[0], exit_code=0)         # errors of single statements are ignored
+    return dict((instance.pk, result) for instance in instances)
+
+
+def create_yigo_instance(instance, steps=YIGO_STEPS):
     """Create yigo instance directory layout, install yigo release pack and yigo app config pack.
     The process is completed successfully if no `Exception' raised.
 
     Parameters
     ----------
     instance : mc.models.YigoInstance
+    steps : the parts to (re)do, of 'release', 'log4j', 'configs' and 'launcher'
     """
     instance_code = instance.external_id
     configs_source = instance.configs_source
@@ -78,102 +169,519 @@ def create_yigo_instance(instance):
     checksum_source = configs_source + '.sha256sum'
     checksum_filename = configs_filename + '.sha256sum'
     instance_path = _get_instance_path(instance)
-    run("mkdir -p %s/{cache,configs,data,logs,tmp,yigo}" % (instance_path,))
-    run("tar -xf yigo-%s.tar.gz -C %s/yigo" % (instance.yigo_env.version, instance_path,))
-    run("echo -e \"" + _get_log4j_configuration(instance) + \
-        ("\" > %s/yigo/WEB-INF/classes/log4j.properties" % (instance_path,)))
-    with cd('%s/cache' % (instance_path,)):
-        # All timeout of wget are set to 2 seconds
-        run("wget -q -T 2 -O '%s' '%s'" % (checksum_filename, checksum_source,))
-        run("wget -q -T 2 -O '%s' '%s'" % (configs_filename, configs_source,))
-        run("sha256sum -c '%s'" % (checksum_filename,))
-        run("tar -xf '%s' -C '../configs'" % (configs_filename,))
-        run("test -e  ../configs/_yigo && cp -a ../configs/_yigo/* ../yigo/")
+    cache_path = '%s/cache' % (instance_path,)
+    script = RemoteScript(on_step=step_emitter(instance.pk))
+    script.step('layout', "mkdir -p %s/{bin,cache,configs,data,logs,tmp,yigo}" % (instance_path,))
+    if 'release' in steps:
+        script.step('release', "tar -xf yigo-%s.tar.gz -C %s/yigo" % (instance.yigo_env.version, instance_path,))
+    if 'log4j' in steps:
+        script.step('log4j', "echo -e \"" + _get_log4j_configuration(instance) + \
+                    ("\" > %s/yigo/WEB-INF/classes/log4j.properties" % (instance_path,)))
+    if 'launcher' in steps:
+        script.step('launcher', _write_launcher_command(instance))
+    if 'configs' not in steps:
+        return script.run()
+    # Files of a previous config pack must not survive in configs/
+    script.step('configs clean', "rm -rf %s/configs/*" % (instance_path,))
+    # All timeout of wget are set to 2 seconds
+    script.step('checksum download', "cd '%s' && wget -q -T 2 -O '%s' '%s'" %
+                (cache_path, checksum_filename, checksum_source,))
+    # Config packs are kept once per host in a cache named by their sha256. The first install
+    # downloads and verifies a pack under a lock, concurrent installs of the same pack wait
+    # for it, later ones only hard link it.
+    sha = "sha=$(cut -d ' ' -f 1 '%s/%s') && test -n \"$sha\"" % (cache_path, checksum_filename,)
+    configs_cache_path = _get_configs_cache_path(instance)
+    script.step('configs fetch', sha +
+                " && mkdir -p '%s' && cd '%s' && exec 9> \"$sha.lock\" && flock 9"
+                " && if [ ! -e \"$sha\" ]; then"
+                " wget -q -T 2 -O \"$sha.part\" '%s'"
+                " && echo \"$sha  $sha.part\" | sha256sum -c -"
+                " && mv \"$sha.part\" \"$sha\"; fi"
+                " && touch \"$sha\" && cd - > /dev/null"
+                " && (ln -f '%s/'\"$sha\" '%s/%s' || cp -f '%s/'\"$sha\" '%s/%s')" %
+                (configs_cache_path, configs_cache_path, configs_source,
+                 configs_cache_path, cache_path, configs_filename,
+                 configs_cache_path, cache_path, configs_filename,))
+    script.step('configs extract', "cd '%s' && tar -xf '%s' -C '../configs'" % (cache_path, configs_filename,))
+    script.step('configs install', "cd '%s' && test -e  ../configs/_yigo && cp -a ../configs/_yigo/* ../yigo/" %
+                (cache_path,))
+    # Drop least recently used packs above the size limit, skipped while another install evicts
+    script.step('configs cache evict', sha +
+                " && cd '%s' && exec 8> .evict.lock && flock -n 8"
+                " && packs=$(ls -1tr | grep -E '^[0-9a-f]{64}$') && total=0"
+                " && for f in $packs; do total=$((total + $(stat -c %%s \"$f\"))); done"
+                " && for f in $packs; do [ $total -le %s ] && break; [ \"$f\" = \"$sha\" ] && continue;"
+                " size=$(stat -c %%s \"$f\"); flock -n \"$f.lock\" rm -f \"$f\" && total=$((total - size)); done" %
+                (configs_cache_path, settings.MC_CONFIGS_CACHE_MAX_BYTES,), check=False)
+    return script.run()
 
 def _get_pid_filename(instance):
     return '%s/tmp/pid' % (_get_instance_path(instance),)
 
+def _get_log_filename(instance):
+    return '%s/logs/nohup.out' % (_get_instance_path(instance),)
+
 
-def is_yigo_instance_running(instance):
+def read_yigo_log(instance, offset, max_bytes):
     """
-    Test whether instance is running.
+    Read at most `max_bytes' of the instance log from byte `offset' on, in one
+    remote command. `tail -c +N' seeks to the offset, so the size of the log does
+    not matter. A chunk cut short by `max_bytes' ends after its last full line.
+
+    Parameters
+    ----------
+    instance : mc.models.YigoInstance
+    offset : where to start, `None' for the last `max_bytes' (from a line start).
+             An offset beyond the end of the log, e.g. after the log was truncated
+             by a restart, starts over at 0.
+    max_bytes : int
+
+    Returns
+    -------
+    dict of 'data', its 'offset', the 'next_offset' to read from, the log 'size'
+    """
+    from_end = offset is None
+    output = run("f='%s'; size=$(stat -c %%s \"$f\" 2>/dev/null || echo 0); off=%s;"
+                 " [ $off -lt 0 ] && off=$(( size > %s ? size - %s : 0 ));"
+                 " [ $off -gt $size ] && off=0;"
+                 " echo \"$size $off\";"
+                 " [ $off -lt $size ] && tail -c +$((off + 1)) \"$f\" | head -c %s | base64 -w 0; echo" %
+                 (_get_log_filename(instance), -1 if from_end else int(offset),
+                  max_bytes, max_bytes, max_bytes,), quiet=True, pty=False)
+    lines = output.splitlines()
+    size, offset = [int(x) for x in lines[0].split()]
+    data = base64.b64decode(lines[1].strip()) if len(lines) > 1 else ''
+    if from_end and offset > 0 and '\n' in data:
+        # Tailing from the end, drop the partial first line
+        skipped = data.index('\n') + 1
+        data = data[skipped:]
+        offset += skipped
+    if len(data) == max_bytes and offset + len(data) < size and '\n' in data:
+        data = data[:data.rindex('\n') + 1]
+    return {'data': data.decode('utf-8', 'replace'), 'offset': offset,
+            'next_offset': offset + len(data), 'size': size}
+
+
+def is_yigo_instance_running(instance, context=None):
+    """
+    Test whether instance is running, once per operation `context'.
 
     Paratmers
     ---------
     instance : mc.models.YigoInstance
+    context : mc.context.OperationContext of the operation, if any
     """
+    return (context or OperationContext()).fact('running', instance, _is_yigo_instance_running)
+
+def _is_yigo_instance_running(instance):
     instance_code = instance.external_id
     pid_filename = _get_pid_filename(instance)
-    return run("test -e '%s' && ps -f -p $(<'%s') | grep 'yigo.instance=%s'" %
-               (pid_filename, pid_filename, instance_code,), quiet=True).succeeded
+    launcher_filename = _get_launcher_filename(instance)
+    # Instances installed before launchers were are looked up directly
+    return run("if [ -e '%s' ]; then '%s' status;"
+               " else test -e '%s' && ps -f -p $(<'%s') | grep 'yigo.instance=%s'; fi" %
+               (launcher_filename, launcher_filename, pid_filename, pid_filename, instance_code,),
+               quiet=True).succeeded
 
 
-def start_yigo_instance(instance):
+def probe_yigo_instances(plan):
     """
-    Start JVM to run yigo instance.
+    Test whether the planned instances of the current host are running, with one
+    remote command reading all pid files under root path and running `ps' once.
 
     Parameters
     ----------
-    instance : mc.models.YigoInstance
+    plan : dict of host string to list of mc.models.YigoInstance
+
+    Returns
+    -------
+    dict of instance pk to bool
+    """
+    instances = plan[env.host_string]
+    output = run("cd '%s' && for f in */tmp/pid; do test -e \"$f\" && echo \"${f%%%%/*} $(<\"$f\")\"; done; "
+                 "echo ===; ps -ww -eo pid=,args= | grep '[y]igo.instance='" %
+                 (instances[0].yigo_host.root_path,), quiet=True)
+    pids = {}
+    processes = {}
+    current = pids
+    for line in output.splitlines():
+        fields = line.strip().split(None, 1)
+        if fields == ['===']:
+            current = processes
+        elif len(fields) == 2:
+            current[fields[0]] = fields[1]
+    result = {}
+    for instance in instances:
+        pid = pids.get(str(instance.id))
+        args = processes.get(pid, '').split()
+        result[instance.pk] = '-Dyigo.instance=%s' % (instance.external_id,) in args
+    return result
+
+
+LAUNCHER_VERSION = 2
+
+# Launcher of an instance, `bin/yigo' in the instance directory with its settings in
+# `bin/yigo.env' (see `_get_launcher_files'). Class data sharing (CLASS_DATA set):
+#   archive   the archive of the envs on this host is used (-Xshare:auto, a stale one
+#             is ignored by the JVM)
+#   training  there is no class list yet, the JVM records the classes it loads and the
+#             list is complete when it stops, one instance per host trains at a time:
+#             the claim holds the pid of the training JVM and is taken over with its
+#             partial list once that JVM is gone, e.g. killed or crashed
+#   off       another instance is training, or dumping the archive failed once (remove
+#             the .failed file to try again)
+# The archive is dumped from the class list by the first start after training, under a
+# lock, so concurrent starts wait for it.
+_LAUNCHER = r'''
+# Usage: yigo start [ready timeout] [ready line] | yigo stop [signal] | yigo status
+cd "$(dirname "$0")/.." || exit 1
+. bin/yigo.env
+CLASSPATH='yigo/WEB-INF/classes:yigo/WEB-INF/lib/*:yigo/WEB-INF/lib/@deprecated/*:yigo/WEB-INF/lib/@deprecated/jetty/*'
+
+running() {
+  [ -e tmp/pid ] && ps -f -p "$(<tmp/pid)" | grep -q "yigo.instance=$INSTANCE"
+}
+
+alive() {
+  # Not a zombie, a JVM killed may be left unreaped
+  ps -o stat= -p "$1" 2> /dev/null | grep -qv '^Z'
+}
+
+claim_training() {
+  # Under the class data lock: the training claim holds the pid of its JVM, or of the
+  # launcher until the JVM is launched
+  if [ -d "$CLASS_DATA.training" ]; then
+    owner=$(cat "$CLASS_DATA.training/pid" 2> /dev/null)
+    [ -n "$owner" ] && alive "$owner" && return 1
+    rm -rf "$CLASS_DATA.training" "$CLASS_DATA.classlist.part"
+  fi
+  mkdir "$CLASS_DATA.training" && echo $$ > "$CLASS_DATA.training/pid"
+}
+
+start() {
+  running && { echo "$INSTANCE is running" >&2; exit 3; }
+  rm -f tmp/cds-training
+  mode=off; share=
+  if [ -n "$CLASS_DATA" ]; then
+    mkdir -p "${CLASS_DATA%/*}"
+    if [ ! -e "$CLASS_DATA.jsa" -a -e "$CLASS_DATA.classlist" -a ! -e "$CLASS_DATA.failed" ]; then
+      (flock 9 && { [ -e "$CLASS_DATA.jsa" ] ||
+        { "$JAVA" $JVM_OPTIONS -Xshare:dump -XX:SharedClassListFile="$CLASS_DATA.classlist" \
+            -XX:SharedArchiveFile="$CLASS_DATA.jsa.part" -cp "$CLASSPATH" >& logs/cds-dump.out < /dev/null &&
+          mv "$CLASS_DATA.jsa.part" "$CLASS_DATA.jsa" || touch "$CLASS_DATA.failed"; }; }) 9> "$CLASS_DATA.lock"
+    fi
+    if [ -e "$CLASS_DATA.jsa" ]; then
+      mode=archive; share="-Xshare:auto -XX:SharedArchiveFile=$CLASS_DATA.jsa"
+    elif [ ! -e "$CLASS_DATA.classlist" -a ! -e "$CLASS_DATA.failed" ] &&
+         (flock 9 && claim_training) 9> "$CLASS_DATA.lock"; then
+      mode=training; share="-XX:DumpLoadedClassList=$CLASS_DATA.classlist.part"; echo "$CLASS_DATA" > tmp/cds-training
+    fi
+  fi
+  echo "@@cds $mode"
+  t0=$(date +%s%N)
+  nohup "$JAVA" $JVM_OPTIONS $share -Xms${HEAP_MB}m -Xmx${HEAP_MB}m -cp "$CLASSPATH" \
+    -Dserver.cloudregisterserver=http://1.1.8.16:8080/yigo \
+    -Dserver.config=configs/main \
+    -Dserver.generateYigoCss=false \
+    -Dserver.dsn.description=default \
+    -Dserver.dsn.default=Y \
+    -Dserver.dsn.dbtype=3 \
+    -Dserver.dsn.name=default \
+    -Dserver.db.default.conntype=jdbc \
+    -Dserver.db.default.dbtype=3 \
+    -Dserver.db.default.driver=com.mysql.jdbc.Driver \
+    "-Dserver.db.default.url=$DB_URL" \
+    "-Dserver.db.default.user=$DB_USER" \
+    "-Dserver.db.default.pass=$DB_PASSWORD" \
+    -DCODEBASE_SERVICE=yigo \
+    -DAPP_SERVICE=yigo \
+    -DAPP_SERVER=localhost:$SERVICE_PORT \
+    -Dyigo.home=yigo \
+    "-Dyigo.instance=$INSTANCE" \
+    -Djava.io.tmpdir=tmp \
+    test.start.StartHttpServer yigo 'core@cloud' >& logs/nohup.out < /dev/null &
+  pid=$!
+  echo $pid > tmp/pid
+  [ $mode = training ] && echo $pid > "$CLASS_DATA.training/pid"
+  if [ "${1:-0}" -gt 0 ]; then
+    # Poll the log until the ready line shows up or the JVM exits
+    for i in $(seq $(($1 * 5))); do
+      grep -qF -- "$2" logs/nohup.out && { echo "@@ready $(( ($(date +%s%N) - t0) / 1000000 ))"; break; }
+      kill -0 $pid 2> /dev/null || break
+      sleep 0.2
+    done
+  else
+    # Wait the command starting up before the ssh connection is closed
+    sleep 1
+  fi
+}
+
+stop() {
+  running || return 0
+  pid=$(<tmp/pid)
+  kill -s "${1:-TERM}" $pid && rm tmp/pid || exit 1
+  if [ -e tmp/cds-training ]; then
+    # A training JVM writes its class list as it exits, it is then the class list of the host
+    cds=$(<tmp/cds-training)
+    for i in $(seq 50); do kill -0 $pid 2> /dev/null || break; sleep 0.2; done
+    # Unless another instance took the claim over meanwhile
+    (flock 9 && [ "$(cat "$cds.training/pid" 2> /dev/null)" = $pid ] &&
+      { mv "$cds.classlist.part" "$cds.classlist" 2> /dev/null; rm -rf "$cds.training"; }) 9> "$cds.lock"
+    rm tmp/cds-training
+  fi
+}
+
+case "$1" in
+  start) shift; start "$@" ;;
+  stop) shift; stop "$@" ;;
+  status) running ;;
+  *) echo "usage: $0 start [ready timeout] [ready line] | stop [signal] | status" >&2; exit 2 ;;
+esac
+'''
+
+def _get_launcher_filename(instance):
+    return '%s/bin/yigo' % (_get_instance_path(instance),)
+
+def _get_launcher_files(instance):
+    """
+    Contents of the launcher and of its environment file of `instance', with the
+    options of its JVM profile (`instance.jvm_profile', the default profile if it
+    has none).
+    """
+    from mc.models import JvmProfile
+    profile = getattr(instance, 'jvm_profile', None) or JvmProfile()
+    java_home = instance.java_env.path
+    if java_home[-1] != '/':
+        java_home = java_home + '/'
+    values = (
+        ('JAVA', java_home + 'bin/java'),
+        ('JVM_OPTIONS', profile.options),
+        ('HEAP_MB', instance.yigo_host.heap_size),
+        # Shared by the instances of the envs on the host, see `_LAUNCHER'
+        ('CLASS_DATA', '../.cds/%s-%s' % (instance.yigo_env.version, instance.java_env.version,)
+                       if profile.class_data_sharing else ''),
+        ('INSTANCE', instance.external_id),
+        ('SERVICE_PORT', instance.service_port),
+        ('DB_URL', 'jdbc:mysql://%s:%s/%s?useUnicode=true&amp;characterEncoding=UTF-8' %
+                   (instance.database_host.address, instance.database_host.port, instance.database_name(),)),
+        ('DB_USER', instance.database_user()),
+        ('DB_PASSWORD', instance.database_password),
+    )
+    launcher = '#!/bin/bash\n# Launcher of yigo instance %s, version %s, written by mc at install\n' % \
+               (instance.id, LAUNCHER_VERSION,) + _LAUNCHER
+    environment = ''.join(['%s=%s\n' % (name, _quote(unicode(value)),) for name, value in values])
+    return launcher, environment
+
+def _write_launcher_command(instance):
+    launcher, environment = _get_launcher_files(instance)
+    # Written aside and renamed, a running launcher keeps reading the old one. Instances
+    # installed before launchers have no bin/ yet
+    return ("mkdir -p '%s/bin' && cd '%s/bin' && printf '%%s' %s > yigo.part && (umask 077 && printf '%%s' %s > yigo.env.part)"
+            " && chmod 755 yigo.part && mv yigo.env.part yigo.env && mv yigo.part yigo" %
+            (_get_instance_path(instance), _get_instance_path(instance), _quote(launcher), _quote(environment),))
+
+def _launcher_command(instance, args, progress=None):
     """
-    if is_yigo_instance_running(instance):
+    Shell command running the launcher of `instance' with `args', which writes the
+    launcher first if the fingerprint in the journal of the instance (loaded by the
+    caller into `instance.install_journal') is not the one of its current contents,
+    e.g. after the JVM profile changed. The new fingerprint is put in `progress'.
+    """
+    command = "'%s' %s" % (_get_launcher_filename(instance), args,)
+    fingerprint = _get_launcher_fingerprint(instance)
+    if getattr(instance, 'install_journal', {}).get('launcher') == fingerprint:
+        return command
+    if progress is not None:
+        progress.setdefault('journal', {})['launcher'] = fingerprint
+    return '(' + _write_launcher_command(instance) + ') && ' + command
+
+def start_yigo_instance(instance, context=None, progress=None):
+    """
+    Start JVM to run yigo instance, with one call of its launcher.
+
+    When MC_START_READY_TIMEOUT is set the JVM is waited for until it logs
+    MC_START_READY_LINE, at most that many seconds, and the time it took is
+    reported in the result, the 'jvm ready' event and `mc_instance_ready_seconds'.
+
+    Parameters
+    ----------
+    instance : mc.models.YigoInstance, with `jvm_profile' and `install_journal'
+               (see `_launcher_command')
+    context : mc.context.OperationContext of the operation, if any
+    progress : dict receiving journal changes, if the launcher is rewritten
+
+    Returns
+    -------
+    dict of 'ready_seconds' (`None' if not waited for or not ready in time) and
+    the 'class_data_sharing' mode, see `_LAUNCHER'
+    """
+    context = context or OperationContext()
+    if is_yigo_instance_running(instance, context):
         raise InstanceIsRunning()
     else:
-        instane_code = instance.external_id
-        # Find java command
-        java_home = instance.java_env.path
-        if java_home[-1] != '/':
-            java_home = java_home + '/'
-        java_exec = java_home + 'bin/java'
-        # Process command arguments
-        args = [java_exec, '-server']
-        # Memory
-        args.append('-Xms%sm' % (instance.yigo_host.heap_size,))
-        args.append('-Xmx%sm' % (instance.yigo_host.heap_size,))
-        args.append('-XX:MaxPermSize=128m')
-        # Classpath
-        args.append('-cp')
-        args.append('"yigo/WEB-INF/classes:yigo/WEB-INF/lib/*:yigo/WEB-INF/lib/@deprecated/*:yigo/WEB-INF/lib/@deprecated/jetty/*"')
-        # Yigo properties
-        args.append('-Dserver.cloudregisterserver=http://1.1.8.16:8080/yigo')
-        args.append('-Dserver.config=configs/main')
-        args.append('-Dserver.generateYigoCss=false')
-        args.append('-Dserver.dsn.description=default')
-        args.append('-Dserver.dsn.default=Y')
-        args.append('-Dserver.dsn.dbtype=3')
-        args.append('-Dserver.dsn.name=default')
-        args.append('-Dserver.db.default.conntype=jdbc')
-        args.append('-Dserver.db.default.dbtype=3')
-        args.append('-Dserver.db.default.driver=com.mysql.jdbc.Driver')
-        args.append('\'-Dserver.db.default.url=jdbc:mysql://%s:%s/%s?useUnicode=true&amp;characterEncoding=UTF-8\'' %
-                    (instance.database_host.address, instance.database_host.port, instance.database_name(),))
-        args.append('-Dserver.db.default.user=%s' % (instance.database_user(),))
-        args.append('-Dserver.db.default.pass=%s' % (instance.database_password,))
-        args.append('-DCODEBASE_SERVICE=yigo')
-        args.append('-DAPP_SERVICE=yigo')
-        args.append('-DAPP_SERVER=localhost:%s' % (instance.service_port,))
-        # Instance properties
-        args.append('-Dyigo.home=yigo')
-        args.append('-Dyigo.instance=%s' % (instance.external_id,))
-        args.append('-Djava.io.tmpdir=tmp')
-        # Main class
-        args.append('test.start.StartHttpServer')
-        # Arguments of main class
-        args.append('yigo') # yigo install dir
-        args.append('\'core@cloud\'') # empty core.properties
-
-        cmd = ' '.join(args)
-        with cd(_get_instance_path(instance)):
-            # Use `sleep 1` to wait the command starting up before fabric closes the ssh connection
-            run('$(nohup ' + cmd + ' >& logs/nohup.out < /dev/null & echo $! > tmp/pid) && sleep 1')
-
-
-def stop_yigo_instance(instance, force=False):
+        output = run(_launcher_command(instance, 'start %d %s' % (settings.MC_START_READY_TIMEOUT,
+                                                                  _quote(settings.MC_START_READY_LINE),),
+                                       progress))
+        reported = dict(line[2:].split(None, 1) for line in output.splitlines() if line.startswith('@@') and ' ' in line)
+        result = {'ready_seconds': int(reported['ready']) / 1000.0 if 'ready' in reported else None,
+                  'class_data_sharing': reported.get('cds', 'off').strip()}
+        context.record('running', instance, True)
+        emit(instance.pk, 'jvm launched', class_data_sharing=result['class_data_sharing'])
+        if result['ready_seconds'] is not None:
+            emit(instance.pk, 'jvm ready', seconds=result['ready_seconds'])
+            observe('mc_instance_ready_seconds', result['ready_seconds'], yigo_env=instance.yigo_env.version,
+                    java_env=instance.java_env.version, class_data_sharing=result['class_data_sharing'])
+        return result
+
+
+def stop_yigo_instance(instance, force=False, context=None, progress=None):
+    context = context or OperationContext()
     signal = 'TERM'
     if force: signal = 'KILL'
-    pid_filename = _get_pid_filename(instance)
-    if is_yigo_instance_running(instance):
-        run("kill -s %s $(<'%s') && rm '%s'" % (signal, pid_filename, pid_filename))
+    if is_yigo_instance_running(instance, context):
+        run(_launcher_command(instance, 'stop %s' % (signal,), progress))
+        context.record('running', instance, False)
+        emit(instance.pk, 'jvm stopped', signal=signal)
+
+
+def _get_configs_checksum(instance):
+    output = run("wget -q -T 2 -O - '%s.sha256sum'" % (instance.configs_source,), quiet=True)
+    return (output.split() or [''])[0]
+
+def _fingerprint(*values):
+    return hashlib.sha1('\0'.join([unicode(v).encode('utf-8') for v in values])).hexdigest()
+
+def _get_launcher_fingerprint(instance):
+    return _fingerprint(*_get_launcher_files(instance))
+
+def get_install_fingerprints(instance, configs_checksum):
+    """Digests of the inputs of every install step, a step is redone when its digest changes."""
+    database_host = instance.database_host
+    return {
+        'database': _fingerprint(database_host.address, database_host.port, instance.database_name(),
+                                 instance.database_user(), instance.database_password),
+        'release': _fingerprint(instance.yigo_host.root_path, instance.yigo_env.version),
+        'log4j': _fingerprint(_get_log4j_configuration(instance)),
+        'configs': _fingerprint(instance.configs_source, configs_checksum),
+        'launcher': _get_launcher_fingerprint(instance),
+    }
+
+
+def install_yigo_instance(instance, journal, progress, context=None):
+    """
+    Install database and yigo instance, redoing only the steps which never finished
+    or whose inputs changed since. A new release invalidates everything unpacked
+    into the instance directory, so all yigo steps are redone then. A running
+    instance is never changed, `InstanceIsRunning' is raised instead.
+
+    Parameters
+    ----------
+    instance : mc.models.YigoInstance
+    journal : dict of finished step to the fingerprint it was done with
+    progress : dict receiving model flags and, under 'journal', journal changes as
+               steps finish, so it is up to date when a step fails
+    context : mc.context.OperationContext of the operation, if any
+
+    Returns
+    -------
+    list of redone steps
+    """
+    context = context or OperationContext()
+    if is_yigo_instance_running(instance, context):
+        raise InstanceIsRunning()
+    fingerprints = get_install_fingerprints(instance, _get_configs_checksum(instance))
+    redo = [step for step in DATABASE_STEPS + YIGO_STEPS if journal.get(step) != fingerprints[step]]
+    if 'release' in redo:
+        redo = [step for step in redo if step not in YIGO_STEPS] + list(YIGO_STEPS)
+    changes = progress.setdefault('journal', {})
+
+    if 'database' in redo:
+        delete_mysql_instance(instance, context)
+        progress['database_installed'] = False
+        changes['database'] = None
+        create_mysql_instance(instance)
+        progress['database_installed'] = True
+        changes['database'] = fingerprints['database']
+
+    yigo_steps = [step for step in YIGO_STEPS if step in redo]
+    if yigo_steps:
+        if 'release' in yigo_steps:
+            delete_yigo_instance(instance, context)
+        progress['installed'] = False
+        for step in yigo_steps:
+            changes[step] = None
+        create_yigo_instance(instance, yigo_steps)
+        for step in yigo_steps:
+            changes[step] = fingerprints[step]
+        progress['installed'] = True
+    return redo
+
+
+def uninstall_yigo_instance(instance, progress, context=None):
+    """
+    Delete yigo instance and its database, the parts flagged installed.
+
+    Parameters
+    ----------
+    instance : mc.models.YigoInstance
+    progress : dict receiving model flags and, under 'journal', the steps to forget
+    context : mc.context.OperationContext of the operation, if any
+    """
+    context = context or OperationContext()
+    journal = progress.setdefault('journal', {})
+    if instance.installed:
+        delete_yigo_instance(instance, context)
+        progress['installed'] = False
+        journal.update(dict.fromkeys(YIGO_STEPS))
+    if instance.database_installed:
+        delete_mysql_instance(instance, context)
+        progress['database_installed'] = False
+        journal.update(dict.fromkeys(DATABASE_STEPS))
+
+
+def _stop_and_uninstall(instance, progress, context):
+    stop_yigo_instance(instance, context=context, progress=progress)
+    uninstall_yigo_instance(instance, progress, context)
+
+
+_BATCH_OPERATIONS = {
+    'install': lambda instance, flags, context: install_yigo_instance(instance, instance.install_journal,
+                                                                      flags, context),
+    'start': lambda instance, flags, context: start_yigo_instance(instance, context, flags),
+    'stop': lambda instance, flags, context: stop_yigo_instance(instance, context=context, progress=flags),
+    'uninstall': uninstall_yigo_instance,
+    'stop_uninstall': _stop_and_uninstall,
+}
+
+def run_batch(operation, plan):
+    """
+    Run `operation' on the instances planned for the current host, one after another.
+    A failing instance does not stop the others, the end of every instance is
+    emitted as it happens. The running states of all instances are probed up
+    front with one remote command.
+
+    Parameters
+    ----------
+    operation : one of 'install', 'start', 'stop', 'uninstall', 'stop_uninstall'
+    plan : dict of host string to list of mc.models.YigoInstance
+
+    Returns
+    -------
+    list of (pk, result, error class name, error message, progress as reported by the task)
+    """
+    results = []
+    context = OperationContext(probe_yigo_instances(plan))
+    for instance in plan[env.host_string]:
+        flags = {}
+        try:
+            result = _BATCH_OPERATIONS[operation](instance, flags, context)
+        except Exception, e:
+            results.append((instance.pk, None, e.__class__.__name__, unicode(e), flags))
+            emit(instance.pk, 'failed', operation=operation, error=e.__class__.__name__, message=unicode(e))
+        else:
+            results.append((instance.pk, result, None, None, flags))
+            emit(instance.pk, 'finished', operation=operation)
+    return results
 
 
 
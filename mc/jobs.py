@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import socket
+import sys
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from mc.exceptions import InstanceIsBusy
+from mc.models import *
+from mc.manager import Manager, JOB_METHODS, BATCH_JOB_METHODS
+
+
+def get_worker_name(index=0):
+    return '%s:%s:%s' % (socket.gethostname(), os.getpid(), index,)
+
+
+def _expires():
+    return timezone.now() + timedelta(seconds=settings.MC_JOB_TTL)
+
+
+class _Heartbeat(threading.Thread):
+    """Renews the claim of a running job until stopped, so it outlives long
+    operations but not its worker (see `fail_lost_jobs')."""
+
+    def __init__(self, job):
+        threading.Thread.__init__(self, name='mc-job-heartbeat')
+        self.daemon = True
+        self.job = job
+        self.stopped = threading.Event()
+
+    def run(self):
+        try:
+            while not self.stopped.wait(settings.MC_JOB_TTL / 3.0):
+                self.job.__class__.objects.filter(pk=self.job.pk, state=JOB_RUNNING).update(expires=_expires())
+        finally:
+            connection.close()
+
+
+@contextmanager
+def _heartbeat(job):
+    heartbeat = _Heartbeat(job)
+    heartbeat.start()
+    try:
+        yield
+    finally:
+        heartbeat.stopped.set()
+        heartbeat.join()
+
+
+def fail_lost_jobs():
+    """Fail running jobs and batch jobs whose claim expired, their worker died. They
+    are not run again as the operation may have been done in part; the leases of
+    their instances expire the same way (see mc.locks)."""
+    for model in (Job, BatchJob):
+        model.objects.filter(state=JOB_RUNNING, expires__lt=timezone.now()) \
+                     .update(state=JOB_FAILED, error='WorkerLost', message='worker stopped renewing the job',
+                             finished=timezone.now())
+
+
+def claim_job(worker, scan=20):
+    """Move the oldest runnable pending job to running and return it, or `None'.
+
+    Jobs of one instance run one after another in submission order: a job is only
+    runnable when no older job of its instance is pending or running, and nobody
+    holds or waits for a lease on the instance. Jobs of lost workers are failed
+    first, so they do not hold up the jobs after them.
+    """
+    fail_lost_jobs()
+    candidates = Job.objects.filter(state=JOB_PENDING) \
+                            .exclude(instance__lease_set__expires__gt=timezone.now()).order_by('pk')[:scan]
+    for job in candidates:
+        if Job.objects.filter(instance=job.instance_id, state__in=(JOB_PENDING, JOB_RUNNING),
+                              pk__lt=job.pk).exists():
+            continue
+        if Job.objects.filter(pk=job.pk, state=JOB_PENDING) \
+                      .update(state=JOB_RUNNING, worker=worker, started=timezone.now(), expires=_expires()):
+            return Job.objects.get(pk=job.pk)
+    return None
+
+
+def run_job(job, manager=None):
+    """Run the manager method of a claimed job and record how it ended."""
+    manager = manager or Manager()
+    try:
+        with _heartbeat(job):
+            result = getattr(manager, job.method)(job.instance_id, lock_timeout=settings.MC_JOB_LEASE_WAIT)
+    except InstanceIsBusy:
+        # Someone outside the queue holds the instance, wait for it in the queue
+        Job.objects.filter(pk=job.pk).update(state=JOB_PENDING, worker='', started=None)
+        return
+    except Exception, e:
+        traceback.print_exc(file=sys.stderr)
+        Job.objects.filter(pk=job.pk).update(state=JOB_FAILED, error=e.__class__.__name__,
+                                             message=unicode(e), finished=timezone.now())
+    else:
+        Job.objects.filter(pk=job.pk).update(state=JOB_SUCCEEDED, result=json.dumps(result),
+                                             finished=timezone.now())
+
+
+def claim_batch_job(worker):
+    """Move the oldest pending batch job to running and return it, or `None'.
+
+    Batch jobs do not wait for the jobs of their instances, an instance leased
+    meanwhile is reported busy in the result of the batch job. Batch jobs of lost
+    workers are failed as in `claim_job'.
+    """
+    fail_lost_jobs()
+    for job in BatchJob.objects.filter(state=JOB_PENDING).order_by('pk')[:5]:
+        if BatchJob.objects.filter(pk=job.pk, state=JOB_PENDING) \
+                           .update(state=JOB_RUNNING, worker=worker, started=timezone.now(), expires=_expires()):
+            return BatchJob.objects.get(pk=job.pk)
+    return None
+
+
+def run_batch_job(job, manager=None):
+    """Run the manager batch method of a claimed batch job and record its results."""
+    manager = manager or Manager()
+    pks = list(job.instances.order_by('pk').values_list('pk', flat=True))
+    options = dict((str(k), v) for k, v in json.loads(job.options or '{}').items())
+    try:
+        if job.method not in BATCH_JOB_METHODS:
+            raise ValueError('Cannot run method %s' % (job.method,))
+        with _heartbeat(job):
+            results = getattr(manager, job.method)(pks, **options)
+    except Exception, e:
+        traceback.print_exc(file=sys.stderr)
+        BatchJob.objects.filter(pk=job.pk).update(state=JOB_FAILED, error=e.__class__.__name__,
+                                                  message=unicode(e), finished=timezone.now())
+    else:
+        BatchJob.objects.filter(pk=job.pk).update(state=JOB_SUCCEEDED, result=json.dumps(results),
+                                                  finished=timezone.now())
+
+
+def work(worker, poll_interval=1.0, max_jobs=None):
+    """Claim and run jobs, batch jobs when no other job is runnable, until `max_jobs'
+    jobs are done, forever if it is `None'."""
+    connection.close()                                  # never share a connection with the parent
+    manager = Manager()
+    done = 0
+    while max_jobs is None or done < max_jobs:
+        job = claim_job(worker)
+        if job is None:
+            batch_job = claim_batch_job(worker)
+            if batch_job is None:
+                time.sleep(poll_interval)
+                continue
+            run_batch_job(batch_job, manager)
+        elif job.method in JOB_METHODS:
+            run_job(job, manager)
+        else:
+            Job.objects.filter(pk=job.pk).update(state=JOB_FAILED, error='NoSuchMethod',
+                                                 message=job.method, finished=timezone.now())
+        done += 1
+
+
+# Local Variables: **
+# comment-column: 56 **
+# indent-tabs-mode: nil **
+# python-indent: 4 **
+# End: **
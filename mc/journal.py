@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+
+from django.utils import timezone
+
+from mc.models import YigoInstance, InstallStep
+
+
+DATABASE_STEPS = ('database',)
+YIGO_STEPS = ('release', 'log4j', 'configs', 'launcher',)
+
+
+def load_journal(instance):
+    """Fingerprints of the finished install steps of `instance', as a dict of step to
+    fingerprint. Steps of a part which is not flagged installed are left out."""
+    steps = []
+    if instance.database_installed:
+        steps.extend(DATABASE_STEPS)
+    if instance.installed:
+        steps.extend(YIGO_STEPS)
+    return dict(instance.install_step_set.filter(step__in=steps).values_list('step', 'fingerprint'))
+
+
+def apply_progress(pk, progress):
+    """Save what a fabtask reported in `progress': model flags, and under 'journal' a
+    dict of step to fingerprint of the finished steps, or to `None' for undone ones."""
+    flags = dict((k, v) for k, v in progress.items() if k != 'journal')
+    if flags:
+        YigoInstance.objects.filter(pk=pk).update(**flags)
+    for step, fingerprint in progress.get('journal', {}).items():
+        if fingerprint is None:
+            InstallStep.objects.filter(instance=pk, step=step).delete()
+        elif not InstallStep.objects.filter(instance=pk, step=step).update(fingerprint=fingerprint,
+                                                                                 finished=timezone.now()):
+            InstallStep.objects.create(instance_id=pk, step=step, fingerprint=fingerprint)
+
+
+def forget(pk, steps):
+    InstallStep.objects.filter(instance=pk, step__in=steps).delete()
+
+
+# Local Variables: **
+# comment-column: 56 **
+# indent-tabs-mode: nil **
+# python-indent: 4 **
+# End: **
@@ -8,42 +8,101 @@
 # did not, you can find it at http://www.gnu.org/
 #
 
+import sys
 import json
-from django.http import HttpResponse
+import hashlib
+import threading
+import time
+import traceback
+from inspect import getargspec
+from multiprocessing.pool import ThreadPool
+from django.http import HttpResponse, HttpResponseNotModified
 from django.conf import settings as django_settings
+from django.db import close_old_connections
+
+# JSON-RPC 2.0 error codes, -32000 to -32099 are left for the errors of the served methods
+PARSE_ERROR      = -32700
+INVALID_REQUEST  = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS   = -32602
+INTERNAL_ERROR   = -32603
 
 class publicmethod(object):
 
     def __init__(self, method):
         self.method = method
         self.__public__ = True
+        # Inspected once here, not on every SMD request
+        inner = method
+        while hasattr(inner, 'method'):
+            inner = inner.method
+        spec = getargspec(inner)
+        self.args = [ a for a in spec.args if a != "self" ]
+        self.required = self.args[:len(self.args) - len(spec.defaults or ())]
+
+    def check_params(self, params):
+        """Whether JSON-RPC `params' (by position or by name) fit the arguments."""
+        if isinstance(params, dict):
+            return set(self.required) <= set(params) <= set(self.args)
+        return len(self.required) <= len(params) <= len(self.args)
 
     def __call__(self, *args, **kwargs):
         return self.method(*args, **kwargs)
 
     def get_args(self):
-        from inspect import getargspec
-        method = self.method
-        while hasattr(method, 'method'):
-            method = method.method
-        return [ a for a in getargspec(method).args if a != "self" ]
+        return self.args
+
+
+# Public methods of every class served, name -> publicmethod, see `get_registry'
+_registries = {}
+# Serialized SMD and its ETag, by (class, url, report_methods)
+_smds = {}
+
+def get_registry(cls):
+    """Public methods of class `cls', looked up once per class."""
+    registry = _registries.get(cls)
+    if registry is None:
+        registry = {}
+        for name in dir(cls):
+            attr = getattr(cls, name)
+            if isinstance(attr, publicmethod) and attr.__public__ == True:
+                registry[name] = attr
+        _registries[cls] = registry
+    return registry
 
 
 class JsonRpc(object):
+    """
+    Serves the public methods of `instance' over JSON-RPC.
 
-    def __init__(self, instance, allow_errors=True, report_methods=True):
+    Requests with "jsonrpc": "2.0" get JSON-RPC 2.0 handling, including batches
+    and notifications, others the JSON-RPC 1.0 handling. `error_codes' is a
+    sequence of (exception class, code) giving the error codes of 2.0 errors,
+    the first matching class wins. The calls of a batch run concurrently on at
+    most `batch_workers' threads, one after another with a custom `dispatch' of the
+    instance. `observer' is called with the method name, the seconds taken and the
+    exception raised or `None' after every call of a served method.
+    """
+
+    def __init__(self, instance, allow_errors=True, report_methods=True, error_codes=(), batch_workers=1,
+                 observer=None):
         self.instance = instance
         self.allow_errors = allow_errors
         self.report_methods = report_methods
+        self.observer = observer
+        self.error_codes = error_codes
+        self.batch_workers = batch_workers
+        self.pool = None
+        self.pool_lock = threading.Lock()
         if not hasattr(self.instance, "url"):
             raise Exception("'url' not present in supplied instance")
+        self.registry = get_registry(type(instance))
+        self.custom_dispatch = getattr(instance, "dispatch", None)
+        if not callable(self.custom_dispatch):
+            self.custom_dispatch = None
 
     def get_public_methods(self):
-        return [
-            m for m in dir(self.instance) if \
-            getattr(self.instance, m).__class__.__name__ == "publicmethod" and \
-            getattr(self.instance, m).__public__ == True
-        ]
+        return sorted(self.registry)
 
     def generate_smd(self):
         smd = {
@@ -53,22 +112,119 @@ class JsonRpc(object):
         }
         if self.report_methods:
             smd["methods"] = [
-                {"name": method, "parameters": getattr(self.instance, method).get_args()} \
+                {"name": method, "parameters": self.registry[method].get_args()} \
                 for method in self.get_public_methods()
             ]
         return json.dumps(smd)
 
+    def get_smd(self):
+        """The SMD serialized once, and its ETag."""
+        key = (type(self.instance), self.instance.url, self.report_methods)
+        if key not in _smds:
+            smd = self.generate_smd()
+            _smds[key] = (smd, '"%s"' % (hashlib.sha1(smd).hexdigest(),))
+        return _smds[key]
+
     def dispatch(self, method, params):
-        if hasattr(self.instance, "dispatch") and \
-            callable(self.instance.dispatch):
-            return self.instance.dispatch(method, params)
-        elif method in self.get_public_methods():
-            return getattr(self.instance, method)(self.instance, *params)
-        else:
+        if self.custom_dispatch is None and method not in self.registry:
             return "no such method"
+        start = time.time()
+        try:
+            if self.custom_dispatch is not None:
+                result = self.custom_dispatch(method, params)
+            elif isinstance(params, dict):
+                result = self.registry[method](self.instance, **dict((str(k), v) for k, v in params.items()))
+            else:
+                result = self.registry[method](self.instance, *params)
+        except Exception, e:
+            if self.observer is not None:
+                self.observer(method, time.time() - start, e)
+            raise
+        if self.observer is not None:
+            self.observer(method, time.time() - start, None)
+        return result
+
+    def error(self, request_id, code, message, data=None):
+        response = {"jsonrpc": "2.0", "id": request_id, "error": {"code": code, "message": message}}
+        if data is not None:
+            response["error"]["data"] = data
+        return response
+
+    def call(self, request):
+        """Run JSON-RPC 2.0 request object `request', return its response object,
+        or `None' for a notification."""
+        if not isinstance(request, dict) or request.get("jsonrpc") != "2.0" or \
+            not isinstance(request.get("method"), basestring) or \
+            not isinstance(request.get("params", []), (list, dict)):
+            return self.error(None, INVALID_REQUEST, "Invalid Request")
+        request_id = request.get("id")
+        method = request["method"]
+        params = request.get("params", [])
+        response = None
+        if self.custom_dispatch is None and method not in self.registry:
+            response = self.error(request_id, METHOD_NOT_FOUND, "Method not found")
+        elif self.custom_dispatch is None and not self.registry[method].check_params(params):
+            response = self.error(request_id, INVALID_PARAMS, "Invalid params")
+        else:
+            try:
+                response = {"jsonrpc": "2.0", "id": request_id, "result": self.dispatch(method, params)}
+            except Exception, e:
+                traceback.print_exc(file=sys.stderr)
+                if not self.allow_errors:
+                    response = self.error(request_id, INTERNAL_ERROR, "error")
+                else:
+                    code = INTERNAL_ERROR
+                    for exc_type, exc_code in self.error_codes:
+                        if isinstance(e, exc_type):
+                            code = exc_code
+                            break
+                    response = self.error(request_id, code, unicode(e) or e.__class__.__name__,
+                                          {"type": e.__class__.__name__})
+        if "id" not in request:
+            return None
+        return response
+
+    def call_in_thread(self, request):
+        try:
+            return self.call(request)
+        finally:
+            close_old_connections()
+
+    def call_batch(self, requests):
+        """Run the request objects of a batch, return the responses in request order
+        but for notifications."""
+        if self.batch_workers > 1 and self.custom_dispatch is None and self.pool is None:
+            with self.pool_lock:
+                if self.pool is None:
+                    self.pool = ThreadPool(self.batch_workers)
+        pending = []
+        responses = [None] * len(requests)
+        if self.pool is not None:
+            for i, request in enumerate(requests):
+                pending.append((i, self.pool.apply_async(self.call_in_thread, (request,))))
+        else:
+            for i, request in enumerate(requests):
+                responses[i] = self.call(request)
+        for i, result in pending:
+            responses[i] = result.get()
+        return [response for response in responses if response is not None]
 
     def serialize(self, raw_post_data):
-        raw_request    = json.loads(raw_post_data)
+        try:
+            raw_request = json.loads(raw_post_data)
+        except ValueError:
+            return json.dumps(self.error(None, PARSE_ERROR, "Parse error"))
+        if isinstance(raw_request, list):
+            if not raw_request:
+                return json.dumps(self.error(None, INVALID_REQUEST, "Invalid Request"))
+            responses = self.call_batch(raw_request)
+            return json.dumps(responses) if responses else None
+        if not isinstance(raw_request, dict):
+            return json.dumps(self.error(None, INVALID_REQUEST, "Invalid Request"))
+        if raw_request.get("jsonrpc") == "2.0":
+            response = self.call(raw_request)
+            return json.dumps(response) if response is not None else None
+
         request_id     = raw_request.get("id", 0)
         request_method = raw_request.get("method")
         request_params = raw_request.get("params", [])
@@ -79,8 +235,6 @@ class JsonRpc(object):
             response["result"] = self.dispatch(request_method, request_params)
         except:
             if self.allow_errors:
-                import sys
-                import traceback
                 exc_type, exc_value, exc_tb = sys.exc_info()
                 print >> sys.stderr, exc_value, exc_type
                 traceback.print_tb(exc_tb)
@@ -92,9 +246,20 @@ class JsonRpc(object):
 
     def handle_request(self, request):
         response = None
+        etag = None
         if request.method == "POST" and \
             len(request.body) > 0:
             response = self.serialize(request.body)
+            if response is None:
+                # Notifications only, nothing to answer
+                return HttpResponse(status=204)
         else:
-            response = self.generate_smd()
-        return HttpResponse(response, content_type='application/json; charset=' + django_settings.DEFAULT_CHARSET)
+            response, etag = self.get_smd()
+            if request.META.get("HTTP_IF_NONE_MATCH") == etag:
+                response = HttpResponseNotModified()
+                response["ETag"] = etag
+                return response
+        response = HttpResponse(response, content_type='application/json; charset=' + django_settings.DEFAULT_CHARSET)
+        if etag:
+            response["ETag"] = etag
+        return response
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from mc.exceptions import InstanceIsBusy
+from mc.metrics import inc
+from mc.models import YigoInstance, Lease
+
+
+def get_owner_name():
+    return '%s:%s:%s' % (socket.gethostname(), os.getpid(), threading.current_thread().ident,)
+
+
+def _expires():
+    return timezone.now() + timedelta(seconds=settings.MC_LEASE_TTL)
+
+
+class _Heartbeat(threading.Thread):
+    """Renews leases until stopped, so they outlive long operations but not their worker."""
+
+    def __init__(self, leases):
+        threading.Thread.__init__(self, name='mc-lease-heartbeat')
+        self.daemon = True
+        self.leases = leases
+        self.stopped = threading.Event()
+
+    def run(self):
+        try:
+            while not self.stopped.wait(settings.MC_LEASE_TTL / 3.0):
+                Lease.objects.filter(pk__in=[lease.pk for lease in self.leases]).update(expires=_expires())
+        finally:
+            connection.close()
+
+
+class Leases(object):
+    """
+    Leases on instances held by the current worker.
+
+    A lease is a row of `Lease'. Leases of one instance are granted in the order
+    they were requested: the oldest unexpired lease is the held one, younger ones
+    wait. Held leases are renewed by a heartbeat thread, so the lease of a dead
+    worker expires after MC_LEASE_TTL seconds and is reclaimed by the next caller.
+    """
+
+    def __init__(self, owner=None):
+        self.owner = owner or get_owner_name()
+        self.leases = []
+        self._heartbeat = None
+
+    def acquire(self, pk, timeout=0):
+        """Wait at most `timeout' seconds for the lease of instance `pk', raise
+        `InstanceIsBusy' if it is not granted in time."""
+        if not YigoInstance.objects.filter(pk=pk).exists():
+            raise YigoInstance.DoesNotExist()
+        lease = Lease.objects.create(instance_id=pk, owner=self.owner, expires=_expires())
+        deadline = time.time() + timeout
+        while True:
+            Lease.objects.filter(instance=pk, expires__lt=timezone.now()).delete()
+            first = Lease.objects.filter(instance=pk).order_by('pk').values_list('pk', flat=True)[:1]
+            if first and first[0] == lease.pk:
+                break
+            if time.time() >= deadline:
+                Lease.objects.filter(pk=lease.pk).delete()
+                inc('mc_lease_busy_total')
+                raise InstanceIsBusy()
+            time.sleep(min(settings.MC_LEASE_POLL, max(deadline - time.time(), 0)))
+            Lease.objects.filter(pk=lease.pk).update(expires=_expires())
+        Lease.objects.filter(pk=lease.pk).update(held=True, expires=_expires())
+        YigoInstance.objects.filter(pk=pk).update(busy=True)
+        self.leases.append(lease)
+        if self._heartbeat is None:
+            self._heartbeat = _Heartbeat(self.leases)
+            self._heartbeat.start()
+        return lease
+
+    def release_all(self):
+        if self._heartbeat is not None:
+            self._heartbeat.stopped.set()
+            self._heartbeat.join()
+            self._heartbeat = None
+        if self.leases:
+            pks = [lease.instance_id for lease in self.leases]
+            Lease.objects.filter(pk__in=[lease.pk for lease in self.leases]).delete()
+            YigoInstance.objects.filter(pk__in=pks).update(busy=False)
+            self.leases = []
+
+
+@contextmanager
+def lease(pk, timeout=0):
+    """Hold the lease of instance `pk' in a `with' block, see `Leases.acquire'."""
+    leases = Leases()
+    leases.acquire(pk, timeout)
+    try:
+        yield
+    finally:
+        leases.release_all()
+
+
+# Local Variables: **
+# comment-column: 56 **
+# indent-tabs-mode: nil **
+# python-indent: 4 **
+# End: **
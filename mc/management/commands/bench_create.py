@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+
+from mc.models import *
+from mc.manager import Manager
+from mc.metrics import use_scratch_dir
+
+
+class Command(BaseCommand):
+    help = 'Measure Manager.create latency and query count against fleets of growing size. ' \
+           'Everything is done in a transaction which is rolled back at the end.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--sizes', dest='sizes', default='10,100,1000',
+                    help='comma separated fleet sizes (number of yigo and database hosts)'),
+        make_option('--creates', dest='creates', type='int', default=50,
+                    help='number of instances created for each fleet size'),
+    )
+
+    def handle(self, *args, **options):
+        use_scratch_dir()
+        sizes = [int(x) for x in options['sizes'].split(',')]
+        creates = options['creates']
+        self.stdout.write('%8s %8s %12s %12s' % ('hosts', 'creates', 'ms/create', 'queries'))
+        for size in sizes:
+            with transaction.atomic():
+                elapsed, queries = self._run(size, creates)
+                transaction.set_rollback(True)
+            self.stdout.write('%8d %8d %12.3f %12.1f' %
+                              (size, creates, elapsed * 1000.0 / creates, float(queries) / creates))
+
+    def _run(self, size, creates):
+        YigoEnv.objects.get_or_create(version='bench', defaults={'path': 'yigo-bench.tar.gz'})
+        JavaEnv.objects.get_or_create(version='bench', defaults={'path': '/opt/jdk-bench'})
+        YigoHost.objects.bulk_create([YigoHost(address='10.0.%d.%d' % (i / 256, i % 256),
+                                               ssh_user='bench', max_instances=creates,
+                                               heap_size=256)
+                                      for i in range(size)])
+        DatabaseHost.objects.bulk_create([DatabaseHost(address='10.1.%d.%d' % (i / 256, i % 256),
+                                                       ssh_user='bench', max_instances=creates,
+                                                       admin_user='root', admin_password='root')
+                                          for i in range(size)])
+        manager = Manager()
+        with CaptureQueriesContext(connection) as queries:
+            start = time.time()
+            for i in range(creates):
+                manager.create('bench-%d-%d' % (size, i), 'http://localhost/bench.tar.gz',
+                               yigo_version='bench', java_version='bench')
+            elapsed = time.time() - start
+        return elapsed, len(queries)
+
+
+# Local Variables: **
+# comment-column: 56 **
+# indent-tabs-mode: nil **
+# python-indent: 4 **
+# End: **
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+
+import multiprocessing
+import os
+import shutil
+import time
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from mc.models import *
+from mc.metrics import use_scratch_dir
+
+
+def _call(call):
+    """Run Manager method `method' with `args' in a pool process, return its
+    latency and the error it raised, if any."""
+    from fabric.api import hide
+    from mc.manager import Manager
+    method, args = call
+    start = time.time()
+    try:
+        with hide('everything'):
+            getattr(Manager(), method)(*args)
+    except Exception, e:
+        return time.time() - start, '%s: %s' % (e.__class__.__name__, e,)
+    return time.time() - start, None
+
+
+def _percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100.0))] if values else 0.0
+
+
+class Command(BaseCommand):
+    help = 'Drive Manager against a fleet of hosts simulated on this machine (see mc.backends.SimulatorBackend) ' \
+           'and report throughput and latency of creates, installs, starts, status checks and stops. ' \
+           'The fleet is added to the database and the rows added are removed at the end.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--hosts', dest='hosts', type='int', default=200,
+                    help='number of simulated yigo hosts and database hosts'),
+        make_option('--instances', dest='instances', type='int', default=400,
+                    help='number of instances created'),
+        make_option('--concurrency', dest='concurrency', type='int', default=8,
+                    help='number of processes calling Manager at the same time'),
+        make_option('--latency', dest='latency', type='float', default=0.02,
+                    help='seconds added to every remote command'),
+        make_option('--jitter', dest='jitter', type='float', default=0.01,
+                    help='seconds added at random to every remote command'),
+        make_option('--connect-latency', dest='connect_latency', type='float', default=0.1,
+                    help='seconds added to the first remote command of a host in a process'),
+        make_option('--root', dest='root', default=None,
+                    help='directory of the host sandboxes, MC_SIMULATOR_ROOT by default'),
+    )
+
+    def handle(self, *args, **options):
+        use_scratch_dir()
+        settings.MC_EXECUTION_BACKEND = 'mc.backends.SimulatorBackend'
+        settings.MC_SIMULATOR_LATENCY = options['latency']
+        settings.MC_SIMULATOR_JITTER = options['jitter']
+        settings.MC_SIMULATOR_CONNECT_LATENCY = options['connect_latency']
+        if options['root']:
+            settings.MC_SIMULATOR_ROOT = options['root']
+        import mc.manager                               # sets up fabric
+
+        hosts = options['hosts']
+        instances = options['instances']
+        self.concurrency = options['concurrency']
+        max_instances = (instances + hosts - 1) / hosts
+        # Rows of this run are named after it, only they are removed at the end
+        run = 'bench-%s-%s' % (os.getpid(), int(time.time()),)
+        yigo_env, yigo_env_created = YigoEnv.objects.get_or_create(version='bench',
+                                                                   defaults={'path': 'yigo-bench.tar.gz'})
+        java_env, java_env_created = JavaEnv.objects.get_or_create(version='bench',
+                                                                   defaults={'path': '/opt/jdk-bench'})
+        YigoHost.objects.bulk_create([YigoHost(address='%s-yigo-%d' % (run, i,), ssh_user='bench',
+                                               max_instances=max_instances, heap_size=256)
+                                      for i in range(hosts)])
+        DatabaseHost.objects.bulk_create([DatabaseHost(address='%s-db-%d' % (run, i,), ssh_user='bench',
+                                                       max_instances=max_instances,
+                                                       admin_user='root', admin_password='root')
+                                          for i in range(hosts)])
+        yigo_hosts = list(YigoHost.objects.filter(address__startswith=run + '-yigo-').values_list('pk', flat=True))
+        database_hosts = list(DatabaseHost.objects.filter(address__startswith=run + '-db-')
+                                                  .values_list('pk', flat=True))
+        codes = ['%s-%d' % (run, i,) for i in range(instances)]
+        run_instances = YigoInstance.objects.filter(external_id__startswith=run + '-')
+        self.stdout.write('%-16s %7s %7s %9s %9s %9s %9s' %
+                          ('phase', 'calls', 'errors', 'seconds', 'calls/s', 'p50 ms', 'p99 ms'))
+        # sqlite fails concurrent transactions which read before writing instead of waiting
+        create_concurrency = 1 if connection.vendor == 'sqlite' else self.concurrency
+        try:
+            self._phase('create', [('create', (code, 'http://bench/configs.tar.gz', 'bench', 'bench'))
+                                   for code in codes], create_concurrency)
+            pks = list(run_instances.values_list('pk', flat=True))
+            self._phase('install', [('install', (pk,)) for pk in pks])
+            self._phase('start', [('start', (pk,)) for pk in pks])
+            self._phase('is_running', [('is_running', (pk, True)) for pk in pks])
+            # Batch methods work on many hosts in parallel threads themselves
+            self._phase('is_running_many', [('is_running_many', (pks, True))], 0)
+            self._phase('stop', [('stop', (pk,)) for pk in pks])
+            self._phase('install_many', [('install_many', (pks,))], 0)
+        finally:
+            # The simulated hosts go away with their sandboxes
+            run_instances.update(installed=False, database_installed=False)
+            run_instances.delete()
+            YigoHost.objects.filter(pk__in=yigo_hosts).delete()
+            DatabaseHost.objects.filter(pk__in=database_hosts).delete()
+            if yigo_env_created:
+                yigo_env.delete()
+            if java_env_created:
+                java_env.delete()
+            shutil.rmtree(os.path.join(settings.MC_SIMULATOR_ROOT, 'hosts'), ignore_errors=True)
+
+    def _phase(self, name, calls, concurrency=None):
+        """Make `calls' on `concurrency' processes, in this process if it is 0."""
+        if concurrency is None:
+            concurrency = self.concurrency
+        start = time.time()
+        if concurrency:
+            connection.close()                          # never share a connection with the pool
+            pool = multiprocessing.Pool(min(concurrency, len(calls)))
+            try:
+                outcome = pool.map(_call, calls, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            outcome = [_call(call) for call in calls]
+        elapsed = time.time() - start
+        latencies = [latency for latency, error in outcome]
+        errors = [error for latency, error in outcome if error]
+        self.stdout.write('%-16s %7d %7d %9.2f %9.1f %9.1f %9.1f' %
+                          (name, len(calls), len(errors), elapsed, len(calls) / elapsed,
+                           _percentile(latencies, 50) * 1000, _percentile(latencies, 99) * 1000))
+        for error in sorted(set(errors))[:5]:
+            self.stderr.write('  %s' % (error.splitlines()[0],))
+
+
+# Local Variables: **
+# comment-column: 56 **
+# indent-tabs-mode: nil **
+# python-indent: 4 **
+# End: **
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+import json
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.test.client import RequestFactory
+
+from mc.jsonrpc import *
+from mc import views
+from mc.metrics import use_scratch_dir
+
+
+class EchoMethods(object):
+
+    url = '/bench/'
+
+    @publicmethod
+    def echo(self, value):
+        return value
+
+
+class Command(BaseCommand):
+    help = 'Measure the JSON-RPC dispatch overhead per call, without any manager work: ' \
+           'JsonRpc.serialize of a trivial method, and the rpc view serving the SMD.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--calls', dest='calls', type='int', default=10000,
+                    help='number of calls measured for each case'),
+    )
+
+    def handle(self, *args, **options):
+        use_scratch_dir()
+        calls = options['calls']
+        rpc = JsonRpc(EchoMethods())
+        body = json.dumps({'id': 1, 'method': 'echo', 'params': ['bench']})
+        factory = RequestFactory()
+        smd_request = factory.get('/mc/rpc/')
+        etag = views.rpc(smd_request)['ETag']
+        cached_smd_request = factory.get('/mc/rpc/', HTTP_IF_NONE_MATCH=etag)
+        self.stdout.write('%-24s %8s %12s' % ('case', 'calls', 'us/call'))
+        for name, call in (('dispatch', lambda: rpc.dispatch('echo', ['bench'])),
+                           ('serialize', lambda: rpc.serialize(body)),
+                           ('view smd', lambda: views.rpc(smd_request)),
+                           ('view smd not modified', lambda: views.rpc(cached_smd_request)),):
+            start = time.time()
+            for i in xrange(calls):
+                call()
+            elapsed = time.time() - start
+            self.stdout.write('%-24s %8d %12.2f' % (name, calls, elapsed * 1000000.0 / calls))
+
+
+# Local Variables: **
+# comment-column: 56 **
+# indent-tabs-mode: nil **
+# python-indent: 4 **
+# End: **
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from mc import occupancy
+
+
+class Command(BaseCommand):
+    help = 'Check the instance and reserved heap counters and the service port reservations of all hosts ' \
+           'against their instances, e.g. after adding the counter columns or the service port table to an ' \
+           'existing database.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--fix', dest='fix', action='store_true', default=False,
+                    help='rebuild the counters which are off, claim the missing reservations'),
+    )
+
+    def handle(self, *args, **options):
+        wrong = occupancy.check(options['fix'])
+        for host, field, counted, actual in wrong:
+            self.stdout.write('%s %s %s: %s, actually %s%s' %
+                              (host.__class__.__name__, host, field, counted, actual,
+                               ' (fixed)' if options['fix'] else '',))
+        if not wrong:
+            self.stdout.write('All counters are right')
+
+
+# Local Variables: **
+# comment-column: 56 **
+# indent-tabs-mode: nil **
+# python-indent: 4 **
+# End: **
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+
+import multiprocessing
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from mc.jobs import work, get_worker_name
+
+
+class Command(BaseCommand):
+    help = 'Run job workers executing queued install/uninstall/start/stop jobs and batch jobs.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', dest='workers', type='int', default=4,
+                    help='number of worker processes'),
+        make_option('--poll', dest='poll', type='float', default=1.0,
+                    help='seconds to wait when no job is pending'),
+    )
+
+    def handle(self, *args, **options):
+        # Fabric state is per thread (see mc.fabstate), workers are processes of their own so a
+        # job crashing or hanging its interpreter only takes its worker down
+        connection.close()
+        workers = []
+        for i in range(options['workers']):
+            p = multiprocessing.Process(target=work, args=(get_worker_name(i), options['poll'],),
+                                        name='mc_worker-%s' % (i,))
+            p.start()
+            workers.append(p)
+        try:
+            for p in workers:
+                p.join()
+        except KeyboardInterrupt:
+            for p in workers:
+                p.terminate()
+
+
+# Local Variables: **
+# comment-column: 56 **
+# indent-tabs-mode: nil **
+# python-indent: 4 **
+# End: **
@@ -1,6 +1,17 @@
 # -*- coding: utf-8 -*-
 
-from django.db import transaction
+import calendar
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.db import connection, transaction
 from django.db.models import F
 
 from mc.exceptions import *
@@ -8,12 +19,15 @@ from mc.exceptions import *
 from mc.models import *
 from mc.jsonrpc import *
 from mc.utils import *
+from mc.context import OperationContext
+from mc.sshpool import ConnectionPool, install_connection_pool
+from mc import fabstate, status
+from mc.events import emit, since
+from mc.metrics import timed
+from mc.locks import Leases, lease
+from mc.journal import load_journal, apply_progress, forget, DATABASE_STEPS, YIGO_STEPS
 
 
-def get_host(instance):
-    yigo_host = instance.yigo_host
-    return '%s@%s:%s' % (yigo_host.ssh_user, yigo_host.address, yigo_host.ssh_port,)
-
 def initialize_fabric():
     from fabric import state
     from fabric.main import load_tasks_from_module
@@ -23,43 +37,158 @@ def initialize_fabric():
     state.commands.update(tasks)
     state.env['key_filename'] = 'key/id_rsa'
     state.env['abort_exception'] = RuntimeError # Use exception to abort failed commands
-initialize_fabric()
+    pool = ConnectionPool(settings.MC_SSH_IDLE_TIMEOUT, settings.MC_SSH_MAX_CONNECTIONS_PER_HOST)
+    install_connection_pool(pool)
+    fabstate.install_thread_local_state()
+    return Executor(pool)
 
 
 from fabric.api import execute
+from fabric.context_managers import settings as fabric_settings
+
+
+class Executor(object):
+    """
+    Runs fabtasks for Manager, several operations of a worker process at once.
+
+    Every operation works on copies of fabric `env' and `output' of its own (see
+    mc.fabstate) and holds the pooled SSH connections it uses (see
+    `ConnectionPool.holding'), so operations of concurrent requests, or of a
+    thread pool, do not interfere. Calls nest: an operation may run others.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.timed_pool = None
+        self.timed_pool_pid = None
+        self.timed_pool_lock = threading.Lock()
+
+    def get_timed_pool(self):
+        """The thread pool of the plans run with a timeout, one per process: hosts
+        which never answer hold at most MC_BATCH_PARALLELISM threads and their
+        connections however often such plans run."""
+        with self.timed_pool_lock:
+            if self.timed_pool is None or self.timed_pool_pid != os.getpid():
+                self.timed_pool = ThreadPool(settings.MC_BATCH_PARALLELISM)
+                self.timed_pool_pid = os.getpid()
+            return self.timed_pool
+
+    @contextmanager
+    def operation(self, base=None):
+        """Run the block as an operation, on copies of the fabric state of the
+        current thread or of `base' (see `mc.fabstate.current')."""
+        with fabstate.isolated(base):
+            with self.pool.holding():
+                yield
+
+    def execute(self, task, host, *args):
+        """Execute fabtask `task' with `args' on `host' and return its result."""
+        with self.operation():
+            return execute(task, *args, hosts=[host])[host]
+
+    def execute_plan(self, task, plan, *args, **kwargs):
+        """Execute fabtask `task' with `args' and `plan' on every host of `plan'.
+
+        `plan' maps host strings (see `get_host' and `get_database_host') to the
+        instances worked on there. Hosts run in parallel threads (at most
+        MC_BATCH_PARALLELISM at a time) sharing the pooled connections of this
+        process when there are more than one. Returns a dict of host string to the
+        task result, or to the exception if the host failed.
+
+        With keyword argument `timeout', hosts not done within `timeout' seconds
+        get a `multiprocessing.TimeoutError', their threads of the shared pool (see
+        `get_timed_pool') finish in the background.
+        """
+        timeout = kwargs.pop('timeout', None)
+        hosts = plan.keys()
+        args = args + (plan,)
+        if len(hosts) == 1 and timeout is None:
+            try:
+                return {hosts[0]: self.execute(task, hosts[0], *args)}
+            except Exception, e:
+                return {hosts[0]: e}
+        base = fabstate.current()
+        def execute_on(host):
+            try:
+                with self.operation(base):
+                    with fabric_settings(skip_bad_hosts=True, warn_only=True):
+                        return execute(task, *args, hosts=[host])[host]
+            except Exception, e:
+                return e
+            finally:
+                connection.close()                      # of this pool thread, if the task used one
+        if timeout is None:
+            pool = ThreadPool(min(settings.MC_BATCH_PARALLELISM, len(hosts)))
+        else:
+            pool = self.get_timed_pool()
+        pending = [(host, pool.apply_async(execute_on, (host,))) for host in hosts]
+        deadline = timeout and time.time() + timeout
+        outcome = {}
+        for host, result in pending:
+            try:
+                outcome[host] = result.get(deadline and max(deadline - time.time(), 0))
+            except TimeoutError:
+                outcome[host] = TimeoutError('%s not done within %s seconds' % (host, timeout,))
+        if timeout is None:
+            pool.close()
+            pool.join()
+        return outcome
+
+
+executor = initialize_fabric()
+
+
+def new_results(pks):
+    """Drop duplicates from `pks', return them and a result dict for every pk."""
+    seen = set()
+    pks = [pk for pk in pks if not (pk in seen or seen.add(pk))]
+    return pks, dict((pk, {'id': pk, 'result': None, 'error': None, 'message': None}) for pk in pks)
+
+def set_error(result, error_type, message):
+    result.update(error=error_type, message=message or None)
+
+
+# Manager methods that can be queued as jobs, see `Manager.submit'
+JOB_METHODS = ('install', 'uninstall', 'start', 'stop',)
+
+# Manager methods that can be queued as batch jobs, see `Manager.submit_many'
+BATCH_JOB_METHODS = ('install_many', 'uninstall_many', 'start_many', 'stop_many',)
 
 
 def busymethod(method):
+    """Run `method' holding the lease of its instance, waiting `lock_timeout' seconds
+    (MC_LEASE_WAIT by default) for it before raising `InstanceIsBusy'."""
+    @wraps(method)
     def wrapper(self, pk, *args, **kwargs):
-        if not YigoInstance.objects.filter(pk=pk, busy=False).update(busy=True):
-            YigoInstance.objects.get(pk=pk) # checking instance exists, will raise DoesNotExist
-            raise InstanceIsBusy()
+        timeout = kwargs.pop('lock_timeout', settings.MC_LEASE_WAIT)
         try:
-            return method(self, pk, *args, **kwargs)
+            with lease(pk, timeout):
+                emit(pk, 'started', operation=method.__name__)
+                try:
+                    result = method(self, pk, *args, **kwargs)
+                except Exception, e:
+                    emit(pk, 'failed', operation=method.__name__, error=e.__class__.__name__, message=unicode(e))
+                    raise
+                emit(pk, 'finished', operation=method.__name__)
+                return result
         finally:
-            YigoInstance.objects.filter(pk=pk, busy=True).update(busy=False)
+            status.invalidate(pk)
     return wrapper
 
 
 class Manager(object):
 
     def _find_sparest_host(self, host_type):
-        spare_hosts = host_type.objects.filter(max_instances__gt=0)
+        # Rank hosts by their occupancy counter, one query whatever the fleet size, and
+        # skip hosts already at `max_instances'. pre_save still rejects the pick if the
+        # host filled up meanwhile.
+        spare_hosts = host_type.objects.filter(num_instances__lt=F('max_instances')) \
+                                       .order_by('num_instances', 'pk')[:1]
         if spare_hosts:
-            return sorted(spare_hosts, key=lambda x: x.instance_set.count())[0]
+            return spare_hosts[0]
         else:
             raise NoMoreSpareHosts(host_type)
 
-    def _find_service_port(self, yigo_host):
-        if yigo_host.instance_set.count() == 0:
-            return yigo_host.initial_service_port
-        else:
-            instances = yigo_host.instance_set.all().order_by('service_port')
-            for i, instance in enumerate(instances):
-                if instance.service_port != yigo_host.initial_service_port + i:
-                    return yigo_host.initial_service_port + i
-            return yigo_host.initial_service_port + len(instances)
-
     def _find_env(self, env_type, version=None):
         envs = None
         if version:
@@ -71,33 +200,171 @@ class Manager(object):
         else:
             raise NoEnv(env_type, version)
 
-    def _check_is_running(self, pk):
-        if self.is_running(pk):
+    def _check_is_running(self, instance, context):
+        # Probed afresh as the state is about to be relied on, the fabtasks of the
+        # operation then take it from `context'
+        running = self.is_running(instance.pk, refresh=True)
+        context.record('running', instance, running)
+        if running:
             raise InstanceIsRunning()
 
+    def _lock_many(self, pks, results, leases, check=None):
+        """Load instances `pks' and take the leases of those passing `check' into `leases'.
+
+        `check' raises the exception reported for an instance it rejects. Errors go
+        to `results', the locked instances are returned in the order of `pks'.
+        """
+        instances = YigoInstance.objects.select_related('yigo_host', 'database_host',
+                                                        'yigo_env', 'java_env').in_bulk(pks)
+        locked = []
+        for pk in pks:
+            instance = instances.get(pk)
+            try:
+                if instance is None:
+                    raise YigoInstance.DoesNotExist()
+                if check:
+                    check(instance)
+                leases.acquire(pk)
+            except Exception, e:
+                set_error(results[pk], e.__class__.__name__, unicode(e))
+                continue
+            locked.append(instance)
+        return locked
+
+    def _emit_many(self, operation, instances, results=None):
+        """Emit the start of `operation' on locked `instances', or its end if
+        `results' are given."""
+        for instance in instances:
+            result = results and results[instance.pk]
+            if results is None:
+                emit(instance.pk, 'started', operation=operation)
+            elif result['error']:
+                emit(instance.pk, 'failed', operation=operation, error=result['error'], message=result['message'])
+            else:
+                emit(instance.pk, 'finished', operation=operation)
+
+    def _unlock_many(self, leases, instances):
+        leases.release_all()
+        if instances:
+            status.invalidate(*[instance.pk for instance in instances])
+
+    def _load_launcher_inputs(self, instance, profiles=None):
+        """Give `instance' the install journal and JVM profile the fabtasks render and
+        check its launcher with (see mc.fabtasks._launcher_command), `profiles' caches
+        the profiles of a batch by envs."""
+        profiles = {} if profiles is None else profiles
+        key = (instance.yigo_env_id, instance.java_env_id)
+        if key not in profiles:
+            profiles[key] = JvmProfile.objects.for_instance(instance)
+        instance.jvm_profile = profiles[key]
+        instance.install_journal = load_journal(instance)
+
+    def _check_installed(self, instance):
+        if not (instance.installed and instance.database_installed):
+            raise InstanceNotInstalled()
 
+    def _run_many(self, operation, pks):
+        """Run fabtask operation `operation' on instances `pks'.
+
+        Instances are grouped by yigo host, hosts run in parallel (at most
+        MC_BATCH_PARALLELISM at a time) and instances of one host run in the given
+        order. Returns one result dict per pk, errors are reported per pk.
+        """
+        pks, results = new_results(pks)
+        leases = Leases()
+        check = self._check_installed if operation in ('start', 'stop',) else None
+        locked = self._lock_many(pks, results, leases, check)
+        try:
+            self._emit_many(operation, locked)
+            plan = {}
+            profiles = {}
+            for instance in locked:
+                self._load_launcher_inputs(instance, profiles)
+                plan.setdefault(get_host(instance), []).append(instance)
+            outcome = executor.execute_plan('run_batch', plan, operation) if plan else {}
+            for host, host_instances in plan.items():
+                host_results = outcome.get(host)
+                if not isinstance(host_results, list):
+                    # The whole host failed, e.g. it could not be connected
+                    for instance in host_instances:
+                        set_error(results[instance.pk], host_results.__class__.__name__, unicode(host_results))
+                    # run_batch emitted the end of the others
+                    self._emit_many(operation, host_instances, results)
+                    continue
+                for pk, result, error_type, message, progress in host_results:
+                    apply_progress(pk, progress)
+                    if error_type:
+                        set_error(results[pk], error_type, message)
+                    else:
+                        results[pk]['result'] = result
+        finally:
+            self._unlock_many(leases, locked)
+        return [results[pk] for pk in pks]
+
+    def _run_databases_many(self, task, pks, database_installed):
+        """Run fabtask `task' once per database host for all instances `pks' on it,
+        then set their `database_installed' flag. See `_run_many' for results."""
+        pks, results = new_results(pks)
+        running, errors = status.probe(pks, refresh=True)
+        def check(instance):
+            if instance.pk in errors:
+                raise errors[instance.pk]
+            if running[instance.pk]:
+                raise InstanceIsRunning()
+        leases = Leases()
+        locked = self._lock_many(pks, results, leases, check)
+        try:
+            self._emit_many(task, locked)
+            plan = {}
+            for instance in locked:
+                plan.setdefault(get_database_host(instance), []).append(instance)
+            outcome = executor.execute_plan(task, plan) if plan else {}
+            for host, host_instances in plan.items():
+                host_result = outcome.get(host)
+                if isinstance(host_result, BaseException) or host_result is None:
+                    for instance in host_instances:
+                        set_error(results[instance.pk], host_result.__class__.__name__, unicode(host_result))
+                    continue
+                done = []
+                for instance in host_instances:
+                    step = host_result[instance.pk]
+                    if step['exit_code']:
+                        set_error(results[instance.pk], 'RemoteStepFailed',
+                                  'Step %s failed with exit code %s' % (step['step'], step['exit_code'],))
+                    else:
+                        results[instance.pk]['result'] = step
+                        done.append(instance.pk)
+                YigoInstance.objects.filter(pk__in=done).update(database_installed=database_installed)
+            self._emit_many(task, locked, results)
+        finally:
+            self._unlock_many(leases, locked)
+        return [results[pk] for pk in pks]
+
+
+    @timed('mc_manager')
     def create(self, instance_code, configs_source, yigo_version=None, java_version=None):
         yigo_host = self._find_sparest_host(YigoHost)
-        service_port = self._find_service_port(yigo_host)
         database_host = self._find_sparest_host(DatabaseHost)
         java_env = self._find_env(JavaEnv, java_version)
         yigo_env = self._find_env(YigoEnv, yigo_version)
 
-        instance = YigoInstance(external_id=instance_code,
-                                yigo_host=yigo_host,
-                                configs_source=configs_source,
-                                service_port=service_port,
-                                database_host=database_host,
-                                java_env=java_env,
-                                yigo_env=yigo_env)
-
         with transaction.atomic():
+            # The port reservation is rolled back with the instance if saving fails
+            service_port = ServicePort.objects.claim(yigo_host)
+            instance = YigoInstance(external_id=instance_code,
+                                    yigo_host=yigo_host,
+                                    configs_source=configs_source,
+                                    service_port=service_port,
+                                    database_host=database_host,
+                                    java_env=java_env,
+                                    yigo_env=yigo_env)
             instance.save()
 
         return {'id': instance.id,
                 'url': 'http://%s:%s/%s/' %  (yigo_host.address, instance.service_port, 'yigo',)}
 
 
+    @timed('mc_manager')
     def info(self, pk):
         instance = YigoInstance.objects.get(pk=pk)
         return {
@@ -109,71 +376,213 @@ class Manager(object):
         }
 
 
+    @timed('mc_manager')
     @busymethod
     def install(self, pk):
         instance = YigoInstance.objects.get(pk=pk)
-        self._check_is_running(pk)
+        context = OperationContext()
+        self._check_is_running(instance, context)
 
         host = get_host(instance)
-        # recreate mysql instance
-        execute('delete_mysql_instance', hosts=[host], *[instance], **{})
-        instance.database_installed = False
-        instance.save()
-        execute('create_mysql_instance', hosts=[host], *[instance], **{})
-        instance.database_installed = True
-        instance.save()
-        # recreate yigo instance
-        execute('delete_yigo_instance', hosts=[host], *[instance], **{})
-        instance.installed = False
-        instance.save()
-        execute('create_yigo_instance', hosts=[host], *[instance], **{})
-        instance.installed = True
-        instance.save()
+        # Only steps which never finished or whose inputs changed are redone
+        progress = {}
+        self._load_launcher_inputs(instance)
+        try:
+            return executor.execute('install_yigo_instance', host, instance, instance.install_journal,
+                                    progress, context)
+        finally:
+            apply_progress(pk, progress)
 
 
+    @timed('mc_manager')
     @busymethod
     def uninstall(self, pk):
         instance = YigoInstance.objects.get(pk=pk)
-        self._check_is_running(pk)
+        context = OperationContext()
+        self._check_is_running(instance, context)
 
         host = get_host(instance)
         if instance.installed:
-            execute('delete_yigo_instance', hosts=[host], *[instance], **{})
+            executor.execute('delete_yigo_instance', host, instance, context)
             instance.installed = False
-            instance.save()
+            instance.save(update_fields=['installed'])
+            forget(pk, YIGO_STEPS)
         if instance.database_installed:
-            execute('delete_mysql_instance', hosts=[host], *[instance], **{})
+            executor.execute('delete_mysql_instance', host, instance, context)
             instance.database_installed = False
-            instance.save()
+            instance.save(update_fields=['database_installed'])
+            forget(pk, DATABASE_STEPS)
 
+    @timed('mc_manager')
     @busymethod
     def start(self, pk):
         instance = YigoInstance.objects.get(pk=pk)
-        self._check_is_running(pk)
+        context = OperationContext()
+        self._check_is_running(instance, context)
 
         if instance.installed and instance.database_installed:
             host = get_host(instance)
-            execute('start_yigo_instance', hosts=[host], *[instance], **{})
+            self._load_launcher_inputs(instance)
+            progress = {}
+            try:
+                return executor.execute('start_yigo_instance', host, instance, context, progress)
+            finally:
+                apply_progress(pk, progress)
         else:
             raise InstanceNotInstalled()
 
+    @timed('mc_manager')
     @busymethod
     def stop(self, pk):
         instance = YigoInstance.objects.get(pk=pk)
         if instance.installed and instance.database_installed:
             host = get_host(instance)
-            execute('stop_yigo_instance', hosts=[host], *[instance], **{})
+            self._load_launcher_inputs(instance)
+            progress = {}
+            try:
+                executor.execute('stop_yigo_instance', host, instance, False, None, progress)
+            finally:
+                apply_progress(pk, progress)
         else:
             raise InstanceNotInstalled()
 
 
-    def is_running(self, pk):
+    @timed('mc_manager')
+    def is_running(self, pk, refresh=False):
+        running, errors = status.probe([pk], refresh)
+        if pk in errors:
+            raise errors[pk]
+        return running[pk]
+
+
+    @timed('mc_manager')
+    def tail_log(self, pk, offset=None, max_bytes=None):
+        """Read the log of instance `pk' from byte `offset' on, the last lines without
+        `offset'. Pass the returned `next_offset' to the next call to follow the log."""
+        max_bytes = min(int(max_bytes or settings.MC_LOG_CHUNK_BYTES), settings.MC_LOG_MAX_CHUNK_BYTES)
+        if max_bytes <= 0 or (offset is not None and offset < 0):
+            raise ValueError('Bad offset %s or max_bytes %s' % (offset, max_bytes,))
+        instance = YigoInstance.objects.select_related('yigo_host').get(pk=pk)
+        host = get_host(instance)
+        return executor.execute('read_yigo_log', host, instance, offset, max_bytes)
+
+
+    @timed('mc_manager')
+    def install_many(self, pks):
+        return self._run_many('install', pks)
+
+    @timed('mc_manager')
+    def start_many(self, pks):
+        return self._run_many('start', pks)
+
+    @timed('mc_manager')
+    def stop_many(self, pks):
+        return self._run_many('stop', pks)
+
+    @timed('mc_manager')
+    def uninstall_many(self, pks, stop=False):
+        """Delete instances `pks' and their databases, stopping running ones first if
+        `stop' is set. Running instances are reported as errors otherwise."""
+        return self._run_many('stop_uninstall' if stop else 'uninstall', pks)
+
+    @timed('mc_manager')
+    def is_running_many(self, pks, refresh=False):
+        running, errors = status.probe(pks, refresh)
+        return [{'id': pk,
+                 'result': running.get(pk),
+                 'error': pk in errors and errors[pk].__class__.__name__ or None,
+                 'message': pk in errors and unicode(errors[pk]) or None}
+                for pk in pks]
+
+
+    @timed('mc_manager')
+    def ssh_pool_stats(self):
+        """SSH connection reuse of this worker process."""
+        return executor.pool.stats()
+
+
+    @timed('mc_manager')
+    def install_databases_many(self, pks):
+        """Create databases and users of instances `pks', one mysql session per database host."""
+        return self._run_databases_many('create_mysql_instances', pks, True)
+
+    @timed('mc_manager')
+    def uninstall_databases_many(self, pks):
+        """Drop databases and users of instances `pks', one mysql session per database host."""
+        return self._run_databases_many('delete_mysql_instances', pks, False)
+
+
+    @timed('mc_manager')
+    def submit(self, method, pk):
+        """Queue `method' of instance `pk' for the job workers, return the job id."""
+        if method not in JOB_METHODS:
+            raise ValueError('Cannot queue method %s' % (method,))
         instance = YigoInstance.objects.get(pk=pk)
-        if instance.installed and instance.database_installed:
-            host = get_host(instance)
-            result = execute('is_yigo_instance_running', hosts=[host], *[instance], **{})
-            return result[host]
-        return False
+        return Job.objects.create(method=method, instance=instance).id
+
+    @timed('mc_manager')
+    def job_status(self, job_id):
+        job = Job.objects.get(pk=job_id)
+        return {
+            'id': job.id,
+            'method': job.method,
+            'instance': job.instance_id,
+            'state': job.state,
+            'result': json.loads(job.result) if job.result else None,
+            'error': job.error or None,
+            'message': job.message or None,
+            'created': job.created.isoformat(),
+            'started': job.started and job.started.isoformat(),
+            'finished': job.finished and job.finished.isoformat(),
+        }
+
+    @timed('mc_manager')
+    def submit_many(self, method, pks, **options):
+        """Queue batch `method' of instances `pks' with keyword arguments `options' for
+        the job workers as one job, return the job id."""
+        if method not in BATCH_JOB_METHODS:
+            raise ValueError('Cannot queue method %s' % (method,))
+        pks, _ = new_results(pks)
+        if YigoInstance.objects.filter(pk__in=pks).count() != len(pks):
+            raise YigoInstance.DoesNotExist()
+        with transaction.atomic():
+            job = BatchJob.objects.create(method=method, options=json.dumps(options))
+            job.instances.add(*pks)
+        return job.id
+
+    @timed('mc_manager')
+    def batch_job_status(self, job_id):
+        """State of batch job `job_id' and of each of its instances: the last progress
+        event while it runs, the result once it finished."""
+        job = BatchJob.objects.get(pk=job_id)
+        results = dict((result['id'], result) for result in json.loads(job.result)) if job.result else {}
+        after = job.started and (calendar.timegm(job.started.utctimetuple()) * 1000000 + job.started.microsecond)
+        instances = []
+        for instance in job.instances.order_by('pk'):
+            result = results.get(instance.pk, {})
+            progress = since(instance.pk, after) if after else []
+            event = progress and progress[-1]['event'] or None
+            instances.append({
+                'id': instance.pk,
+                'external_id': instance.external_id,
+                'event': event,
+                'done': bool(result) or event in ('finished', 'failed',),
+                'result': result.get('result'),
+                'error': result.get('error'),
+                'message': result.get('message'),
+            })
+        return {
+            'id': job.id,
+            'method': job.method,
+            'state': job.state,
+            'instances': instances,
+            'done': len([instance for instance in instances if instance['done']]),
+            'error': job.error or None,
+            'message': job.message or None,
+            'created': job.created.isoformat(),
+            'started': job.started and job.started.isoformat(),
+            'finished': job.finished and job.finished.isoformat(),
+        }
 
 
 
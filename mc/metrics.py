@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+
+import atexit
+import errno
+import fcntl
+import glob
+import json
+import multiprocessing.util
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+from functools import wraps
+
+from django.conf import settings
+
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300,)
+
+METRICS = {
+    'mc_rpc_seconds': ('histogram', 'JSON-RPC call latency by method'),
+    'mc_rpc_errors_total': ('counter', 'JSON-RPC calls failed, by method and exception class'),
+    'mc_manager_seconds': ('histogram', 'Manager method latency by method'),
+    'mc_manager_errors_total': ('counter', 'Manager methods failed, by method and exception class'),
+    'mc_remote_command_seconds': ('histogram', 'Remote command (SSH round trip) latency by fabtask'),
+    'mc_remote_command_errors_total': ('counter', 'Remote commands failed, by fabtask and exception class'),
+    'mc_lease_busy_total': ('counter', 'Operations rejected because the instance lease was held'),
+    'mc_instance_ready_seconds': ('histogram', 'Instance JVM launch to ready latency by envs and class data sharing mode'),
+}
+
+
+class _Registry(object):
+    """
+    Metrics of this process, saved to a file of its own in MC_METRICS_DIR so the
+    metrics view can add up all uwsgi and job worker processes.
+
+    Files are written at most every MC_METRICS_FLUSH_SECONDS by a background
+    thread, and at exit. A forked child (e.g. a multiprocessing pool worker)
+    starts a registry of its own, written by the multiprocessing exit handlers
+    as such children skip atexit. The file of an exited process with the pid of
+    this one is archived before the first write (see `_archive').
+    """
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.dirty = False
+        self.flushed = False
+        self.flusher = None
+        multiprocessing.util.Finalize(None, self.flush, exitpriority=10)
+
+    def filename(self):
+        return os.path.join(settings.MC_METRICS_DIR, '%s-%s.json' % (socket.gethostname(), self.pid,))
+
+    def inc(self, name, labels, value=1):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+            self.dirty = True
+        self.changed()
+
+    def observe(self, name, labels, seconds):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * len(BUCKETS) + [0, 0.0]
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    histogram[i] += 1
+            histogram[-2] += 1
+            histogram[-1] += seconds
+            self.dirty = True
+        self.changed()
+
+    def changed(self):
+        if self.flusher is None:
+            with self.lock:
+                if self.flusher is None:
+                    self.flusher = threading.Thread(target=self.flush_forever, name='mc-metrics-flusher')
+                    self.flusher.daemon = True
+                    self.flusher.start()
+
+    def flush_forever(self):
+        while True:
+            time.sleep(settings.MC_METRICS_FLUSH_SECONDS)
+            self.flush()
+
+    def flush(self):
+        if os.getpid() != self.pid:
+            return                                      # the copy of the parent in a forked child
+        with self.lock:
+            if not self.dirty:
+                return
+            snapshot = {'counters': [[name, labels, value] for (name, labels), value in self.counters.items()],
+                        'histograms': [[name, labels, values] for (name, labels), values in self.histograms.items()]}
+            self.dirty = False
+        filename = self.filename()
+        if not os.path.isdir(settings.MC_METRICS_DIR):
+            try:
+                os.makedirs(settings.MC_METRICS_DIR)
+            except OSError:
+                pass                                    # made by another process meanwhile
+        if not self.flushed:
+            _archive([filename], exited=True)           # left by an exited process with this pid
+            self.flushed = True
+        with open(filename + '.tmp', 'w') as f:
+            json.dump(snapshot, f)
+        os.rename(filename + '.tmp', filename)
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+def get_registry():
+    global _registry
+    if _registry is None or _registry.pid != os.getpid():
+        with _registry_lock:
+            if _registry is None or _registry.pid != os.getpid():
+                _registry = _Registry()
+    return _registry
+
+def _flush_at_exit():
+    if _registry is not None:
+        _registry.flush()
+atexit.register(_flush_at_exit)
+
+
+def use_scratch_dir():
+    """Save the metrics of this process and of its children to a temporary
+    directory removed at exit, so test runs and benchmarks do not add to the
+    metrics of the running processes."""
+    settings.MC_METRICS_DIR = tempfile.mkdtemp(prefix='yigo_runtime-metrics-')
+    atexit.register(_remove_scratch_dir, settings.MC_METRICS_DIR)
+
+def _remove_scratch_dir(dirname):
+    _flush_at_exit()
+    shutil.rmtree(dirname, ignore_errors=True)
+
+
+def inc(name, **labels):
+    get_registry().inc(name, labels)
+
+def observe(name, seconds, **labels):
+    get_registry().observe(name, labels, seconds)
+
+
+def timed(prefix):
+    """Decorator observing `<prefix>_seconds' and counting `<prefix>_errors_total'
+    by exception class, labelled with the method name."""
+    def decorator(method):
+        @wraps(method)
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            try:
+                return method(*args, **kwargs)
+            except Exception, e:
+                inc(prefix + '_errors_total', method=method.__name__, exception=e.__class__.__name__)
+                raise
+            finally:
+                observe(prefix + '_seconds', time.time() - start, method=method.__name__)
+        return wrapper
+    return decorator
+
+
+def observe_rpc(method, seconds, exception):
+    """`JsonRpc' observer of every call."""
+    observe('mc_rpc_seconds', seconds, method=method)
+    if exception is not None:
+        inc('mc_rpc_errors_total', method=method, exception=exception.__class__.__name__)
+
+
+def _format_labels(labels, extra=()):
+    labels = list(labels) + list(extra)
+    if not labels:
+        return ''
+    return '{' + ','.join(['%s="%s"' % (k, unicode(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                           for k, v in labels]) + '}'
+
+def _format_bound(bound):
+    return repr(float(bound))
+
+def _merge(counters, histograms, filename):
+    """Add the metrics saved in `filename' to `counters' and `histograms'."""
+    try:
+        with open(filename) as f:
+            snapshot = json.load(f)
+    except (IOError, ValueError):
+        return                                          # removed or being replaced
+    for name, labels, value in snapshot['counters']:
+        key = (name, tuple(tuple(label) for label in labels))
+        counters[key] = counters.get(key, 0) + value
+    for name, labels, values in snapshot['histograms']:
+        key = (name, tuple(tuple(label) for label in labels))
+        if key in histograms:
+            values = [a + b for a, b in zip(histograms[key], values)]
+        histograms[key] = values
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == errno.EPERM
+    return True
+
+def _exited_pid(filename):
+    """The pid of the process of this host that saved `filename' if it exited, or `None'."""
+    host, _, pid = os.path.basename(filename)[:-len('.json')].rpartition('-')
+    if host == socket.gethostname() and pid.isdigit() and int(pid) != os.getpid() and not _is_alive(int(pid)):
+        return int(pid)
+    return None
+
+def _archive(filenames, exited=False):
+    """
+    Add the metrics of processes of this host saved in `filenames' to the
+    `<host>-exited.json' file and remove them, keeping the counters of exited
+    processes without a file each, or one overwritten by the next process
+    with the same pid. Files of processes still running are left alone,
+    unless the caller knows them `exited'.
+    """
+    lock = os.open(os.path.join(settings.MC_METRICS_DIR, '.lock'), os.O_RDWR | os.O_CREAT, 0644)
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        filenames = [filename for filename in filenames if os.path.exists(filename) and
+                     (exited or _exited_pid(filename))]
+        if not filenames:
+            return
+        archive = os.path.join(settings.MC_METRICS_DIR, '%s-exited.json' % (socket.gethostname(),))
+        counters = {}
+        histograms = {}
+        for filename in [archive] + filenames:
+            _merge(counters, histograms, filename)
+        with open(archive + '.tmp', 'w') as f:
+            json.dump({'counters': [[name, labels, value] for (name, labels), value in counters.items()],
+                       'histograms': [[name, labels, values] for (name, labels), values in histograms.items()]}, f)
+        os.rename(archive + '.tmp', archive)
+        for filename in filenames:
+            os.remove(filename)
+    finally:
+        os.close(lock)
+
+def collect():
+    """All metrics of all processes in the text exposition format. The files of
+    exited processes of this host are archived first (see `_archive')."""
+    filenames = glob.glob(os.path.join(settings.MC_METRICS_DIR, '*.json'))
+    exited = [filename for filename in filenames if _exited_pid(filename)]
+    if exited:
+        _archive(exited)
+        filenames = glob.glob(os.path.join(settings.MC_METRICS_DIR, '*.json'))
+    counters = {}
+    histograms = {}
+    for filename in filenames:
+        _merge(counters, histograms, filename)
+    lines = []
+    for name in sorted(METRICS):
+        metric_type, help_text = METRICS[name]
+        lines.append('# HELP %s %s' % (name, help_text,))
+        lines.append('# TYPE %s %s' % (name, metric_type,))
+        if metric_type == 'counter':
+            for (series, labels), value in sorted(counters.items()):
+                if series == name:
+                    lines.append('%s%s %s' % (name, _format_labels(labels), value,))
+        else:
+            for (series, labels), values in sorted(histograms.items()):
+                if series != name:
+                    continue
+                for bound, count in zip(BUCKETS, values):
+                    lines.append('%s_bucket%s %s' % (name, _format_labels(labels, [('le', _format_bound(bound))]), count,))
+                lines.append('%s_bucket%s %s' % (name, _format_labels(labels, [('le', '+Inf')]), values[-2],))
+                lines.append('%s_sum%s %s' % (name, _format_labels(labels), repr(values[-1]),))
+                lines.append('%s_count%s %s' % (name, _format_labels(labels), values[-2],))
+    return '\n'.join(lines) + '\n'
+
+
+# Local Variables: **
+# comment-column: 56 **
+# indent-tabs-mode: nil **
+# python-indent: 4 **
+# End: **
@@ -1,4 +1,5 @@
-from django.db import models
+from django.db import models, transaction, IntegrityError
+from django.db.models import Max
 
 HEAP_SIZES = (
     (1024, '1GB'),
@@ -6,6 +7,18 @@ HEAP_SIZES = (
     (256, '256MB'),
 )
 
+JOB_PENDING   = 'pending'
+JOB_RUNNING   = 'running'
+JOB_SUCCEEDED = 'succeeded'
+JOB_FAILED    = 'failed'
+
+JOB_STATES = (
+    (JOB_PENDING, 'pending'),
+    (JOB_RUNNING, 'running'),
+    (JOB_SUCCEEDED, 'succeeded'),
+    (JOB_FAILED, 'failed'),
+)
+
 
 class YigoEnv(models.Model):
     version = models.CharField(max_length=20, unique=True)
@@ -23,15 +36,54 @@ class JavaEnv(models.Model):
         return self.version
 
 
+class JvmProfileManager(models.Manager):
+
+    def for_instance(self, instance):
+        """The profile of the envs of `instance', an unsaved default one if there is none."""
+        try:
+            return self.get(yigo_env=instance.yigo_env_id, java_env=instance.java_env_id)
+        except JvmProfile.DoesNotExist:
+            return JvmProfile(yigo_env_id=instance.yigo_env_id, java_env_id=instance.java_env_id)
+
+
+class JvmProfile(models.Model):
+    yigo_env           = models.ForeignKey(YigoEnv, related_name='jvm_profile_set')
+    java_env           = models.ForeignKey(JavaEnv, related_name='jvm_profile_set')
+    options            = models.CharField(max_length=500, default='-server -XX:MaxPermSize=128m',
+                                          help_text='JVM options of the instances, the heap size is the one of the host')
+    class_data_sharing = models.BooleanField(default=False,
+                                             help_text='start instances with a class data sharing archive made once '
+                                                       'per host from a training run, see mc.fabtasks.start_yigo_instance')
+
+    objects = JvmProfileManager()
+
+    def __unicode__(self):
+        return '%s on %s' % (self.yigo_env, self.java_env,)
+
+    class Meta:
+        unique_together = (('yigo_env', 'java_env'),)
+
+
 class RemoteHost(models.Model):
     address             = models.CharField(max_length=50, help_text='address of this host')
     ssh_user            = models.CharField(max_length=50, help_text='user for ssh connection to this host')
     ssh_port            = models.IntegerField(default=22, help_text='ssh port of this host')
     max_instances       = models.IntegerField(default=1, help_text='max number of instances this host can afford')
+    num_instances       = models.IntegerField(default=0, editable=False,
+                                              help_text='number of instances on this host, see mc.occupancy')
+
+    # Maintained by F-expression updates only (see `claim_host'), never written by `save'
+    counter_fields = ('num_instances', 'reserved_heap',)
 
     def __unicode__(self):
         return '%s@%s:%s' % (self.ssh_user, self.address, self.ssh_port)
 
+    def save(self, *args, **kwargs):
+        if self.pk and not kwargs.get('force_insert') and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [field.name for field in self._meta.fields
+                                       if not field.primary_key and field.name not in self.counter_fields]
+        super(RemoteHost, self).save(*args, **kwargs)
+
     class Meta:
         abstract = True
 
@@ -40,6 +92,8 @@ class YigoHost(RemoteHost):
     heap_size            = models.IntegerField(choices=HEAP_SIZES, help_text='JVM max heap size (MB) on this host')
     root_path            = models.CharField(max_length=100, default='apps', help_text='root path of installed instances')
     initial_service_port = models.IntegerField(default=8000, help_text='initial service port of installed instances')
+    reserved_heap        = models.IntegerField(default=0, editable=False,
+                                               help_text='JVM heap (MB) reserved by the instances on this host')
 
 
 class DatabaseHost(RemoteHost):
@@ -63,7 +117,39 @@ class YigoInstance(models.Model):
     yigo_env = models.ForeignKey(YigoEnv, related_name='+')
     java_env = models.ForeignKey(JavaEnv, related_name='+')
 
-    busy = models.BooleanField(default=False, help_text='is this instance busy on task')
+    busy = models.BooleanField(default=False, help_text='is this instance busy on task, '
+                                                        'mirrors the lease held on it (see mc.locks)')
+
+    def remember_saved(self, names=None):
+        """Take the values of fields `names' (all by default) as the saved ones, done
+        when the instance is loaded and after it is saved, see `changed_fields'."""
+        saved = self.__dict__.setdefault('_saved_values', {})
+        for field in self._meta.fields:
+            if (names is None or field.name in names or field.attname in names) and field.attname in self.__dict__:
+                saved[field.attname] = self.__dict__[field.attname]
+
+    def saved_value(self, name, default=None):
+        """Value of field `name' when the instance was loaded or last saved, `default'
+        if it is unknown (deferred, or the instance was never saved)."""
+        field = self._meta.get_field(name)
+        if self._state.adding:
+            return default
+        return self.__dict__.get('_saved_values', {}).get(field.attname, default)
+
+    def changed_fields(self):
+        """Names of the fields set to other values since the instance was loaded or
+        last saved, deferred fields never loaded excluded."""
+        saved = self.__dict__.get('_saved_values', {})
+        return [field.name for field in self._meta.fields
+                if not field.primary_key and field.attname in self.__dict__
+                and (field.attname not in saved or saved[field.attname] != self.__dict__[field.attname])]
+
+    def save(self, *args, **kwargs):
+        # Only changed columns are written, so a save neither costs a full row nor
+        # overwrites columns updated meanwhile by others (e.g. `busy' by mc.locks)
+        if not self._state.adding and not kwargs.get('force_insert') and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = self.changed_fields()
+        super(YigoInstance, self).save(*args, **kwargs)
 
     def database_name(self):
         return 'u%d' % (self.pk,)
@@ -78,38 +164,237 @@ class YigoInstance(models.Model):
         unique_together = (('yigo_host', 'service_port'),)
 
 
+class Job(models.Model):
+    method   = models.CharField(max_length=20, help_text='manager method run by this job')
+    instance = models.ForeignKey(YigoInstance, related_name='job_set')
+    state    = models.CharField(max_length=20, choices=JOB_STATES, default=JOB_PENDING, db_index=True)
+    result   = models.TextField(blank=True, help_text='JSON encoded return value of the method')
+    error    = models.CharField(max_length=100, blank=True, help_text='exception class of a failed job')
+    message  = models.TextField(blank=True, help_text='exception message of a failed job')
+    worker   = models.CharField(max_length=100, blank=True, help_text='worker running this job')
+    created  = models.DateTimeField(auto_now_add=True)
+    started  = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+    expires  = models.DateTimeField(null=True, blank=True, db_index=True,
+                                    help_text='a running job not renewed before is failed, see mc.jobs')
+
+    def __unicode__(self):
+        return '%s %s' % (self.method, self.instance_id)
+
+
+class BatchJob(models.Model):
+    method    = models.CharField(max_length=20, help_text='manager batch method run by this job')
+    instances = models.ManyToManyField(YigoInstance, related_name='batch_job_set')
+    options   = models.TextField(blank=True, help_text='JSON encoded keyword arguments of the method')
+    state     = models.CharField(max_length=20, choices=JOB_STATES, default=JOB_PENDING, db_index=True)
+    result    = models.TextField(blank=True, help_text='JSON encoded result of every instance')
+    error     = models.CharField(max_length=100, blank=True, help_text='exception class of a failed job')
+    message   = models.TextField(blank=True, help_text='exception message of a failed job')
+    worker    = models.CharField(max_length=100, blank=True, help_text='worker running this job')
+    created   = models.DateTimeField(auto_now_add=True)
+    started   = models.DateTimeField(null=True, blank=True)
+    finished  = models.DateTimeField(null=True, blank=True)
+    expires   = models.DateTimeField(null=True, blank=True, db_index=True,
+                                     help_text='a running job not renewed before is failed, see mc.jobs')
+
+    def __unicode__(self):
+        return '%s %s' % (self.method, self.pk)
+
+
+class Lease(models.Model):
+    instance = models.ForeignKey(YigoInstance, related_name='lease_set')
+    owner    = models.CharField(max_length=100, help_text='worker holding or waiting for this lease')
+    held     = models.BooleanField(default=False, help_text='is the lease held, otherwise it is waiting')
+    expires  = models.DateTimeField(db_index=True, help_text='lease is reclaimed unless renewed before')
+    created  = models.DateTimeField(auto_now_add=True)
+
+    def __unicode__(self):
+        return '%s %s' % (self.instance_id, self.owner)
+
+
+class InstallStep(models.Model):
+    instance    = models.ForeignKey(YigoInstance, related_name='install_step_set')
+    step        = models.CharField(max_length=20, help_text='finished install step')
+    fingerprint = models.CharField(max_length=40, help_text='digest of the inputs the step was done with')
+    finished    = models.DateTimeField(auto_now=True)
+
+    def __unicode__(self):
+        return '%s %s' % (self.instance_id, self.step)
+
+    class Meta:
+        unique_together = (('instance', 'step'),)
+
+
+# Conditional writes a port claim retries when other claims win, e.g. under a snapshot
+# of a REPEATABLE READ transaction that never sees them
+PORT_CLAIM_TRIES = 10
+
+
+class ServicePortManager(models.Manager):
+
+    def claim(self, yigo_host):
+        """Reserve a free service port on `yigo_host' and return it.
+
+        Released ports are handed out again first, otherwise a new port above the
+        highest reserved one is added. Both paths are a single conditional write, so
+        concurrent callers never get the same port. The reservations are the only
+        record looked at, those of instances created before them are added by
+        `check_occupancy --fix' (see `mc.occupancy.check').
+        """
+        for attempt in range(PORT_CLAIM_TRIES):
+            free = self.filter(yigo_host=yigo_host, claimed=False).order_by('port') \
+                       .values_list('pk', 'port')[:1]
+            if free:
+                pk, port = free[0]
+                if self.filter(pk=pk, claimed=False).update(claimed=True):
+                    return port
+                continue                                # claimed by someone else, try again
+            top = self.filter(yigo_host=yigo_host).aggregate(top=Max('port'))['top']
+            port = yigo_host.initial_service_port if top is None else top + 1
+            try:
+                with transaction.atomic():
+                    self.create(yigo_host=yigo_host, port=port, claimed=True)
+                return port
+            except IntegrityError:
+                continue                                # same port added concurrently, try again
+        raise ServicePortTaken(yigo_host, port)
+
+    def take(self, yigo_host, port):
+        """Reserve `port' on `yigo_host' for an instance given it, e.g. moved to the
+        host, raise `ServicePortTaken' if another instance holds it."""
+        for attempt in range(PORT_CLAIM_TRIES):
+            if self.filter(yigo_host=yigo_host, port=port, claimed=False).update(claimed=True):
+                return
+            if self.filter(yigo_host=yigo_host, port=port, claimed=True).exists():
+                break
+            try:
+                with transaction.atomic():
+                    self.create(yigo_host_id=yigo_host, port=port, claimed=True)
+                return
+            except IntegrityError:
+                continue                                # added concurrently, claim it
+        raise ServicePortTaken(yigo_host, port)
+
+    def release(self, yigo_host, port):
+        self.filter(yigo_host=yigo_host, port=port).update(claimed=False)
+
+
+class ServicePort(models.Model):
+    yigo_host = models.ForeignKey(YigoHost, related_name='service_port_set')
+    port      = models.IntegerField(help_text='service port reserved on this host')
+    claimed   = models.BooleanField(default=False, help_text='is this port used by an instance')
+
+    objects = ServicePortManager()
+
+    def __unicode__(self):
+        return '%s:%s' % (self.yigo_host.address, self.port)
+
+    class Meta:
+        unique_together = (('yigo_host', 'port'),)
+
+
 from django.dispatch import receiver
 from django.db.models import signals, F
-from mc.exceptions import NoMoreSpareHosts, UninstallBeforeDelete
+from mc.exceptions import NoMoreSpareHosts, UninstallBeforeDelete, ServicePortTaken
 from mc.models import YigoInstance
 from mc.utils import generate_password
 
 @receiver(signals.post_init, sender=YigoInstance)
 def post_init_yigo_instance(**kwargs):
     instance = kwargs['instance']
+    instance.remember_saved()
     if not instance.database_password:
         instance.database_password = generate_password()
 
-def check_host_refs(host_type, host_instance):
-    host_instance = host_type.objects.select_for_update().get(pk=host_instance.pk)
-    if host_instance.max_instances <= host_instance.instance_set.count():
+def _occupancy_changes(host_type, sign):
+    changes = {'num_instances': F('num_instances') + sign}
+    if host_type is YigoHost:
+        changes['reserved_heap'] = F('reserved_heap') + F('heap_size') * sign
+    return changes
+
+def claim_host(host_type, host_pk):
+    """Count a new instance on host `host_pk' if it has room left, with one
+    conditional UPDATE, raise `NoMoreSpareHosts' otherwise."""
+    if not host_type.objects.filter(pk=host_pk, num_instances__lt=F('max_instances')) \
+                            .update(**_occupancy_changes(host_type, 1)):
         raise NoMoreSpareHosts(host_type)
 
+def release_host(host_type, host_pk):
+    """Stop counting an instance on host `host_pk'."""
+    host_type.objects.filter(pk=host_pk).update(**_occupancy_changes(host_type, -1))
+
+@receiver(signals.pre_save, sender=YigoHost)
+def pre_save_yigo_host(**kwargs):
+    # Instances reserve the heap size of their host, a new heap size changes their
+    # reservations by the difference, conditional on the saved heap size so concurrent
+    # changes and claims (see `claim_host') are not lost
+    host = kwargs['instance']
+    if host._state.adding:
+        return
+    while True:
+        old = list(YigoHost.objects.filter(pk=host.pk).values_list('heap_size', flat=True))
+        if not old or old[0] == host.heap_size:
+            return
+        if YigoHost.objects.filter(pk=host.pk, heap_size=old[0]) \
+                           .update(heap_size=host.heap_size,
+                                   reserved_heap=F('reserved_heap') + F('num_instances') * (host.heap_size - old[0])):
+            return
+
 @receiver(signals.pre_save, sender=YigoInstance)
 def pre_save_yigo_instance(**kwargs):
+    # Hosts are claimed before the instance is written, callers save in a transaction
+    # (see Manager.create) so a failed save gives the claims back
     instance = kwargs['instance']
-    if not instance.pk:
-        check_host_refs(YigoHost, instance.yigo_host)
-        check_host_refs(DatabaseHost, instance.database_host)
+    if instance._state.adding:
+        old_yigo_host, old_database_host, old_service_port = None, None, None
     else:
-        old_instance = YigoInstance.objects.get(pk=instance.pk)
-        if old_instance.yigo_host != instance.yigo_host:
-            check_host_refs(YigoHost, instance.yigo_host)
-        if old_instance.database_host != instance.database_host:
-            check_host_refs(DatabaseHost, instance.database_host)
+        old_yigo_host = instance.saved_value('yigo_host')
+        old_database_host = instance.saved_value('database_host')
+        old_service_port = instance.saved_value('service_port')
+        if None in (old_yigo_host, old_database_host, old_service_port):
+            # Loaded with these fields deferred
+            old_yigo_host, old_database_host, old_service_port = \
+                YigoInstance.objects.filter(pk=instance.pk).values_list('yigo_host', 'database_host', 'service_port')[0]
+    # Ports of new instances are claimed by Manager.create, other ones are taken as given,
+    # first as a port held by another instance fails the save
+    port_moved = old_yigo_host is not None and \
+                 (old_yigo_host, old_service_port) != (instance.yigo_host_id, instance.service_port)
+    if port_moved:
+        ServicePort.objects.take(instance.yigo_host_id, instance.service_port)
+    try:
+        if old_yigo_host != instance.yigo_host_id:
+            claim_host(YigoHost, instance.yigo_host_id)
+        if old_database_host != instance.database_host_id:
+            try:
+                claim_host(DatabaseHost, instance.database_host_id)
+            except NoMoreSpareHosts:
+                if old_yigo_host != instance.yigo_host_id:
+                    release_host(YigoHost, instance.yigo_host_id)
+                raise
+    except NoMoreSpareHosts:
+        if port_moved:
+            ServicePort.objects.release(instance.yigo_host_id, instance.service_port)
+        raise
+    if old_yigo_host not in (None, instance.yigo_host_id):
+        release_host(YigoHost, old_yigo_host)
+    if old_database_host not in (None, instance.database_host_id):
+        release_host(DatabaseHost, old_database_host)
+    if port_moved:
+        ServicePort.objects.release(old_yigo_host, old_service_port)
+
+@receiver(signals.post_save, sender=YigoInstance)
+def post_save_yigo_instance(**kwargs):
+    kwargs['instance'].remember_saved(kwargs['update_fields'])
 
 @receiver(signals.pre_delete, sender=YigoInstance)
 def pre_delete_yigo_instance(**kwargs):
     instance = kwargs['instance']
     if instance.installed or instance.database_installed:
         raise UninstallBeforeDelete()
+
+@receiver(signals.post_delete, sender=YigoInstance)
+def post_delete_yigo_instance(**kwargs):
+    instance = kwargs['instance']
+    ServicePort.objects.release(instance.yigo_host_id, instance.service_port)
+    release_host(YigoHost, instance.yigo_host_id)
+    release_host(DatabaseHost, instance.database_host_id)
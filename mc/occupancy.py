@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+from django.db import transaction, IntegrityError
+from django.db.models import Count
+
+from mc.models import YigoHost, DatabaseHost, YigoInstance, ServicePort
+
+
+def _actual(host_type, host, num_instances):
+    actual = {'num_instances': num_instances}
+    if host_type is YigoHost:
+        actual['reserved_heap'] = num_instances * host.heap_size
+    return actual
+
+
+def check(fix=False):
+    """
+    Compare the occupancy counters of all yigo and database hosts (see
+    `mc.models.claim_host') with their instances.
+
+    Returns a list of (host, field, counter value, actual value) for every
+    counter which is off, and for every service port of an instance without a
+    claimed reservation. With `fix' set such counters are rebuilt, each host
+    row locked while its instances are counted again so instances created
+    meanwhile are not missed, and missing reservations are claimed.
+    """
+    wrong = []
+    for host_type in (YigoHost, DatabaseHost,):
+        for host in host_type.objects.annotate(actual_instances=Count('instance_set')):
+            actual = _actual(host_type, host, host.actual_instances)
+            off = [(field, getattr(host, field), value) for field, value in sorted(actual.items())
+                   if getattr(host, field) != value]
+            if not off:
+                continue
+            if fix:
+                with transaction.atomic():
+                    locked = host_type.objects.select_for_update().get(pk=host.pk)
+                    host_type.objects.filter(pk=host.pk) \
+                                     .update(**_actual(host_type, locked, locked.instance_set.count()))
+            wrong.extend([(host, field, counted, value) for field, counted, value in off])
+    wrong.extend(_check_service_ports(fix))
+    return wrong
+
+
+def _check_service_ports(fix):
+    # Every service port of an instance is claimed in ServicePort, the only record port
+    # claims look at; instances created before that table get theirs here
+    claimed = set(ServicePort.objects.filter(claimed=True).values_list('yigo_host', 'port'))
+    hosts = dict((host.pk, host) for host in YigoHost.objects.all())
+    wrong = []
+    for yigo_host, port in sorted(set(YigoInstance.objects.values_list('yigo_host', 'service_port'))):
+        if (yigo_host, port) in claimed:
+            continue
+        if fix and not ServicePort.objects.filter(yigo_host=yigo_host, port=port).update(claimed=True):
+            try:
+                with transaction.atomic():
+                    ServicePort.objects.create(yigo_host_id=yigo_host, port=port, claimed=True)
+            except IntegrityError:
+                ServicePort.objects.filter(yigo_host=yigo_host, port=port).update(claimed=True)
+        wrong.append((hosts[yigo_host], 'service port %s' % (port,), 'unclaimed', 'used'))
+    return wrong
+
+
+# Local Variables: **
+# comment-column: 56 **
+# indent-tabs-mode: nil **
+# python-indent: 4 **
+# End: **
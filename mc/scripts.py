@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import time
+
+from django.conf import settings
+
+from mc.backends import run
+from mc.exceptions import RemoteStepFailed
+
+
+_MARKER = '@@mc-step'
+
+
+class _StepStream(object):
+    """Stdout of a fused script, passed through to `stream' while step markers are
+    reported to the script as their lines arrive."""
+
+    def __init__(self, script, stream):
+        self.script = script
+        self.stream = stream
+        self.line = ''
+        self.results = []
+
+    def write(self, data):
+        self.stream.write(data)
+        self.line += data
+        while '\n' in self.line:
+            line, self.line = self.line.split('\n', 1)
+            result = self.script._parse_marker(line)
+            if result is not None:
+                self.results.append(result)
+                self.script.on_step(result)
+
+    def flush(self):
+        self.stream.flush()
+
+
+class RemoteScript(object):
+    """
+    Shell steps of one fabtask, run on the current host.
+
+    With MC_FUSED_SCRIPTS the steps are sent as one script over one SSH channel,
+    otherwise each step is a `run()' of its own. Either way the steps run in order,
+    the first failing checked step stops the script (like `set -e') and raises
+    `RemoteStepFailed', and every step reports its exit code and duration, to
+    `on_step' as soon as it is done if given. Quiet fused scripts report their
+    steps when the whole script is done.
+    """
+
+    def __init__(self, quiet=False, on_step=None):
+        self.quiet = quiet
+        self.on_step = on_step
+        self.steps = []
+
+    def step(self, name, command, check=True):
+        """Add `command' as step `name', its failure is ignored unless `check'."""
+        self.steps.append((name, command, check))
+
+    def render(self):
+        lines = []
+        for i, (name, command, check) in enumerate(self.steps):
+            # Every step runs in a subshell so `cd' and `exit' stay inside the step
+            line = '__mc_t=$(date +%s%N); ( ' + command + ' ); __mc_rc=$?; ' \
+                   'echo; echo "' + _MARKER + ' ' + str(i) + ' $__mc_rc $(( ($(date +%s%N) - __mc_t) / 1000 ))"'
+            if check:
+                line += '; [ $__mc_rc -eq 0 ] || exit $__mc_rc'
+            lines.append(line)
+        return '\n'.join(lines)
+
+    def run(self):
+        """Run the steps, return a list of dicts with step name, exit code and seconds."""
+        if settings.MC_FUSED_SCRIPTS:
+            return self._run_fused()
+        return self._run_stepwise()
+
+    def _run_stepwise(self):
+        results = []
+        for name, command, check in self.steps:
+            start = time.time()
+            output = run(command, quiet=self.quiet, warn_only=True)
+            results.append({'step': name, 'exit_code': output.return_code,
+                            'seconds': time.time() - start})
+            if self.on_step:
+                self.on_step(results[-1])
+            if check and output.failed:
+                raise RemoteStepFailed(name, output.return_code, command, output, results)
+        return results
+
+    def _parse_marker(self, line):
+        if _MARKER not in line:
+            return None
+        i, exit_code, micros = line[line.find(_MARKER):].split()[1:4]
+        return {'step': self.steps[int(i)][0], 'exit_code': int(exit_code),
+                'seconds': int(micros) / 1000000.0}
+
+    def _run_fused(self):
+        if self.on_step:
+            stream = _StepStream(self, sys.stdout)
+            output = run(self.render(), quiet=self.quiet, warn_only=True, stdout=stream)
+            reported = len(stream.results)
+        else:
+            output = run(self.render(), quiet=self.quiet, warn_only=True)
+        results = []
+        lines = []
+        for line in output.splitlines():
+            result = self._parse_marker(line)
+            if result is not None:
+                lines.append(line[:line.find(_MARKER)])
+                results.append(result)
+            else:
+                lines.append(line)
+        if self.on_step:
+            # Steps whose output was hidden, or not written to the stream
+            for result in results[reported:]:
+                self.on_step(result)
+        if output.failed:
+            if results and results[-1]['exit_code'] == output.return_code:
+                name, command, check = self.steps[len(results) - 1]
+            else:
+                # Killed before the step reported, blame the step which did not report
+                name, command, check = self.steps[min(len(results), len(self.steps) - 1)]
+            raise RemoteStepFailed(name, output.return_code, command, '\n'.join(lines), results)
+        return results
+
+
+# Local Variables: **
+# comment-column: 56 **
+# indent-tabs-mode: nil **
+# python-indent: 4 **
+# End: **
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+from contextlib import contextmanager
+
+from fabric.network import HostConnectionCache, connect, normalize, normalize_to_string
+
+
+class ConnectionPool(HostConnectionCache):
+    """
+    Fabric connection cache keeping SSH connections of this worker process open
+    across tasks and requests.
+
+    Connections idle for more than `idle_timeout' seconds are closed, a connection
+    is checked before it is handed out again, and at most `max_per_host'
+    connections (different users or ports) are kept open to one address.
+
+    Threads share the connections. Connections used within `holding' are never
+    evicted for being idle or for the per-address limit until the block ends,
+    so a long command of one operation keeps its connection whatever other
+    threads do meanwhile. Handshakes of different hosts run at the same time.
+    """
+
+    def __init__(self, idle_timeout=300, max_per_host=4):
+        HostConnectionCache.__init__(self)
+        self.idle_timeout = idle_timeout
+        self.max_per_host = max_per_host
+        self._last_used = {}
+        self._lock = threading.RLock()
+        self._connecting = {}
+        self._holders = {}
+        self._local = threading.local()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.handshake_seconds = 0.0
+
+    def connect(self, key):
+        user, host, port = normalize(key)
+        key = normalize_to_string(key)
+        with self._lock:
+            same_host = [k for k in self.keys() if normalize(k)[1] == host]
+            evictable = [k for k in same_host if k not in self._holders]
+            while evictable and len(same_host) >= self.max_per_host:
+                oldest = min(evictable, key=lambda k: self._last_used.get(k, 0))
+                self._evict(oldest)
+                same_host.remove(oldest)
+                evictable.remove(oldest)
+        start = time.time()
+        client = connect(user, host, port, cache=self)
+        with self._lock:
+            self.handshake_seconds += time.time() - start
+            dict.__setitem__(self, key, client)
+            self._last_used[key] = time.time()
+
+    def __getitem__(self, key):
+        key = normalize_to_string(key)
+        with self._lock:
+            connecting = self._connecting.setdefault(key, threading.Lock())
+        with connecting:                                # one handshake per key at a time
+            with self._lock:
+                self.evict_idle()
+                if key in self and self._is_healthy(dict.__getitem__(self, key)):
+                    self.hits += 1
+                    self._last_used[key] = time.time()
+                    self._hold(key)
+                    return dict.__getitem__(self, key)
+                if key in self:
+                    self._evict(key)
+                self.misses += 1
+            self.connect(key)
+            with self._lock:
+                self._hold(key)
+                return dict.__getitem__(self, key)
+
+    @contextmanager
+    def holding(self):
+        """Hold the connections the current thread gets within the block."""
+        held = set()
+        stack = self._local.__dict__.setdefault('held', [])
+        stack.append(held)
+        try:
+            yield
+        finally:
+            stack.pop()
+            with self._lock:
+                for key in held:
+                    self._holders[key] -= 1
+                    if not self._holders[key]:
+                        del self._holders[key]
+
+    def _hold(self, key):
+        stack = getattr(self._local, 'held', None)
+        if stack and key not in stack[-1]:
+            stack[-1].add(key)
+            self._holders[key] = self._holders.get(key, 0) + 1
+
+    def __delitem__(self, key):
+        key = normalize_to_string(key)
+        self._last_used.pop(key, None)
+        dict.__delitem__(self, key)
+
+    def pop(self, key, *default):
+        key = normalize_to_string(key)
+        self._last_used.pop(key, None)
+        return dict.pop(self, key, *default)
+
+    def _is_healthy(self, client):
+        transport = client.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        try:
+            transport.send_ignore()
+        except Exception:
+            return False
+        return True
+
+    def _evict(self, key):
+        client = dict.__getitem__(self, key)
+        del self[key]
+        self.evictions += 1
+        try:
+            client.close()
+        except Exception:
+            pass
+
+    def evict_idle(self):
+        deadline = time.time() - self.idle_timeout
+        with self._lock:
+            for key in [k for k in self.keys()
+                        if self._last_used.get(k, 0) < deadline and k not in self._holders]:
+                self._evict(key)
+
+    def stats(self):
+        with self._lock:
+            handshakes = self.misses or 1
+            return {
+                'open': len(self),
+                'held': len(self._holders),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'handshake_seconds': self.handshake_seconds,
+                # Every hit is a handshake that did not happen
+                'saved_seconds': self.hits * self.handshake_seconds / handshakes,
+            }
+
+
+def install_connection_pool(pool):
+    """Make Fabric use `pool' for all of its connections."""
+    from fabric import state, operations, context_managers, sftp
+    for module in (state, operations, context_managers, sftp):
+        module.connections = pool
+
+
+# Local Variables: **
+# comment-column: 56 **
+# indent-tabs-mode: nil **
+# python-indent: 4 **
+# End: **
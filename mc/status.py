@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+from django.conf import settings
+from django.core.cache import cache
+
+from mc.models import YigoInstance
+from mc.utils import get_host
+
+
+def _cache_key(pk):
+    return 'mc:running:%s' % (pk,)
+
+
+def invalidate(*pks):
+    """Forget cached running states, e.g. after starting or stopping instances."""
+    cache.delete_many([_cache_key(pk) for pk in pks])
+
+
+def probe(pks, refresh=False, timeout=None):
+    """
+    Running states of instances `pks'.
+
+    States are read from the cache unless `refresh' is set. Missing states are
+    probed with one remote command per yigo host (see fabtask
+    `probe_yigo_instances'), hosts in parallel, and cached for MC_STATUS_TTL
+    seconds. Instances of hosts not answering within `timeout' seconds get a
+    `multiprocessing.TimeoutError'.
+
+    Returns
+    -------
+    (running, errors) : dict of pk to bool, dict of pk to the exception raised
+    """
+    running = {}
+    errors = {}
+    if not refresh:
+        cached = cache.get_many([_cache_key(pk) for pk in pks])
+        for pk in pks:
+            if _cache_key(pk) in cached:
+                running[pk] = cached[_cache_key(pk)]
+    missing = [pk for pk in pks if pk not in running]
+    if not missing:
+        return running, errors
+
+    fresh = {}
+    plan = {}
+    instances = YigoInstance.objects.select_related('yigo_host').in_bulk(missing)
+    for pk in missing:
+        instance = instances.get(pk)
+        if instance is None:
+            errors[pk] = YigoInstance.DoesNotExist('YigoInstance %s does not exist' % (pk,))
+        elif instance.installed and instance.database_installed:
+            plan.setdefault(get_host(instance), []).append(instance)
+        else:
+            fresh[pk] = False
+    if plan:
+        from mc.manager import executor
+        outcome = executor.execute_plan('probe_yigo_instances', plan, timeout=timeout)
+        for host, host_instances in plan.items():
+            host_result = outcome.get(host)
+            for instance in host_instances:
+                if isinstance(host_result, dict):
+                    fresh[instance.pk] = host_result.get(instance.pk, False)
+                else:
+                    errors[instance.pk] = host_result
+    cache.set_many(dict((_cache_key(pk), value) for pk, value in fresh.items()),
+                   settings.MC_STATUS_TTL)
+    running.update(fresh)
+    return running, errors
+
+
+# Local Variables: **
+# comment-column: 56 **
+# indent-tabs-mode: nil **
+# python-indent: 4 **
+# End: **
@@ -1,15 +1,43 @@
+import json
+import os
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.cache import cache
 from django.test import TestCase
 
 from mc.exceptions import *
 from mc.models import *
+import mc.cache
+import mc.manager
 from mc.manager import Manager
+from mc.jobs import claim_job, run_job, claim_batch_job, run_batch_job
+from mc import sshpool, status, scripts, fabtasks, events, metrics
+from mc.journal import load_journal, apply_progress
+from mc.locks import Leases
+from mc.jsonrpc import JsonRpc, publicmethod
 
 
 CONFIGS_SOURCE = 'http://1.1.2.154/software/yigo/config-tutorial-20140721.tar.gz'
 TEST_HOST = '1.1.2.193'
 
+# Keep the metrics and the cache entries of test runs out of MC_METRICS_DIR and CACHES
+metrics.use_scratch_dir()
+CACHE_DIR = mc.cache.use_scratch_dir()
+
+
+def emit_in_other_process(pk, event):
+    """Emit progress event `event' of instance `pk' from a process of its own, as a job worker does."""
+    code = 'from mc import events, cache; cache.use_dir(%r); events.emit(%d, %r)' % (CACHE_DIR, pk, event,)
+    subprocess.check_call([sys.executable, '-c', code],
+                          cwd=settings.BASE_DIR, env=dict(os.environ, DJANGO_SETTINGS_MODULE='yigo_runtime.settings'))
+
 
-class ManagerTests(TestCase):
+class McTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
 
     def _create_yigo_host(self, address, max_instances=1):
         self.yigo_host = YigoHost(address=address, ssh_user='cloud', max_instances=max_instances,
@@ -35,6 +63,9 @@ class ManagerTests(TestCase):
         self._create_yigo_env('20140721')
         self._create_java_env('1.6')
 
+
+class ManagerTests(McTestCase):
+
     def test_no_yigo_hosts_when_creating(self):
         self._create_database_host(TEST_HOST, 1)
         self._create_yigo_env('20140721')
@@ -96,6 +127,77 @@ class ManagerTests(TestCase):
         self.assertFalse(instance.installed)
         self.assertFalse(instance.database_installed)
 
+    def test_sparest_host_skips_full_hosts(self):
+        self._setup()
+        full_host = self.yigo_host
+        self.database_host.max_instances = 3
+        self.database_host.save()
+        Manager().create('t1', CONFIGS_SOURCE)
+        self._create_yigo_host(TEST_HOST, 3)
+        Manager().create('t2', CONFIGS_SOURCE)
+        result = Manager().create('t3', CONFIGS_SOURCE)
+        instance = YigoInstance.objects.get(pk=result['id'])
+        self.assertEqual(self.yigo_host, instance.yigo_host)
+        self.assertEqual(1, full_host.instance_set.count())
+
+    def test_sparest_host_in_one_query(self):
+        self._setup()
+        for i in range(5):
+            self._create_yigo_host(TEST_HOST, 2)
+        self.assertNumQueries(1, Manager()._find_sparest_host, YigoHost)
+
+    def test_service_ports_after_creating(self):
+        self._setup()
+        self.yigo_host.max_instances = 3
+        self.yigo_host.save()
+        self.database_host.max_instances = 3
+        self.database_host.save()
+        ports = [YigoInstance.objects.get(pk=Manager().create(code, CONFIGS_SOURCE)['id']).service_port
+                 for code in ('t1', 't2')]
+        self.assertEqual([8000, 8001], ports)
+
+    def test_service_port_released_after_deleting(self):
+        self._setup()
+        self.yigo_host.max_instances = 3
+        self.yigo_host.save()
+        self.database_host.max_instances = 3
+        self.database_host.save()
+        manager = Manager()
+        first = manager.create('t1', CONFIGS_SOURCE)
+        manager.create('t2', CONFIGS_SOURCE)
+        YigoInstance.objects.get(pk=first['id']).delete()
+        result = manager.create('t3', CONFIGS_SOURCE)
+        self.assertEqual(8000, YigoInstance.objects.get(pk=result['id']).service_port)
+
+    def test_service_ports_after_moving(self):
+        self._setup()
+        YigoHost.objects.update(max_instances=3)
+        DatabaseHost.objects.update(max_instances=4)
+        manager = Manager()
+        moved = [manager.create(code, CONFIGS_SOURCE)['id'] for code in ('t1', 't2')][1]
+        old_host = self.yigo_host
+        self._create_yigo_host('1.1.2.194', 3)
+        instance = YigoInstance.objects.get(pk=moved)
+        instance.yigo_host = self.yigo_host
+        instance.save()
+        for code in ('t3', 't4'):
+            manager.create(code, CONFIGS_SOURCE)
+        for host in (old_host, self.yigo_host):
+            self.assertEqual(sorted(host.instance_set.values_list('service_port', flat=True)),
+                             sorted(host.service_port_set.filter(claimed=True).values_list('port', flat=True)))
+        self.assertEqual([8000, 8001], sorted(old_host.instance_set.values_list('service_port', flat=True)))
+
+    def test_moving_onto_held_service_port_rejected(self):
+        self._setup()
+        YigoHost.objects.update(max_instances=2)
+        DatabaseHost.objects.update(max_instances=2)
+        pks = [Manager().create(code, CONFIGS_SOURCE)['id'] for code in ('t1', 't2')]
+        instance = YigoInstance.objects.get(pk=pks[1])
+        instance.service_port = 8000
+        self.assertRaises(ServicePortTaken, instance.save)
+        self.assertEqual([8000, 8001], list(ServicePort.objects.filter(claimed=True).order_by('port')
+                                                              .values_list('port', flat=True)))
+
     def test_hosts_refs_after_creating(self):
         self._setup()
         result = Manager().create('t1', CONFIGS_SOURCE)
@@ -154,3 +256,976 @@ class ManagerTests(TestCase):
             manager.install(result['id'])
         except RuntimeError, e:
             self.assertTrue(e.message.find('20140720') > -1)
+
+    def test_batch_errors_per_instance(self):
+        self._setup()
+        manager = Manager()
+        result = manager.create('t1', CONFIGS_SOURCE)
+        results = manager.start_many([result['id'], result['id'] + 1])
+        self.assertEqual(InstanceNotInstalled.__name__, results[0]['error'])
+        self.assertEqual(YigoInstance.DoesNotExist.__name__, results[1]['error'])
+        self.assertFalse(YigoInstance.objects.get(pk=result['id']).busy)
+        self.assertEqual([False], [r['result'] for r in manager.is_running_many([result['id']])])
+
+    def test_batch_databases_errors_per_instance(self):
+        self._setup()
+        results = Manager().uninstall_databases_many([1000])
+        self.assertEqual(YigoInstance.DoesNotExist.__name__, results[0]['error'])
+
+    def test_running_state_cached(self):
+        self._setup()
+        result = Manager().create('t1', CONFIGS_SOURCE)
+        self.assertFalse(Manager().is_running(result['id']))
+        self.assertNumQueries(0, Manager().is_running, result['id'])
+        status.invalidate(result['id'])
+        self.assertNumQueries(1, Manager().is_running, result['id'])
+
+
+class OccupancyTests(McTestCase):
+
+    def setUp(self):
+        McTestCase.setUp(self)
+        self._setup()
+        YigoHost.objects.update(max_instances=3)
+        DatabaseHost.objects.update(max_instances=3)
+
+    def _counters(self, host):
+        host = host.__class__.objects.get(pk=host.pk)
+        return host.num_instances, getattr(host, 'reserved_heap', None)
+
+    def test_counters_follow_instances(self):
+        pks = [Manager().create(code, CONFIGS_SOURCE)['id'] for code in ('t1', 't2')]
+        self.assertEqual((2, 512), self._counters(self.yigo_host))
+        self.assertEqual((2, None), self._counters(self.database_host))
+        old_host = self.yigo_host
+        self._create_yigo_host(TEST_HOST)
+        instance = YigoInstance.objects.get(pk=pks[0])
+        instance.yigo_host = self.yigo_host
+        instance.save()
+        self.assertEqual([(1, 256), (1, 256)], [self._counters(old_host), self._counters(self.yigo_host)])
+        YigoInstance.objects.get(pk=pks[1]).delete()
+        self.assertEqual((0, 0), self._counters(old_host))
+        self.assertEqual((1, None), self._counters(self.database_host))
+
+    def test_full_host_rejected(self):
+        DatabaseHost.objects.update(max_instances=1)
+        Manager().create('t1', CONFIGS_SOURCE)
+        instance = YigoInstance(external_id='t2', yigo_host=self.yigo_host, database_host=self.database_host,
+                                configs_source=CONFIGS_SOURCE, service_port=9000,
+                                yigo_env=self.yigo_env, java_env=self.java_env)
+        self.assertRaises(NoMoreSpareHosts, instance.save)
+        self.assertEqual((1, 256), self._counters(self.yigo_host))
+
+    def test_saving_host_keeps_counters(self):
+        Manager().create('t1', CONFIGS_SOURCE)
+        self.yigo_host.address = '1.1.2.194'
+        self.yigo_host.save()
+        self.assertEqual((1, 256), self._counters(self.yigo_host))
+
+    def test_checker_claims_missing_service_ports(self):
+        from mc import occupancy
+        Manager().create('t1', CONFIGS_SOURCE)
+        ServicePort.objects.all().delete()
+        self.assertEqual([('service port 8000', 'unclaimed', 'used')],
+                         [(field, counted, actual) for host, field, counted, actual in occupancy.check(fix=True)])
+        self.assertEqual([], occupancy.check())
+        pk = Manager().create('t2', CONFIGS_SOURCE)['id']
+        self.assertEqual(8001, YigoInstance.objects.get(pk=pk).service_port)
+
+    def test_heap_size_change_moves_reserved_heap(self):
+        from mc import occupancy
+        for code in ('t1', 't2'):
+            Manager().create(code, CONFIGS_SOURCE)
+        self.yigo_host.heap_size = 1024
+        self.yigo_host.save()
+        self.assertEqual((2, 2048), self._counters(self.yigo_host))
+        self.assertEqual([], occupancy.check())
+
+    def test_checker_rebuilds_counters(self):
+        from mc import occupancy
+        Manager().create('t1', CONFIGS_SOURCE)
+        YigoHost.objects.update(num_instances=5)
+        self.assertEqual([('num_instances', 5, 1)],
+                         [(field, counted, actual) for host, field, counted, actual in occupancy.check()])
+        occupancy.check(fix=True)
+        self.assertEqual([], occupancy.check())
+        self.assertEqual((1, 256), self._counters(self.yigo_host))
+
+
+class DirtyFieldsTests(McTestCase):
+
+    def setUp(self):
+        McTestCase.setUp(self)
+        self._setup()
+        self.pk = Manager().create('t1', CONFIGS_SOURCE)['id']
+
+    def test_changed_fields(self):
+        instance = YigoInstance.objects.get(pk=self.pk)
+        self.assertEqual([], instance.changed_fields())
+        instance.installed = True
+        instance.service_port = instance.service_port
+        self.assertEqual(['installed'], instance.changed_fields())
+        instance.save()
+        self.assertEqual([], instance.changed_fields())
+
+    def test_save_writes_changed_columns_only(self):
+        from django.db import connection
+        instance = YigoInstance.objects.get(pk=self.pk)
+        YigoInstance.objects.filter(pk=self.pk).update(busy=True)
+        instance.installed = True
+        with self.assertNumQueries(1):
+            instance.save()
+        self.assertNotIn('busy', connection.queries[-1]['sql'])
+        instance = YigoInstance.objects.get(pk=self.pk)
+        self.assertEqual((True, True), (instance.installed, instance.busy))
+
+    def test_host_change_needs_no_query(self):
+        instance = YigoInstance.objects.get(pk=self.pk)
+        self._create_yigo_host(TEST_HOST)
+        instance.yigo_host = self.yigo_host
+        from django.test.utils import CaptureQueriesContext
+        from django.db import connection
+        # Hosts and ports are claimed and released, the instance row is never read
+        with CaptureQueriesContext(connection) as queries:
+            instance.save()
+        self.assertFalse([query for query in queries.captured_queries
+                          if query['sql'].startswith('SELECT') and 'mc_yigoinstance' in query['sql']])
+        self.assertEqual(1, YigoHost.objects.get(pk=self.yigo_host.pk).num_instances)
+
+
+class LeaseTests(McTestCase):
+
+    def setUp(self):
+        McTestCase.setUp(self)
+        self._setup()
+        self.pk = Manager().create('t1', CONFIGS_SOURCE)['id']
+
+    def test_busy_while_leased(self):
+        leases = Leases('first')
+        leases.acquire(self.pk)
+        self.assertTrue(YigoInstance.objects.get(pk=self.pk).busy)
+        self.assertRaises(InstanceIsBusy, Leases('second').acquire, self.pk)
+        leases.release_all()
+        self.assertFalse(YigoInstance.objects.get(pk=self.pk).busy)
+        Leases('second').acquire(self.pk).delete()
+
+    def test_expired_lease_reclaimed(self):
+        from django.utils import timezone
+        Lease.objects.create(instance_id=self.pk, owner='dead', held=True, expires=timezone.now())
+        leases = Leases('second')
+        leases.acquire(self.pk)
+        leases.release_all()
+
+    def test_waiting_callers_served_in_order(self):
+        from datetime import timedelta
+        from django.utils import timezone
+        Lease.objects.create(instance_id=self.pk, owner='waiting', expires=timezone.now() + timedelta(60))
+        self.assertRaises(InstanceIsBusy, Leases('second').acquire, self.pk)
+        self.assertEqual(['waiting'], [lease.owner for lease in Lease.objects.filter(instance=self.pk)])
+
+    def test_busy_method_raises(self):
+        leases = Leases('first')
+        leases.acquire(self.pk)
+        self.assertRaises(InstanceIsBusy, Manager().start, self.pk)
+        leases.release_all()
+
+
+class InstallJournalTests(McTestCase):
+
+    def setUp(self):
+        McTestCase.setUp(self)
+        self._setup()
+        self.instance = YigoInstance.objects.get(pk=Manager().create('t1', CONFIGS_SOURCE)['id'])
+        self.created = []
+        self.lookups = []
+        self._patched = (fabtasks._get_configs_checksum, fabtasks.create_yigo_instance,
+                         fabtasks.run, fabtasks._is_yigo_instance_running, scripts.RemoteScript.run)
+        fabtasks._get_configs_checksum = lambda instance: 'checksum'
+        fabtasks.create_yigo_instance = lambda instance, steps: self.created.append(steps)
+        fabtasks.run = lambda command, **kwargs: None
+        fabtasks._is_yigo_instance_running = lambda instance: self.lookups.append(instance.pk) or False
+        scripts.RemoteScript.run = lambda script: []
+
+    def tearDown(self):
+        (fabtasks._get_configs_checksum, fabtasks.create_yigo_instance,
+         fabtasks.run, fabtasks._is_yigo_instance_running, scripts.RemoteScript.run) = self._patched
+
+    def _install(self):
+        progress = {}
+        redo = fabtasks.install_yigo_instance(self.instance, load_journal(self.instance), progress)
+        apply_progress(self.instance.pk, progress)
+        self.instance = YigoInstance.objects.get(pk=self.instance.pk)
+        return redo
+
+    def _finish_install(self):
+        fingerprints = fabtasks.get_install_fingerprints(self.instance, 'checksum')
+        apply_progress(self.instance.pk, {'installed': True, 'database_installed': True, 'journal': fingerprints})
+        self.instance = YigoInstance.objects.get(pk=self.instance.pk)
+
+    def test_nothing_redone(self):
+        self._finish_install()
+        self.assertEqual([], self._install())
+        self.assertEqual([], self.created)
+
+    def test_changed_configs_redone(self):
+        self._finish_install()
+        YigoInstance.objects.filter(pk=self.instance.pk).update(configs_source=CONFIGS_SOURCE + '?v=2')
+        self.instance = YigoInstance.objects.get(pk=self.instance.pk)
+        self.assertEqual(['configs'], self._install())
+        self.assertEqual([['configs']], self.created)
+        self.assertEqual([], self._install())
+
+    def test_changed_password_rewrites_launcher(self):
+        self._finish_install()
+        YigoInstance.objects.filter(pk=self.instance.pk).update(database_password='changed')
+        self.instance = YigoInstance.objects.get(pk=self.instance.pk)
+        self.assertEqual(['database', 'launcher'], self._install())
+        self.assertEqual([['launcher']], self.created)
+
+    def test_launcher_written_when_changed(self):
+        self._finish_install()
+        self.instance.install_journal = load_journal(self.instance)
+        progress = {}
+        self.assertEqual("'apps/%s/bin/yigo' status" % (self.instance.pk,),
+                         fabtasks._launcher_command(self.instance, 'status', progress))
+        self.assertEqual({}, progress)
+        self.instance.jvm_profile = JvmProfile(options='-server -XX:+UseG1GC')
+        self.assertTrue('UseG1GC' in fabtasks._launcher_command(self.instance, 'status', progress))
+        self.assertEqual({'journal': {'launcher': fabtasks._get_launcher_fingerprint(self.instance)}}, progress)
+
+    def test_unfinished_steps_redone(self):
+        self._finish_install()
+        apply_progress(self.instance.pk, {'installed': False, 'journal': {'configs': None}})
+        self.instance = YigoInstance.objects.get(pk=self.instance.pk)
+        self.assertEqual(['release', 'log4j', 'configs', 'launcher'], self._install())
+        self.assertTrue(self.instance.installed)
+
+    def test_running_state_looked_up_once(self):
+        self.assertEqual(['database', 'release', 'log4j', 'configs', 'launcher'], self._install())
+        self.assertEqual([self.instance.pk], self.lookups)
+
+
+class EventTests(McTestCase):
+
+    def setUp(self):
+        McTestCase.setUp(self)
+        self._setup()
+        self.pk = Manager().create('t1', CONFIGS_SOURCE)['id']
+
+    def test_failed_operation(self):
+        self.assertRaises(InstanceNotInstalled, Manager().start, self.pk)
+        self.assertEqual([('started', 'start'), ('failed', 'start')],
+                         [(e['event'], e['operation']) for e in events.since(self.pk)])
+        self.assertEqual('InstanceNotInstalled', events.since(self.pk)[-1]['error'])
+
+    def test_emitted_by_another_process(self):
+        emit_in_other_process(self.pk, 'jvm launched')
+        self.assertEqual(['jvm launched'], [e['event'] for e in events.since(self.pk)])
+
+    def test_buffer_bounded(self):
+        with self.settings(MC_EVENTS_BUFFER=3):
+            for i in range(5):
+                events.emit(self.pk, 'step %s' % (i,))
+        buffered = events.since(self.pk)
+        self.assertEqual(['step 2', 'step 3', 'step 4'], [e['event'] for e in buffered])
+        self.assertEqual(['step 4'], [e['event'] for e in events.since(self.pk, buffered[1]['id'])])
+
+    def test_replayed_to_late_subscriber(self):
+        events.emit(self.pk, 'jvm launched')
+        events.emit(self.pk, 'jvm stopped')
+        first = events.since(self.pk)[0]['id']
+        with self.settings(MC_EVENTS_STREAM_SECONDS=0):
+            response = self.client.get('/mc/events/%s/' % (self.pk,), HTTP_LAST_EVENT_ID=str(first))
+            content = ''.join(response.streaming_content)
+        self.assertEqual('text/event-stream', response['Content-Type'])
+        self.assertFalse('jvm launched' in content)
+        self.assertTrue('event: jvm stopped' in content)
+
+
+class SharedFileCacheTests(TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.dirname = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.dirname)
+
+    def test_entries_counted_once_per_interval(self):
+        shared = mc.cache.SharedFileCache(self.dirname, {'OPTIONS': {'MAX_ENTRIES': 1, 'CULL_INTERVAL': 60}})
+        for key in ('a', 'b', 'c'):
+            shared.set(key, key)
+        self.assertEqual(['a', 'b', 'c'], [shared.get(key) for key in ('a', 'b', 'c')])
+        shared._next_cull = 0
+        shared.set('d', 'd')
+        self.assertTrue(None in [shared.get(key) for key in ('a', 'b', 'c')])
+
+
+class SimulatorTests(McTestCase):
+    """Instance lifecycle against a host simulated on this machine."""
+
+    def setUp(self):
+        import tempfile
+        McTestCase.setUp(self)
+        self._setup()
+        self.root = tempfile.mkdtemp()
+        self._settings = self.settings(MC_EXECUTION_BACKEND='mc.backends.SimulatorBackend',
+                                       MC_SIMULATOR_ROOT=self.root)
+        self._settings.enable()
+        self.pk = Manager().create('t1', CONFIGS_SOURCE)['id']
+
+    def tearDown(self):
+        import glob, shutil, signal
+        for pid_filename in glob.glob(os.path.join(self.root, 'hosts', '*', '*', '*', 'tmp', 'pid')):
+            try:
+                os.kill(int(open(pid_filename).read()), signal.SIGKILL)
+            except OSError:
+                pass
+        self._settings.disable()
+        shutil.rmtree(self.root)
+
+    def test_lifecycle(self):
+        from fabric.api import hide
+        manager = Manager()
+        with hide('everything'):
+            self.assertEqual(['database', 'release', 'log4j', 'configs', 'launcher'], manager.install(self.pk))
+            self.assertEqual([], manager.install(self.pk))
+            manager.start(self.pk)
+            self.assertTrue(manager.is_running(self.pk, refresh=True))
+            self.assertRaises(InstanceIsRunning, manager.uninstall, self.pk)
+            self.assertTrue('-Dyigo.instance=t1' in manager.tail_log(self.pk)['data'])
+            manager.stop(self.pk)
+            self.assertFalse(manager.is_running(self.pk, refresh=True))
+            manager.uninstall(self.pk)
+        instance = YigoInstance.objects.get(pk=self.pk)
+        self.assertFalse(instance.installed or instance.database_installed)
+
+    def test_batch_install_refuses_running_instance(self):
+        from fabric.api import hide
+        manager = Manager()
+        with hide('everything'):
+            manager.install(self.pk)
+            manager.start(self.pk)
+            YigoInstance.objects.filter(pk=self.pk).update(configs_source=CONFIGS_SOURCE + '?v=2')
+            self.assertEqual(['InstanceIsRunning'], [result['error'] for result in manager.install_many([self.pk])])
+            manager.stop(self.pk)
+            self.assertEqual(['configs'], manager.install(self.pk))
+
+    def test_stop_instance_installed_before_launchers(self):
+        import glob, shutil
+        from fabric.api import hide
+        manager = Manager()
+        with hide('everything'):
+            manager.install(self.pk)
+            manager.start(self.pk)
+            shutil.rmtree(glob.glob(os.path.join(self.root, 'hosts', '*', 'apps', str(self.pk), 'bin'))[0])
+            InstallStep.objects.filter(instance=self.pk, step='launcher').delete()
+            self.assertTrue(manager.is_running(self.pk, refresh=True))
+            manager.stop(self.pk)
+            self.assertFalse(manager.is_running(self.pk, refresh=True))
+
+    def _configs_cache_path(self):
+        import glob
+        return glob.glob(os.path.join(self.root, 'hosts', '*', '*', '.configs-cache'))[0]
+
+    def test_configs_cache_evicts_least_recently_used(self):
+        import time
+        from fabric.api import hide
+        YigoHost.objects.update(max_instances=2)
+        DatabaseHost.objects.update(max_instances=2)
+        pks = [self.pk, Manager().create('t2', CONFIGS_SOURCE)['id']]
+        manager = Manager()
+        with hide('everything'):
+            manager.install(pks[0])
+            cache_path = self._configs_cache_path()
+            sha = [name for name in os.listdir(cache_path) if len(name) == 64][0]
+            for i, name in enumerate(('a' * 64, 'b' * 64,)):
+                with open(os.path.join(cache_path, name), 'w') as f:
+                    f.write('x' * 100)
+                os.utime(f.name, (time.time() - 100 + i, time.time() - 100 + i))
+            size = os.path.getsize(os.path.join(cache_path, sha))
+            with self.settings(MC_CONFIGS_CACHE_MAX_BYTES=size + 150):
+                manager.install(pks[1])
+        self.assertEqual(sorted(['b' * 64, sha]), sorted([name for name in os.listdir(cache_path) if len(name) == 64]))
+
+    def test_configs_cache_downloads_once_for_concurrent_creates(self):
+        import threading
+        from mc.manager import executor
+        from mc.utils import get_host
+        from fabric.api import hide
+        YigoHost.objects.update(max_instances=2)
+        DatabaseHost.objects.update(max_instances=2)
+        pks = [self.pk, Manager().create('t2', CONFIGS_SOURCE)['id']]
+        instances = YigoInstance.objects.select_related('yigo_host', 'yigo_env', 'java_env', 'database_host') \
+                                        .filter(pk__in=pks)
+        errors = []
+        def create(instance):
+            try:
+                with hide('everything'):
+                    executor.execute('create_yigo_instance', get_host(instance), instance)
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=create, args=(instance,)) for instance in instances]
+        with self.settings(MC_SIMULATOR_DOWNLOAD=0.5):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual([], errors)
+        with open(os.path.join(self._configs_cache_path(), '..', '..', 'wget.log')) as f:
+            self.assertEqual([CONFIGS_SOURCE], f.read().splitlines())
+
+    def test_batch_databases_with_one_existing(self):
+        import glob
+        from fabric.api import hide
+        YigoHost.objects.update(max_instances=2)
+        DatabaseHost.objects.update(max_instances=2)
+        pks = [self.pk, Manager().create('t2', CONFIGS_SOURCE)['id']]
+        manager = Manager()
+        with hide('everything'):
+            manager.install_databases_many(pks[:1])
+            # Left over by an earlier run which failed, the admin gives a new password
+            YigoInstance.objects.filter(pk=pks[0]).update(database_installed=False, database_password='fresh')
+            self.assertEqual([None, None], [result['error'] for result in manager.install_databases_many(pks)])
+        self.assertEqual(2, YigoInstance.objects.filter(pk__in=pks, database_installed=True).count())
+        user = YigoInstance.objects.get(pk=pks[0]).database_user()
+        with open(glob.glob(os.path.join(self.root, 'hosts', '*', '.mysql', 'users', user))[0]) as f:
+            self.assertEqual('fresh', f.read().strip())
+
+    def test_start_rewrites_changed_launcher(self):
+        from fabric.api import hide
+        manager = Manager()
+        with hide('everything'):
+            manager.install(self.pk)
+            JvmProfile.objects.create(yigo_env=self.yigo_env, java_env=self.java_env, options='-server -Dmc.profile=2')
+            manager.start(self.pk)
+            self.assertTrue('-Dmc.profile=2' in manager.tail_log(self.pk)['data'])
+            manager.stop(self.pk)
+            # The journal has the launcher written by start, install has nothing left to do
+            self.assertEqual([], manager.install(self.pk))
+
+    def test_batch_on_two_hosts(self):
+        from fabric.api import hide
+        self._create_yigo_host('1.1.2.194')
+        self._create_database_host('1.1.2.194')
+        pks = [self.pk, Manager().create('t2', CONFIGS_SOURCE)['id']]
+        manager = Manager()
+        with hide('everything'):
+            self.assertEqual([None, None], [result['error'] for result in manager.install_many(pks)])
+            self.assertEqual([None, None], [result['error'] for result in manager.start_many(pks)])
+            self.assertEqual([True, True], [result['result'] for result in manager.is_running_many(pks, True)])
+            self.assertEqual([None, None], [result['error'] for result in manager.uninstall_many(pks, stop=True)])
+        self.assertFalse(YigoInstance.objects.filter(pk__in=pks, installed=True).exists())
+        self.assertFalse(InstallStep.objects.filter(instance__in=pks).exists())
+
+    def test_class_data_sharing(self):
+        from fabric.api import hide
+        YigoHost.objects.update(max_instances=2)
+        DatabaseHost.objects.update(max_instances=2)
+        JvmProfile.objects.create(yigo_env=self.yigo_env, java_env=self.java_env, class_data_sharing=True)
+        pks = [self.pk, Manager().create('t2', CONFIGS_SOURCE)['id']]
+        manager = Manager()
+        with self.settings(MC_START_READY_TIMEOUT=5), hide('everything'):
+            manager.install_many(pks)
+            first = manager.start(pks[0])
+            self.assertEqual('training', first['class_data_sharing'])
+            self.assertTrue(first['ready_seconds'] >= 0)
+            # One instance per host trains
+            self.assertEqual('off', manager.start(pks[1])['class_data_sharing'])
+            manager.stop(pks[0])
+            self.assertEqual('archive', manager.start(pks[0])['class_data_sharing'])
+            self.assertTrue('-Xshare:auto' in manager.tail_log(pks[0])['data'])
+            manager.stop_many(pks)
+
+    def test_class_data_training_taken_over_after_crash(self):
+        import glob, signal
+        from fabric.api import hide
+        YigoHost.objects.update(max_instances=2)
+        DatabaseHost.objects.update(max_instances=2)
+        JvmProfile.objects.create(yigo_env=self.yigo_env, java_env=self.java_env, class_data_sharing=True)
+        pks = [self.pk, Manager().create('t2', CONFIGS_SOURCE)['id']]
+        manager = Manager()
+        with hide('everything'):
+            manager.install_many(pks)
+            self.assertEqual('training', manager.start(pks[0])['class_data_sharing'])
+            with open(glob.glob(os.path.join(self.root, 'hosts', '*', 'apps', str(pks[0]), 'tmp', 'pid'))[0]) as f:
+                os.kill(int(f.read()), signal.SIGKILL)
+            cds = glob.glob(os.path.join(self.root, 'hosts', '*', 'apps', '.cds', '*.training'))[0][:-len('.training')]
+            with open(cds + '.classlist.part', 'w') as f:
+                f.write('partial')
+            self.assertEqual('training', manager.start(pks[1])['class_data_sharing'])
+            self.assertFalse(os.path.exists(cds + '.classlist.part'))
+            manager.stop(pks[1])
+            self.assertFalse(os.path.exists(cds + '.training'))
+            self.assertEqual('archive', manager.start(pks[0])['class_data_sharing'])
+            manager.stop_many(pks)
+
+
+class TailLogTests(McTestCase):
+
+    def setUp(self):
+        import tempfile
+        from fabric.api import local, settings
+        McTestCase.setUp(self)
+        self._setup()
+        self.root_path = tempfile.mkdtemp()
+        YigoHost.objects.update(root_path=self.root_path)
+        self.pk = Manager().create('t1', CONFIGS_SOURCE)['id']
+        self.log = '%s/%s/logs/nohup.out' % (self.root_path, self.pk,)
+        os.makedirs(os.path.dirname(self.log))
+        with open(self.log, 'w') as f:
+            f.write(''.join(['line %s\n' % (i,) for i in range(1000)]))
+        def run_locally(command, **kwargs):
+            with settings(warn_only=True):
+                return local(command, capture=True, shell='/bin/bash')
+        def execute_locally(task, *args, **kwargs):
+            return dict((host, getattr(fabtasks, task)(*args)) for host in kwargs['hosts'])
+        self._patched = (fabtasks.run, mc.manager.execute)
+        fabtasks.run = run_locally
+        mc.manager.execute = execute_locally
+
+    def tearDown(self):
+        import shutil
+        (fabtasks.run, mc.manager.execute) = self._patched
+        shutil.rmtree(self.root_path)
+
+    def test_following(self):
+        chunk = Manager().tail_log(self.pk, 0, 20)
+        self.assertEqual('line 0\nline 1\n', chunk['data'])
+        chunk = Manager().tail_log(self.pk, chunk['next_offset'], 20)
+        self.assertEqual('line 2\nline 3\n', chunk['data'])
+        chunk = Manager().tail_log(self.pk, chunk['size'])
+        self.assertEqual(('', chunk['size']), (chunk['data'], chunk['next_offset']))
+
+    def test_last_lines(self):
+        chunk = Manager().tail_log(self.pk, None, 20)
+        self.assertEqual('line 998\nline 999\n', chunk['data'])
+        self.assertEqual(chunk['size'], chunk['next_offset'])
+
+    def test_truncated_log(self):
+        with open(self.log, 'w') as f:
+            f.write('restarted\n')
+        chunk = Manager().tail_log(self.pk, 5000)
+        self.assertEqual((0, 'restarted\n'), (chunk['offset'], chunk['data']))
+
+
+class JobTests(McTestCase):
+
+    def test_submitting(self):
+        self._setup()
+        manager = Manager()
+        result = manager.create('t1', CONFIGS_SOURCE)
+        status = manager.job_status(manager.submit('install', result['id']))
+        self.assertEqual(JOB_PENDING, status['state'])
+        self.assertEqual('install', status['method'])
+
+    def test_jobs_of_instance_run_in_order(self):
+        self._setup()
+        manager = Manager()
+        result = manager.create('t1', CONFIGS_SOURCE)
+        first = manager.submit('start', result['id'])
+        manager.submit('stop', result['id'])
+        job = claim_job('test')
+        self.assertEqual(first, job.id)
+        self.assertEqual(None, claim_job('test'))
+
+    def test_job_of_lost_worker_is_failed(self):
+        from datetime import timedelta
+        from django.utils import timezone
+        self._setup()
+        manager = Manager()
+        result = manager.create('t1', CONFIGS_SOURCE)
+        first = manager.submit('start', result['id'])
+        second = manager.submit('stop', result['id'])
+        self.assertEqual(first, claim_job('dead').id)
+        self.assertEqual(None, claim_job('test'))
+        Job.objects.filter(pk=first).update(expires=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(second, claim_job('test').id)
+        status = manager.job_status(first)
+        self.assertEqual((JOB_FAILED, 'WorkerLost'), (status['state'], status['error']))
+
+    def test_failed_job(self):
+        self._setup()
+        manager = Manager()
+        result = manager.create('t1', CONFIGS_SOURCE)
+        job_id = manager.submit('start', result['id'])
+        run_job(claim_job('test'), manager)
+        status = manager.job_status(job_id)
+        self.assertEqual(JOB_FAILED, status['state'])
+        self.assertEqual(InstanceNotInstalled.__name__, status['error'])
+
+    def test_batch_job(self):
+        self._setup()
+        manager = Manager()
+        result = manager.create('t1', CONFIGS_SOURCE)
+        job_id = manager.submit_many('start_many', [result['id']])
+        self.assertEqual(None, claim_job('test'))
+        run_batch_job(claim_batch_job('test'), manager)
+        status = manager.batch_job_status(job_id)
+        self.assertEqual((JOB_SUCCEEDED, 1), (status['state'], status['done']))
+        self.assertEqual(InstanceNotInstalled.__name__, status['instances'][0]['error'])
+
+    def test_admin_action_submits_batch_job(self):
+        from django.contrib.auth.models import User
+        from django.contrib.admin import ACTION_CHECKBOX_NAME
+        self._setup()
+        pk = Manager().create('t1', CONFIGS_SOURCE)['id']
+        User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.client.login(username='admin', password='admin')
+        response = self.client.post('/admin/mc/yigoinstance/', {'action': 'install_instance',
+                                                                ACTION_CHECKBOX_NAME: [pk]})
+        job = BatchJob.objects.get()
+        self.assertEqual(('install_many', [pk]), (job.method, [instance.pk for instance in job.instances.all()]))
+        self.assertRedirects(response, '/admin/mc/yigoinstance/batch/%s/' % (job.pk,))
+        response = self.client.get('/admin/mc/yigoinstance/batch/%s/' % (job.pk,))
+        self.assertContains(response, 'http-equiv="refresh"')
+        self.assertContains(response, 't1')
+
+    def test_batch_job_page_shows_progress_of_worker(self):
+        from django.contrib.auth.models import User
+        self._setup()
+        pk = Manager().create('t1', CONFIGS_SOURCE)['id']
+        job_id = Manager().submit_many('install_many', [pk])
+        claim_batch_job('test')
+        emit_in_other_process(pk, 'configs download')
+        User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.client.login(username='admin', password='admin')
+        response = self.client.get('/admin/mc/yigoinstance/batch/%s/' % (job_id,))
+        self.assertContains(response, '<td>configs download</td>')
+        self.assertNotContains(response, '<td>pending</td>')
+
+
+class BatchMethods(object):
+
+    url = '/test/'
+
+    def __init__(self):
+        self.calls = []
+
+    @publicmethod
+    def echo(self, value, delay=0):
+        import time
+        time.sleep(delay)
+        self.calls.append(value)
+        return value
+
+    @publicmethod
+    def fail(self):
+        raise InstanceIsBusy('busy')
+
+
+class JsonRpcTests(TestCase):
+
+    def _serialize(self, rpc, request):
+        response = rpc.serialize(json.dumps(request))
+        return response and json.loads(response)
+
+    def test_batch(self):
+        import time
+        rpc = JsonRpc(BatchMethods(), error_codes=((InstanceIsBusy, -32007),), batch_workers=4)
+        start = time.time()
+        responses = self._serialize(rpc, [
+            {'jsonrpc': '2.0', 'id': 1, 'method': 'echo', 'params': ['a', 0.2]},
+            {'jsonrpc': '2.0', 'id': 2, 'method': 'echo', 'params': {'value': 'b', 'delay': 0.2}},
+            {'jsonrpc': '2.0', 'method': 'echo', 'params': ['notified']},
+            {'jsonrpc': '2.0', 'id': 3, 'method': 'fail'},
+            {'jsonrpc': '2.0', 'id': 4, 'method': 'nonexistent'},
+            {'jsonrpc': '2.0', 'id': 5, 'method': 'echo', 'params': []},
+            {'id': 6},
+        ])
+        self.assertTrue(time.time() - start < 0.4)
+        self.assertEqual([1, 2, 3, 4, 5, None], [r['id'] for r in responses])
+        self.assertEqual(['a', 'b'], [r['result'] for r in responses[:2]])
+        self.assertEqual([-32007, -32601, -32602, -32600], [r['error']['code'] for r in responses[2:]])
+        self.assertEqual('InstanceIsBusy', responses[2]['error']['data']['type'])
+        self.assertTrue('notified' in rpc.instance.calls)
+
+    def test_notifications_only(self):
+        rpc = JsonRpc(BatchMethods())
+        self.assertEqual(None, self._serialize(rpc, {'jsonrpc': '2.0', 'method': 'echo', 'params': ['a']}))
+        self.assertEqual(None, self._serialize(rpc, [{'jsonrpc': '2.0', 'method': 'echo', 'params': ['b']}]))
+        self.assertEqual(['a', 'b'], rpc.instance.calls)
+
+    def test_version_1(self):
+        rpc = JsonRpc(BatchMethods())
+        self.assertEqual({'id': 7, 'result': 'a'}, self._serialize(rpc, {'id': 7, 'method': 'echo', 'params': ['a']}))
+
+    def test_dispatching(self):
+        from mc.views import RpcMethods
+        rpc = JsonRpc(RpcMethods())
+        self.assertTrue('install_many' in rpc.get_public_methods())
+        self.assertEqual(['pk', 'refresh'], rpc.registry['is_running'].get_args())
+        self.assertEqual('no such method', rpc.dispatch('url', []))
+
+    def test_smd_not_modified(self):
+        from django.test.client import RequestFactory
+        from mc import views
+        factory = RequestFactory()
+        response = views.rpc(factory.get('/mc/rpc/'))
+        self.assertEqual(200, response.status_code)
+        self.assertTrue('create' in [m['name'] for m in json.loads(response.content)['methods']])
+        response = views.rpc(factory.get('/mc/rpc/', HTTP_IF_NONE_MATCH=response['ETag']))
+        self.assertEqual(304, response.status_code)
+
+
+class MetricsTests(McTestCase):
+
+    def setUp(self):
+        import tempfile
+        McTestCase.setUp(self)
+        self.metrics_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.metrics_dir)
+
+    def test_added_up_across_processes(self):
+        with self.settings(MC_METRICS_DIR=self.metrics_dir):
+            self.assertRaises(YigoInstance.DoesNotExist, Manager().info, 1)
+            metrics.get_registry().flush()
+            with open(os.path.join(self.metrics_dir, 'other-1.json'), 'w') as f:
+                json.dump({'counters': [['mc_lease_busy_total', [], 2]], 'histograms': []}, f)
+            other = Leases('other')
+            other.acquire(self._create_instance())
+            self.assertRaises(InstanceIsBusy, Leases().acquire, YigoInstance.objects.get().pk)
+            other.release_all()
+            metrics.get_registry().flush()
+            content = self.client.get('/mc/metrics/').content
+        self.assertTrue('mc_manager_errors_total{exception="DoesNotExist",method="info"}' in content)
+        self.assertTrue('mc_manager_seconds_count{method="info"}' in content)
+        self.assertTrue('mc_manager_seconds_bucket{method="create",le="+Inf"}' in content)
+        busy = [line for line in content.splitlines() if line.startswith('mc_lease_busy_total ')]
+        self.assertTrue(int(busy[0].split()[1]) >= 3)
+
+    def test_exited_processes_archived(self):
+        import socket
+        process = subprocess.Popen(['true'])
+        process.wait()
+        exited = os.path.join(self.metrics_dir, '%s-%s.json' % (socket.gethostname(), process.pid,))
+        with self.settings(MC_METRICS_DIR=self.metrics_dir):
+            with open(exited, 'w') as f:
+                json.dump({'counters': [['mc_lease_busy_total', [], 2]], 'histograms': []}, f)
+            metrics.collect()
+            metrics.collect()
+        self.assertFalse(os.path.exists(exited))
+        with open(os.path.join(self.metrics_dir, '%s-exited.json' % (socket.gethostname(),))) as f:
+            self.assertEqual([['mc_lease_busy_total', [], 2]], json.load(f)['counters'])
+
+    def _create_instance(self):
+        self._setup()
+        return Manager().create('t1', CONFIGS_SOURCE)['id']
+
+
+class ExecutorTests(TestCase):
+
+    def test_fabric_state_of_each_operation(self):
+        import threading
+        from fabric.api import env, output
+        seen = {}
+        both_set = threading.Semaphore(0)
+        def operation(host):
+            with mc.manager.executor.operation():
+                env.host_string = host
+                output.running = False
+                both_set.release()
+                both_set.acquire()
+                seen[host] = (env.host_string, output.running)
+                both_set.release()
+        host_string, running = env.host_string, output.running
+        threads = [threading.Thread(target=operation, args=(host,)) for host in ('cloud@a:22', 'cloud@b:22')]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual({'cloud@a:22': ('cloud@a:22', False), 'cloud@b:22': ('cloud@b:22', False)}, seen)
+        self.assertEqual((host_string, running), (env.host_string, output.running))
+
+    def test_plan_timeout(self):
+        import threading, time
+        from multiprocessing import TimeoutError
+        def task(plan):
+            from fabric.api import env
+            time.sleep(plan[env.host_string])
+            return env.host_string
+        outcome = mc.manager.executor.execute_plan(task, {'cloud@a:22': 0, 'cloud@b:22': 2}, timeout=0.5)
+        self.assertEqual('cloud@a:22', outcome['cloud@a:22'])
+        self.assertTrue(isinstance(outcome['cloud@b:22'], TimeoutError))
+        # Timed plans share the threads of one pool
+        threads = threading.active_count()
+        mc.manager.executor.execute_plan(task, {'cloud@a:22': 0, 'cloud@b:22': 2}, timeout=0.5)
+        self.assertEqual(threads, threading.active_count())
+
+    def test_nested_operations(self):
+        from fabric.api import env
+        with mc.manager.executor.operation():
+            env.host_string = 'cloud@a:22'
+            with mc.manager.executor.operation():
+                self.assertEqual('cloud@a:22', env.host_string)
+                env.host_string = 'cloud@b:22'
+            self.assertEqual('cloud@a:22', env.host_string)
+
+
+class AdminTests(McTestCase):
+
+    def setUp(self):
+        from django.contrib.auth.models import User
+        McTestCase.setUp(self)
+        self._create_yigo_host(TEST_HOST, 3)
+        self._create_database_host(TEST_HOST, 3)
+        self._create_yigo_env('20140721')
+        self._create_java_env('1.6')
+        User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.client.login(username='admin', password='admin')
+
+    def _changelist_queries(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/admin/mc/yigoinstance/')
+        self.assertEqual(200, response.status_code)
+        return len(queries)
+
+    def test_changelist_queries_independent_of_rows(self):
+        Manager().create('t1', CONFIGS_SOURCE)
+        queries = self._changelist_queries()
+        Manager().create('t2', CONFIGS_SOURCE)
+        Manager().create('t3', CONFIGS_SOURCE)
+        self.assertEqual(queries, self._changelist_queries())
+
+    def test_action_post_skips_probe(self):
+        from django.contrib.admin import ACTION_CHECKBOX_NAME
+        pk = Manager().create('t1', CONFIGS_SOURCE)['id']
+        probe = status.probe
+        probed = []
+        status.probe = lambda *args, **kwargs: probed.append(args) or probe(*args, **kwargs)
+        try:
+            self.client.post('/admin/mc/yigoinstance/', {'action': 'start_instance', ACTION_CHECKBOX_NAME: [pk]})
+            self.assertEqual([], probed)
+            self.client.get('/admin/mc/yigoinstance/')
+            self.assertEqual(1, len(probed))
+        finally:
+            status.probe = probe
+
+    def test_running_column(self):
+        pk = Manager().create('t1', CONFIGS_SOURCE)['id']
+        YigoInstance.objects.filter(pk=pk).update(installed=True, database_installed=True)
+        cache.set('mc:running:%s' % (pk,), True)
+        response = self.client.get('/admin/mc/yigoinstance/')
+        self.assertContains(response, 'alt="True"', count=3)
+
+
+class FakeTransport(object):
+
+    def __init__(self):
+        self.active = True
+
+    def is_active(self):
+        return self.active
+
+    def send_ignore(self):
+        pass
+
+
+class FakeClient(object):
+
+    def __init__(self):
+        self.transport = FakeTransport()
+
+    def get_transport(self):
+        return self.transport
+
+    def close(self):
+        self.transport.active = False
+
+
+class ConnectionPoolTests(TestCase):
+
+    def setUp(self):
+        self._connect = sshpool.connect
+        sshpool.connect = lambda user, host, port, cache: FakeClient()
+
+    def tearDown(self):
+        sshpool.connect = self._connect
+
+    def test_reusing_connection(self):
+        pool = sshpool.ConnectionPool()
+        client = pool['cloud@1.1.1.1:22']
+        self.assertTrue(client is pool['cloud@1.1.1.1:22'])
+        self.assertEqual((1, 1), (pool.stats()['hits'], pool.stats()['misses']))
+
+    def test_reconnecting_dead_connection(self):
+        pool = sshpool.ConnectionPool()
+        client = pool['cloud@1.1.1.1:22']
+        client.transport.active = False
+        self.assertFalse(client is pool['cloud@1.1.1.1:22'])
+
+    def test_evicting_idle_connection(self):
+        pool = sshpool.ConnectionPool(idle_timeout=-1)
+        client = pool['cloud@1.1.1.1:22']
+        pool.evict_idle()
+        self.assertEqual(0, len(pool))
+        self.assertFalse(client.transport.active)
+
+    def test_max_connections_per_host(self):
+        pool = sshpool.ConnectionPool(max_per_host=1)
+        pool['cloud@1.1.1.1:22']
+        pool['root@1.1.1.1:22']
+        self.assertEqual(['root@1.1.1.1:22'], pool.keys())
+
+    def test_holding_connections(self):
+        pool = sshpool.ConnectionPool(idle_timeout=-1, max_per_host=1)
+        with pool.holding():
+            client = pool['cloud@1.1.1.1:22']
+            pool.evict_idle()
+            pool['root@1.1.1.1:22']
+            self.assertEqual(['cloud@1.1.1.1:22', 'root@1.1.1.1:22'], sorted(pool.keys()))
+        pool.evict_idle()
+        self.assertEqual(0, len(pool))
+        self.assertFalse(client.transport.active)
+
+
+class RemoteScriptTests(TestCase):
+
+    def setUp(self):
+        from fabric.api import local, settings
+        def run_locally(command, quiet=False, warn_only=False, **kwargs):
+            with settings(warn_only=True):
+                return local(command, capture=True, shell='/bin/bash')
+        self._run = scripts.run
+        scripts.run = run_locally
+
+    def tearDown(self):
+        scripts.run = self._run
+
+    def _script(self):
+        script = scripts.RemoteScript(quiet=True)
+        script.step('first', 'echo one')
+        script.step('ignored', 'false', check=False)
+        script.step('failing', 'cd /nonexistent-20140720')
+        script.step('never', 'echo never')
+        return script
+
+    def _test_steps(self):
+        reported = []
+        script = self._script()
+        script.on_step = lambda result: reported.append(result['step'])
+        try:
+            script.run()
+        except RemoteStepFailed, e:
+            self.assertEqual('failing', e.step)
+            self.assertEqual(1, e.exit_code)
+            self.assertTrue(e.message.find('20140720') > -1)
+            self.assertEqual([('first', 0), ('ignored', 1), ('failing', 1)],
+                             [(s['step'], s['exit_code']) for s in e.steps])
+            self.assertEqual(['first', 'ignored', 'failing'], reported)
+        else:
+            self.fail('Must raise ' + RemoteStepFailed.__name__)
+
+    def test_fused_steps(self):
+        with self.settings(MC_FUSED_SCRIPTS=True):
+            self._test_steps()
+
+    def test_separate_steps(self):
+        with self.settings(MC_FUSED_SCRIPTS=False):
+            self._test_steps()
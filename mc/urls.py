@@ -3,4 +3,6 @@ from mc import views
 
 urlpatterns = patterns('',
     url(r'^rpc/$', views.rpc, name='rpc'),
+    url(r'^events/(?P<pk>\d+)/$', views.events, name='events'),
+    url(r'^metrics/$', views.metrics, name='metrics'),
 )
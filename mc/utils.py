@@ -7,6 +7,16 @@ def generate_password():
     return ''.join(sample(chars, 8))
 
 
+def get_host(instance):
+    yigo_host = instance.yigo_host
+    return '%s@%s:%s' % (yigo_host.ssh_user, yigo_host.address, yigo_host.ssh_port,)
+
+
+def get_database_host(instance):
+    database_host = instance.database_host
+    return '%s@%s:%s' % (database_host.ssh_user, database_host.address, database_host.ssh_port,)
+
+
 # Local Variables: **
 # comment-column: 56 **
 # indent-tabs-mode: nil **
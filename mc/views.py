@@ -1,10 +1,41 @@
+import json
+import time
+
+from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
 from django.core.urlresolvers import reverse
+from django.http import HttpResponse, StreamingHttpResponse, HttpResponseBadRequest, Http404
 from django.views.decorators.csrf import csrf_exempt
 
+from mc.exceptions import *
 from mc.jsonrpc import *
 from mc.manager import Manager
+from mc.models import YigoInstance
+from mc import events as mc_events
+from mc import metrics as mc_metrics
+
+
+# JSON-RPC 2.0 error codes of the errors callers are expected to handle
+ERROR_CODES = (
+    (ObjectDoesNotExist, -32001),
+    (NoMoreSpareHosts, -32002),
+    (NoEnv, -32003),
+    (InstanceNotInstalled, -32004),
+    (InstanceAlreadyInstalled, -32005),
+    (InstanceIsRunning, -32006),
+    (InstanceIsBusy, -32007),
+    (RefreshOldData, -32008),
+    (UninstallBeforeDelete, -32009),
+    (RemoteStepFailed, -32010),
+    (ServicePortTaken, -32011),
+)
+
 
 class RpcMethods(object):
+    """
+    The JSON-RPC methods. All of them may run concurrently in a batch, fabtasks
+    run with a fabric state of their own (see `mc.manager.Executor').
+    """
 
     def __init__(self):
         self.url = reverse('mc:rpc')
@@ -20,27 +51,114 @@ class RpcMethods(object):
 
     @publicmethod
     def install(self, pk):
-        return self.manager.install(pk)
+        return self.manager.submit('install', pk)
 
     @publicmethod
     def uninstall(self, pk):
-        return self.manager.uninstall(pk)
+        return self.manager.submit('uninstall', pk)
 
     @publicmethod
     def start(self, pk):
-        return self.manager.start(pk)
+        return self.manager.submit('start', pk)
 
     @publicmethod
     def stop(self, pk):
-        return self.manager.stop(pk)
+        return self.manager.submit('stop', pk)
+
+    @publicmethod
+    def is_running(self, pk, refresh=False):
+        return self.manager.is_running(pk, refresh)
+
+    @publicmethod
+    def tail_log(self, pk, offset=None, max_bytes=None):
+        return self.manager.tail_log(pk, offset, max_bytes)
 
     @publicmethod
-    def is_running(self, pk):
-        return self.manager.is_running(pk)
+    def install_many(self, pks):
+        return self.manager.install_many(pks)
 
+    @publicmethod
+    def start_many(self, pks):
+        return self.manager.start_many(pks)
+
+    @publicmethod
+    def stop_many(self, pks):
+        return self.manager.stop_many(pks)
+
+    @publicmethod
+    def is_running_many(self, pks, refresh=False):
+        return self.manager.is_running_many(pks, refresh)
+
+    @publicmethod
+    def install_databases_many(self, pks):
+        return self.manager.install_databases_many(pks)
+
+    @publicmethod
+    def uninstall_databases_many(self, pks):
+        return self.manager.uninstall_databases_many(pks)
+
+    @publicmethod
+    def job_status(self, job_id):
+        return self.manager.job_status(job_id)
+
+    @publicmethod
+    def ssh_pool_stats(self):
+        return self.manager.ssh_pool_stats()
+
+
+# Built on the first request, the URLconf cannot be reversed while it is imported
+_rpc = None
 
 @csrf_exempt
 def rpc(request):
-    rpc     = JsonRpc( RpcMethods() )
-    result  = rpc.handle_request(request)
+    global _rpc
+    if _rpc is None:
+        _rpc = JsonRpc( RpcMethods(), error_codes=ERROR_CODES, batch_workers=settings.MC_RPC_BATCH_WORKERS,
+                        observer=mc_metrics.observe_rpc )
+    result  = _rpc.handle_request(request)
     return result
+
+
+def _event_stream(pk, after):
+    yield 'retry: %d\n\n' % (settings.MC_EVENTS_POLL * 1000,)
+    deadline = time.time() + settings.MC_EVENTS_STREAM_SECONDS
+    quiet_since = time.time()
+    while True:
+        for event in mc_events.since(pk, after):
+            after = event['id']
+            quiet_since = time.time()
+            yield 'id: %s\nevent: %s\ndata: %s\n\n' % (event['id'], event['event'], json.dumps(event),)
+        if time.time() >= deadline:
+            return
+        if time.time() - quiet_since >= 15:
+            # Keep proxies from closing an idle stream
+            quiet_since = time.time()
+            yield ':\n\n'
+        time.sleep(settings.MC_EVENTS_POLL)
+
+def events(request, pk):
+    """
+    Progress events of instance `pk' as a server-sent event stream.
+
+    Buffered events newer than the Last-Event-ID header (or the `after' parameter)
+    are replayed first, all of them without either. The stream ends after
+    MC_EVENTS_STREAM_SECONDS, an EventSource reconnects and resumes from the last
+    event it got. The stream holds a worker thread of the web server until then.
+    """
+    pk = int(pk)
+    after = request.META.get('HTTP_LAST_EVENT_ID') or request.GET.get('after')
+    try:
+        after = int(after) if after else None
+    except ValueError:
+        return HttpResponseBadRequest('Bad event id')
+    if not YigoInstance.objects.filter(pk=pk).exists():
+        raise Http404
+    response = StreamingHttpResponse(_event_stream(pk, after), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def metrics(request):
+    """Metrics of all web and job worker processes, in the Prometheus text format."""
+    return HttpResponse(mc_metrics.collect(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -63,6 +63,19 @@ DATABASES = {
     }
 }
 
+# Progress events and running states are kept in the cache, a file cache shared by the job
+# workers and the uwsgi processes of this machine. Use e.g. memcached when they run on several
+# machines
+import tempfile
+CACHES = {
+    'default': {
+        'BACKEND': 'mc.cache.SharedFileCache',
+        'LOCATION': os.path.join(tempfile.gettempdir(), 'yigo_runtime-cache'),
+        'OPTIONS': {'MAX_ENTRIES': 100000,              # culling drops event buffers at random
+                    'CULL_INTERVAL': 60},               # seconds between counts of the entries
+    }
+}
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.6/topics/i18n/
 
@@ -87,3 +100,63 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'static')
 # LOGSTASH
 LOGSTASH_HOST = '1.1.2.182'
 LOGSTASH_PORT = 4560
+
+
+# Number of yigo hosts worked on at the same time by the *_many RPC methods
+MC_BATCH_PARALLELISM = 8
+
+# SSH connections kept open by each worker process
+MC_SSH_IDLE_TIMEOUT = 300                   # seconds before an unused connection is closed
+MC_SSH_MAX_CONNECTIONS_PER_HOST = 4
+
+# Seconds instance running states are cached (see CACHES)
+MC_STATUS_TTL = 10
+
+# Seconds the admin instance list waits for the running states of the instances shown
+MC_ADMIN_STATUS_TIMEOUT = 5
+
+# Seconds starting an instance waits for its JVM to log MC_START_READY_LINE, reporting how long it
+# took (see mc.fabtasks.start_yigo_instance), 0 to return right after launching it
+MC_START_READY_TIMEOUT = 0
+MC_START_READY_LINE = 'Server started'
+
+# Send the shell steps of a fabtask as one remote script instead of one ssh command per step
+MC_FUSED_SCRIPTS = True
+
+# Size limit in bytes of the config pack cache on each yigo host, least recently used packs are dropped
+MC_CONFIGS_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+
+# Instance leases (see mc.locks), times in seconds
+MC_LEASE_TTL = 60                           # a lease not renewed for this long is reclaimed
+MC_LEASE_POLL = 0.5                         # how often waiting callers check the lease
+MC_LEASE_WAIT = 0                           # how long operations wait for a lease by default
+MC_JOB_LEASE_WAIT = 60                      # how long queued jobs wait for a lease
+MC_JOB_TTL = 60                             # a running job not renewed for this long lost its worker
+
+# Threads running the calls of one JSON-RPC 2.0 batch request concurrently
+MC_RPC_BATCH_WORKERS = 8
+
+# Progress events of instance operations (see mc.events), kept in the cache (see CACHES). Every
+# open event stream holds a uwsgi worker thread polling the cache until it ends
+MC_EVENTS_BUFFER = 100                      # events kept per instance for late subscribers
+MC_EVENTS_TTL = 3600                        # seconds the events of an idle instance are kept
+MC_EVENTS_POLL = 0.5                        # seconds between checks for new events of a stream
+MC_EVENTS_STREAM_SECONDS = 30               # an event stream ends after this, clients reconnect
+
+# Bytes of instance log returned by one tail_log call, by default and at most
+MC_LOG_CHUNK_BYTES = 64 * 1024
+MC_LOG_MAX_CHUNK_BYTES = 1024 * 1024
+
+# Metrics of every process are saved to a file of its own in this directory, /mc/metrics/ adds them up
+MC_METRICS_DIR = os.path.join(tempfile.gettempdir(), 'yigo_runtime-metrics')
+MC_METRICS_FLUSH_SECONDS = 1
+
+# How fabtasks run remote commands: mc.backends.FabricBackend over SSH, or mc.backends.SimulatorBackend
+# running the commands of every host in a sandbox directory under MC_SIMULATOR_ROOT on this machine
+MC_EXECUTION_BACKEND = 'mc.backends.FabricBackend'
+MC_SIMULATOR_ROOT = os.path.join(tempfile.gettempdir(), 'yigo_runtime-simulator')
+MC_SIMULATOR_LATENCY = 0.0                  # seconds added to every command
+MC_SIMULATOR_JITTER = 0.0                   # at most these seconds added at random
+MC_SIMULATOR_CONNECT_LATENCY = 0.0          # seconds added to the first command of a host
+MC_SIMULATOR_JVM_STARTUP = 0.0              # seconds a simulated JVM takes to start
+MC_SIMULATOR_DOWNLOAD = 0.0                 # seconds a simulated config pack download takes